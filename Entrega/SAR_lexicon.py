@@ -0,0 +1,267 @@
+import heapq
+from array import array
+from bisect import bisect_left
+
+# Indice permuterm sin cadenas repetidas. En lugar de guardar cada rotacion de cada termino
+# (terminos de n caracteres, n + 1 rotaciones y cada una con su lista de terminos) se guarda
+# el lexico del campo una sola vez y, por cada rotacion, dos enteros: el id del termino (su
+# posicion en el lexico ordenado) y el numero de caracteres rotados. Las rotaciones estan
+# ordenadas por la cadena rotada, que se reconstruye al comparar en las busquedas binarias.
+#
+# La misma clase sirve en memoria (lexico como lista de str y rotaciones en un array) y sobre un
+# segmento (lexico leido de la tabla de terminos y rotaciones en el fichero mapeado, ver SAR_segment).
+#
+# El indice de stems de un campo en memoria (Stems) guarda igualmente los terminos de cada stem
+# como ids del mismo lexico, y no otra copia de sus cadenas.
+
+
+def permuterm_rotations(terms):
+    """
+    Calcula las rotaciones del indice permuterm de un campo.
+
+    param:  "terms": lexico del campo ordenado, el id de cada termino es su posicion
+
+    return: array con los pares (id del termino, caracteres rotados) ordenados por el permuterm
+    """
+    permuterms = []
+    ids = array('i')
+    shifts = array('i')
+    for term_id, term in enumerate(terms):
+        term += '$'
+        permuterms.extend(term[shift:] + term[:shift] for shift in range(len(term)))
+        ids.extend(array('i', [term_id]) * len(term))
+        shifts.extend(range(len(term)))
+    order = sorted(range(len(permuterms)), key=permuterms.__getitem__)
+    del permuterms
+    rotations = array('i', [0]) * (2 * len(order))
+    rotations[0::2] = array('i', [ids[i] for i in order])
+    rotations[1::2] = array('i', [shifts[i] for i in order])
+    return rotations
+
+
+def merge_lexicon(terms, new):
+    """
+    Añade terminos nuevos a un lexico.
+
+    param:  "terms": lexico ordenado
+            "new": lista ordenada de terminos que no estan en "terms"
+
+    return: tupla (lexico ordenado con los terminos de ambos, array con el id en el lexico nuevo
+            de cada termino de "terms", array con el id en el lexico nuevo de cada termino de "new")
+    """
+    lexicon = list(heapq.merge(terms, new))
+    added = set(new)
+    old_ids = array('i')
+    new_ids = array('i')
+    for term_id, term in enumerate(lexicon):
+        (new_ids if term in added else old_ids).append(term_id)
+    return lexicon, old_ids, new_ids
+
+
+class Permuterms:
+    """
+    Indice permuterm de un campo: permuterm --> [termino], con la interfaz de diccionario
+    ordenado que usa SAR_Project (len, prefix_items, items).
+    """
+
+    __slots__ = ('terms', 'rotations')
+
+    def __init__(self, terms, rotations):
+        """
+        param:  "terms": lexico del campo ordenado (secuencia id --> termino)
+                "rotations": secuencia de enteros con los pares de permuterm_rotations
+        """
+        self.terms = terms
+        self.rotations = rotations
+
+    @classmethod
+    def from_terms(cls, terms):
+        """
+        param:  "terms": lista ordenada con los terminos del campo
+
+        return: indice permuterm de esos terminos
+        """
+        return cls(terms, permuterm_rotations(terms))
+
+    def add_terms(self, terms, merged=None):
+        """
+        Añade terminos nuevos al indice sin calcular de nuevo las rotaciones de los que ya tenia:
+        solo se calculan las de los terminos nuevos, que se insertan con busquedas binarias entre
+        las existentes, y los ids de los terminos que ya estaban se desplazan en el lexico ampliado.
+
+        param:  "terms": lista ordenada de terminos que no estan en el indice
+                "merged": resultado de merge_lexicon(self.terms, terms) si ya se ha calculado
+
+        return: indice permuterm con los terminos de ambos
+        """
+        lexicon, old_ids, new_ids = merged or merge_lexicon(self.terms, terms)
+        rotations = array('i', self.rotations)
+        rotations[0::2] = array('i', map(old_ids.__getitem__, rotations[0::2]))
+
+        added = permuterm_rotations(terms)
+        res = array('i')
+        positions = range(len(self))
+        last = 0
+        for i in range(0, len(added), 2):
+            term = terms[added[i]] + '$'
+            shift = added[i + 1]
+            # The new rotations are sorted, each one goes after the previous one
+            pos = bisect_left(positions, term[shift:] + term[:shift], last, key=self.permuterm)
+            res.extend(rotations[2 * last:2 * pos])
+            res.extend((new_ids[added[i]], shift))
+            last = pos
+        res.extend(rotations[2 * last:])
+        return Permuterms(lexicon, res)
+
+    def __len__(self):
+        return len(self.rotations) // 2
+
+    def permuterm(self, i):
+        """
+        return: cadena del permuterm i (en el orden del indice)
+        """
+        term = self.terms[self.rotations[2 * i]] + '$'
+        shift = self.rotations[2 * i + 1]
+        return term[shift:] + term[:shift]
+
+    def prefix_items(self, prefix):
+        """
+        Permuterms que empiezan por "prefix", con dos busquedas binarias.
+
+        param:  "prefix": cadena
+
+        return: generador de pares (permuterm, lista con su termino) en orden
+        """
+        positions = range(len(self))
+        lo = bisect_left(positions, prefix, key=self.permuterm)
+        # Permuterms with the prefix are smaller than the prefix with its last character incremented
+        hi = bisect_left(positions, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo, key=self.permuterm) \
+            if prefix else len(self)
+        for i in range(lo, hi):
+            yield self.permuterm(i), [self.terms[self.rotations[2 * i]]]
+
+    def items(self):
+        for i in range(len(self)):
+            yield self.permuterm(i), [self.terms[self.rotations[2 * i]]]
+
+
+class Stems:
+    """
+    Indice de stems de un campo en memoria: stem --> [termino], con la interfaz de diccionario
+    que usa SAR_Project (len, iter, get, items). Como la tabla de stems de un segmento, guarda
+    los stems ordenados y los terminos de todos ellos seguidos, como ids del lexico ordenado
+    del campo, en un solo array: los de stems[i] son ids[starts[i]:starts[i + 1]].
+    """
+
+    __slots__ = ('terms', 'stems', 'starts', 'ids')
+
+    def __init__(self, terms, stems, starts, ids):
+        """
+        param:  "terms": lexico del campo ordenado (secuencia id --> termino)
+                "stems": lista ordenada de stems
+                "starts": array con la posicion en "ids" de los terminos de cada stem y el final
+                "ids": array con los ids de los terminos de cada stem, en orden
+        """
+        self.terms = terms
+        self.stems = stems
+        self.starts = starts
+        self.ids = ids
+
+    @classmethod
+    def from_groups(cls, terms, groups):
+        """
+        param:  "terms": lista ordenada con los terminos del campo
+                "groups": iterable de pares (stem, ids de sus terminos)
+
+        return: indice de stems con esos grupos
+        """
+        stems = []
+        starts = array('i', [0])
+        ids = array('i')
+        for stem, group in sorted(groups):
+            stems.append(stem)
+            ids.extend(sorted(group))
+            starts.append(len(ids))
+        return cls(terms, stems, starts, ids)
+
+    @classmethod
+    def from_terms(cls, terms, stems):
+        """
+        param:  "terms": lista ordenada con los terminos del campo
+                "stems": diccionario termino --> stem con todos los terminos (SAR_Project.stem_cache)
+
+        return: indice de stems de esos terminos
+        """
+        groups = {}
+        for term_id, term in enumerate(terms):
+            groups.setdefault(stems[term], []).append(term_id)
+        return cls.from_groups(terms, groups.items())
+
+    @classmethod
+    def from_lists(cls, terms, lists):
+        """
+        param:  "terms": lista ordenada con los terminos del campo
+                "lists": iterable de pares (stem, lista de terminos), como los indices de stems de
+                         versiones anteriores
+
+        return: indice de stems con los mismos grupos
+        """
+        ids = {term: term_id for term_id, term in enumerate(terms)}
+        return cls.from_groups(terms, ((stem, [ids[term] for term in group]) for stem, group in lists))
+
+    def add_terms(self, terms, stems, merged=None):
+        """
+        Añade terminos nuevos al indice: los ids de los que ya estaban se desplazan en el lexico
+        ampliado y los nuevos se añaden al grupo de su stem.
+
+        param:  "terms": lista ordenada de terminos que no estan en el indice
+                "stems": diccionario termino --> stem con los terminos nuevos
+                "merged": resultado de merge_lexicon(self.terms, terms) si ya se ha calculado
+
+        return: indice de stems con los terminos de ambos
+        """
+        lexicon, old_ids, new_ids = merged or merge_lexicon(self.terms, terms)
+        groups = {stem: [old_ids[term_id] for term_id in ids] for stem, ids in self.id_items()}
+        for term, term_id in zip(terms, new_ids):
+            groups.setdefault(stems[term], []).append(term_id)
+        return Stems.from_groups(lexicon, groups.items())
+
+    def _find(self, stem):
+        """
+        return: posicion de "stem" en self.stems, -1 si no esta
+        """
+        i = bisect_left(self.stems, stem)
+        return i if i < len(self.stems) and self.stems[i] == stem else -1
+
+    def _terms(self, i):
+        return [self.terms[term_id] for term_id in self.ids[self.starts[i]:self.starts[i + 1]]]
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __iter__(self):
+        return iter(self.stems)
+
+    def __contains__(self, stem):
+        return self._find(stem) >= 0
+
+    def __getitem__(self, stem):
+        i = self._find(stem)
+        if i < 0:
+            raise KeyError(stem)
+        return self._terms(i)
+
+    def get(self, stem, default=None):
+        i = self._find(stem)
+        return default if i < 0 else self._terms(i)
+
+    def items(self):
+        for i, stem in enumerate(self.stems):
+            yield stem, self._terms(i)
+
+    def id_items(self):
+        """
+        return: generador de pares (stem, array con los ids de sus terminos) en orden
+        """
+        for i, stem in enumerate(self.stems):
+            yield stem, self.ids[self.starts[i]:self.starts[i + 1]]
@@ -6,6 +6,23 @@ import re
 from pathlib import Path
 import sys
 import math
+import pickle
+import heapq
+import tempfile
+import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from bisect import bisect_left
+from itertools import accumulate, compress, groupby, islice, repeat
+from multiprocessing import Pool
+
+from SAR_lexicon import Permuterms, Stems, merge_lexicon, permuterm_rotations
+from SAR_postings import (BLOCK_SIZE, Bitmap, Posting, bitmap_and, bitmap_minus, bitmap_or, block_maxima,
+                          complement_ids, is_dense)
+from SAR_query import (Complement, Difference, Leaf, Near, Or, Phrase, Term, Union, explain, parse_query,
+                       plan_query, query_terms)
+from SAR_segment import Segment, SegmentWriter, UpdatedTable, finish_segment, is_segment, write_segment
+from SAR_tables import NewsTable, PathTable
 
 
 class SAR_Project:
@@ -29,6 +46,33 @@ class SAR_Project:
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
+    # memoria aproximada (bytes) que ocupa cada token indexado en un bloque, para la indexacion por bloques
+    BLOCK_TOKEN_BYTES = 50
+    BLOCK_POSITIONAL_TOKEN_BYTES = 110
+
+    # numero de tokens de los snippets
+    SNIPPET_WINDOW = 10
+
+    # self.multi_or_posting marca los newid en un bytearray (en vez de mezclar las listas con un heap)
+    # si las listas tienen en total al menos 1 / UNION_DENSITY newid por noticia de la coleccion
+    UNION_DENSITY = 64
+
+    # parametros de BM25 para el ranking
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    # numero de noticias leidas que se guardan en la cache de self.read_news
+    NEWS_CACHE = 256
+
+    # numero maximo de newid de las posting lists guardadas en la cache de consultas (self.query_cache)
+    QUERY_CACHE = 1 << 20
+
+    # terminos por tarea al calcular los stems con un pool de procesos (ver self.stem_terms)
+    STEM_CHUNK = 4096
+
+    # numero maximo de terminos de las consultas que no estan en el indice que se guardan en self.stem_cache
+    QUERY_STEMS = 1 << 14
+
     def __init__(self):
         """
         Constructor de la classe SAR_Indexer.
@@ -54,6 +98,18 @@ class SAR_Project:
             'article': {},
             'summary': {}
         }  # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
+        # Con la opcion stemming cada campo tiene un SAR_lexicon.Stems: los terminos de cada stem como ids en
+        # el lexico ordenado del campo, el mismo que el de su indice permuterm
+        # posting lists precalculadas de los stems con mas de un termino (opcion stem_postings):
+        # campo --> stem --> newid --> suma de las frecuencias de sus terminos
+        self.spindex = {field: {} for field in self.sindex}
+        self.stem_postings = False
+        # termino --> stem de todos los terminos del indice, compartido por todos los campos para calcular
+        # cada stem una sola vez; se guarda con el indice para que el stemming de las consultas sea un acceso
+        self.stem_cache = {}
+        self.query_stems = 0
+        # en un indice abierto desde un segmento: campo --> id del stem de cada termino (ver self.stem)
+        self.stem_ids = {}
         self.ptindex = {
             'title': {},
             'date': {},
@@ -61,23 +117,78 @@ class SAR_Project:
             'article': {},
             'summary': {}
         }  # hash para el indice permuterm.
-        # diccionario de documentos --> clave: entero(docid),  valor: ruta del fichero.
-        self.docs = {}
+        # Con la opcion permuterm cada campo tiene un SAR_lexicon.Permuterms: las rotaciones como pares
+        # (id en el lexico ordenado del campo, caracteres rotados), ordenados para buscar con bisecciones
+        # tabla de documentos (SAR_tables.PathTable) --> clave: entero(docid),  valor: ruta del fichero.
+        self.docs = PathTable()
         # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
-        self.weight = {}
-        # hash de noticias --> clave entero (newid), valor: la info necesaria para diferenciar la noticia dentro de su fichero (doc_id y posición dentro del documento)
-        self.news = {}
+        # 'length': campo --> array con el numero de tokens de cada noticia (por newid)
+        # 'total': campo --> numero de tokens de las noticias no borradas
+        self.weight = {'length': {}, 'total': {}}
+        # tabla de noticias (SAR_tables.NewsTable) --> clave entero (newid), valor: la info necesaria para diferenciar
+        # la noticia dentro de su fichero (doc_id, posición dentro del documento, offset en bytes y longitud en
+        # bytes del objeto JSON dentro del fichero), una columna de enteros por cada dato
+        self.news = NewsTable()
+        # ultimas noticias leidas por self.read_news: newid --> diccionario con los campos de la noticia
+        self.news_cache = OrderedDict()
+        # resultados de consultas y subconsultas: (clave del plan, stemming) --> posting list, ver self.cache_get
+        self.query_cache = OrderedDict()
+        self.cache_size = self.QUERY_CACHE  # valor por defecto, se cambia con self.set_cache()
+        self.cache_postings = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         # expresion regular para hacer la tokenizacion
-        self.tokenizer = re.compile(r"\W+")
+        self.tokenizer = re.compile(r"\w+")
         self.stemmer = SnowballStemmer('spanish')  # stemmer en castellano
         self.show_all = False  # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False  # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False  # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.show_plan = False  # valor por defecto, se cambia con self.set_explain()
+        self.use_pruning = True  # valor por defecto, se cambia con self.set_pruning()
+        # numero de noticias puntuadas en el ultimo ranking
+        self.scored = 0
 
         self.docid = 0
         self.news_counter = 0
         self.tokens = 0
+        # posting lists como objetos Posting (arrays ordenados) en lugar de diccionarios, ver self.make_compact
+        self.compact = False
+        # fraccion de la coleccion a partir de la cual una posting list se guarda tambien como bitmap
+        self.bitmap_threshold = None
+        # limite de memoria (MB) de la indexacion por bloques y ficheros temporales con los bloques volcados
+        self.memory = None
+        self.runs = []
+        # tiempo de cada fase de la indexacion y el guardado
+        self.timings = {}
+        # docid --> (tamaño, fecha de modificacion) del fichero cuando se indexo, para las actualizaciones
+        self.stamps = {}
+        # newid de las noticias borradas (ordenados) y docid de los ficheros borrados, ver self.update_dir
+        self.deleted = array('i')
+        self.deleted_docs = set()
+
+    def __setstate__(self, state):
+        # Indexes pickled by older versions lack the attributes added since, they keep their defaults.
+        # Their tokenizer matched the separators (r"\W+"), the current one is kept.
+        state.pop('tokenizer', None)
+        self.__init__()
+        self.__dict__.update(state)
+        # Their weight was an empty dictionary, without lengths the ranking falls back to TF-IDF
+        self.weight.setdefault('length', {})
+        self.weight.setdefault('total', {})
+        # Older versions also kept every permuterm in a dictionary (and its sorted keys in self.ptkeys)
+        self.__dict__.pop('ptkeys', None)
+        # and the terms of each stem in lists
+        if state.get('stemming') and any(isinstance(table, dict) for table in self.sindex.values()):
+            self.sindex = {field: Stems.from_lists(sorted(self.index[field]), self.sindex[field].items())
+                           for field in self.sindex}
+        if state.get('permuterm') and any(isinstance(table, dict) for table in self.ptindex.values()):
+            self.make_permuterm()
+        # and the news and the files in dictionaries
+        if isinstance(self.news, dict):
+            self.news = NewsTable.from_rows([self.news[new] for new in range(len(self.news))])
+            self.docs = PathTable(self.docs[docid] for docid in range(len(self.docs)))
+
     ###############################
     ###                         ###
     ###      CONFIGURACION      ###
@@ -140,6 +251,199 @@ class SAR_Project:
         """
         self.use_ranking = v
 
+    def set_explain(self, v):
+        """
+
+        Cambia el modo de mostrar el plan de las consultas.
+
+        input: "v" booleano.
+
+        si self.show_plan es True se mostrara el plan elegido para cada consulta con su tamaño y coste estimados
+
+        """
+        self.show_plan = v
+
+    def set_pruning(self, v):
+        """
+
+        Cambia el uso de MaxScore en el ranking.
+
+        input: "v" booleano.
+
+        si self.use_pruning es True las consultas disyuntivas se ordenan con self.rank_maxscore,
+        que no puntua las noticias que no pueden entrar en los resultados mostrados
+
+        """
+        self.use_pruning = v
+
+    def set_cache(self, v):
+        """
+
+        Cambia el tamaño de la cache de consultas.
+
+        input: "v" numero maximo de newid guardados en la cache, 0 para no usarla.
+
+        """
+        self.cache_size = v
+        self.clear_caches()
+
+    def clear_caches(self):
+        """
+        Vacia las caches de consultas y de noticias, se llama cada vez que cambia el indice.
+        """
+        self.query_cache.clear()
+        self.cache_postings = 0
+        self.news_cache.clear()
+
+    def cache_get(self, key):
+        """
+        param:  "key": clave de una consulta o subconsulta, ver self.execute
+
+        return: la posting list guardada en la cache de consultas, None si no esta
+        """
+        res = self.query_cache.get(key)
+        if res is None:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.query_cache.move_to_end(key)
+        return res
+
+    def cache_put(self, key, res):
+        """
+        Guarda una posting list en la cache de consultas, eliminando las menos usadas recientemente
+        hasta que el numero de newid guardados no supera self.cache_size.
+
+        param:  "key": clave de la consulta o subconsulta
+                "res": posting list (no se debe modificar despues)
+        """
+        if not self.cache_size or len(res) > self.cache_size:
+            return
+        self.query_cache[key] = res
+        self.cache_postings += len(res)
+        while self.cache_postings > self.cache_size:
+            self.cache_postings -= len(self.query_cache.popitem(last=False)[1])
+
+    def save(self, filename, format='segment'):
+        """
+        Guarda el indice en un fichero.
+
+        El indice se escribe en un fichero temporal que sustituye a "filename" al terminar, asi
+        se puede guardar sobre el mismo segmento del que se ha cargado (ver self.update_dir).
+
+        param:  "filename": fichero de salida
+                "format": 'segment' para el formato binario de SAR_segment,
+                          'pickle' para guardar el objeto completo
+
+        """
+        tmpname = filename + '.tmp'
+        if format == 'pickle':
+            self.materialize()
+            with open(tmpname, 'wb') as fh:
+                pickle.dump(self, fh)
+        elif self.runs:
+            self.merge_blocks(tmpname)
+        else:
+            write_segment(self, tmpname)
+        os.replace(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Carga un indice guardado con self.save en cualquiera de los dos formatos.
+
+        Un segmento se abre con mmap: solo se leen los metadatos y las posting lists
+        se decodifican cuando una consulta las necesita.
+
+        param:  "filename": fichero con el indice
+
+        return: objeto SAR_Project
+        """
+        if not is_segment(filename):
+            with open(filename, 'rb') as fh:
+                return pickle.load(fh)
+
+        project = cls()
+        project.use_segment(Segment(filename))
+        return project
+
+    def use_segment(self, segment):
+        """
+        Sustituye los indices, las noticias y los ficheros por las tablas de un segmento abierto.
+
+        param:  "segment": objeto SAR_segment.Segment
+        """
+        for name, value in segment.config.items():
+            setattr(self, name, value)
+        self.compact = True
+        self.index = {field: segment.terms(field) for field in self.index}
+        self.sindex = {field: segment.stems(field) for field in self.sindex}
+        self.spindex = {field: segment.stem_postings(field) for field in self.spindex}
+        # The fields with more terms first, a query term is most likely in them
+        self.stem_ids = {field: segment.stem_ids(field)
+                         for field in sorted(self.sindex, key=lambda field: -len(self.index[field]))}
+        self.ptindex = {field: segment.permuterms(field) for field in self.ptindex}
+        self.news = segment.news()
+        self.docs = segment.docs()
+        stamps = segment.array('stamps', 'q')
+        self.stamps = {docid: (stamps[2 * docid], stamps[2 * docid + 1])
+                       for docid in range(len(stamps) // 2) if stamps[2 * docid] >= 0}
+        self.deleted = segment.array('deleted')
+        self.deleted_docs = set(segment.array('deleted_docs'))
+        self.weight = {'length': {}, 'total': {}}
+        for field in self.index:
+            lengths = segment.array('lengths/' + field)
+            if lengths:
+                self.weight['length'][field] = lengths
+                self.weight['total'][field] = sum(lengths) - sum(lengths[new] for new in self.deleted)
+
+    def materialize(self, postings=True):
+        """
+        Carga en memoria las tablas de un indice abierto desde un segmento para poder modificarlo:
+        los indices pasan a ser diccionarios de Posting y las noticias y ficheros tablas en memoria.
+        Con un indice que ya esta en memoria no hace nada.
+
+        param:  "postings": False para dejar las posting lists en el segmento: los indices de terminos
+                            pasan a ser SAR_segment.UpdatedTable, que solo tienen en memoria las posting
+                            lists que se cambian (ver self.update_dir)
+        """
+        if not isinstance(self.docs, PathTable):
+            # Segment keys are already sorted, so the keys of each index are the lexicon of the segment.
+            # Stems and permuterms keep their term ids over it and do not repeat the strings of the terms.
+            lexicon = {field: self.index[field].keys() for field in self.index}
+            if self.stemming:
+                # Version 1 segments store the terms of the stems as strings
+                self.sindex = {field: Stems.from_groups(lexicon[field], self.sindex[field].id_items())
+                               if self.sindex[field].version != 1 else Stems.from_lists(lexicon[field], self.sindex[field].items())
+                               for field in self.sindex}
+            else:
+                self.sindex = {field: {} for field in self.sindex}
+            self.stem_ids = {}
+            if self.permuterm:
+                # Version 1 segments store the permuterms as strings, they are computed again
+                self.ptindex = {field: Permuterms(lexicon[field], array('i', self.ptindex[field].rotations))
+                                if isinstance(self.ptindex[field], Permuterms) else Permuterms.from_terms(lexicon[field])
+                                for field in self.ptindex}
+            else:
+                self.ptindex = {field: {} for field in self.ptindex}
+            self.news = NewsTable([array('i', column) for column in self.news.columns])
+            self.docs = PathTable(self.docs[docid] for docid in self.docs.keys())
+            self.index = {field: UpdatedTable(self.index[field], lexicon[field]) for field in self.index}
+            self.spindex = {field: UpdatedTable(self.spindex[field]) for field in self.spindex}
+        if postings and any(isinstance(table, UpdatedTable) for table in self.index.values()):
+            self.index = {field: dict(self.index[field].items()) for field in self.index}
+            self.spindex = {field: dict(self.spindex[field].items()) for field in self.spindex}
+            for field in self.index:
+                # The lexicon shares the strings of the terms with the index
+                lexicon = list(self.index[field])
+                for table in (self.sindex[field], self.ptindex[field]):
+                    if isinstance(table, (Stems, Permuterms)):
+                        table.terms = lexicon
+                # In memory the stem of every term is in the cache, the inverse of the stems tables
+                if isinstance(self.sindex[field], Stems):
+                    for stem, terms in self.sindex[field].items():
+                        self.stem_cache.update(dict.fromkeys(terms, stem))
+
     ###############################
     ###                         ###
     ###   PARTE 1: INDEXACION   ###
@@ -159,21 +463,346 @@ class SAR_Project:
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        self.stem_postings = self.stemming and args.get('stem_postings', False)
+        self.compact = args.get('compact', False)
+        self.bitmap_threshold = args.get('bitmap_threshold')
+        self.memory = args.get('memory')
+        jobs = args.get('jobs') or 1
+
+        filenames = self.list_files(root)
+
+        pool = None
+        if jobs > 1 and len(filenames) > 1 and not self.memory:
+            pool = Pool(jobs)
+        try:
+            t0 = time.time()
+            if self.memory:
+                self.index_blocks(filenames)
+            elif pool is not None:
+                self.index_parallel(filenames, pool, jobs)
+            else:
+                for fullname in filenames:
+                    self.index_file(fullname)
+            self.timings['inverting'] = time.time() - t0 - self.timings.get('writing blocks', 0)
+
+            # Blocks written to disk are merged when the index is saved (see self.merge_blocks)
+            if not self.runs:
+                t0 = time.time()
+                if self.stemming:
+                    self.make_stemming(pool)
+                if self.stem_postings:
+                    self.make_stem_postings()
+
+                if self.permuterm:
+                    self.make_permuterm(pool)
+                self.timings['stems and permuterms'] = time.time() - t0
+
+                if self.compact:
+                    t0 = time.time()
+                    self.make_compact()
+                    self.timings['compact'] = time.time() - t0
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        ##########################################
+        ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
+        ##########################################
+
+    def list_files(self, root):
+        """
+        param:  "root": directorio con las noticias
 
+        return: lista de ficheros .json de "root" y sus subdirectorios, en el orden de indexacion
+        """
+        filenames = []
         for dir, subdirs, files in os.walk(root):
             for filename in files:
                 if filename.endswith('.json'):
                     fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+                    filenames.append(fullname)
+        return filenames
+
+    def index_parallel(self, filenames, pool, jobs):
+        """
+        Indexa los ficheros repartidos entre los procesos de "pool".
+
+        Cada proceso indexa un bloque de ficheros consecutivos en un indice parcial con sus propios
+        docid y newid (desde 0), y los indices parciales se mezclan en orden con self.merge_index,
+        de forma que el resultado es identico al de indexar los ficheros uno a uno.
+
+        param:  "filenames": lista de ficheros en el orden de indexacion
+                "pool": multiprocessing.Pool
+                "jobs": numero de procesos
+        """
+        # Several blocks per process to keep all of them busy until the end
+        size = max(1, math.ceil(len(filenames) / (jobs * 4)))
+        blocks = [(self.multifield, self.positional, filenames[i:i + size])
+                  for i in range(0, len(filenames), size)]
+        for partial in pool.imap(index_files, blocks):
+            self.merge_index(*partial)
+
+    def merge_index(self, index, docs, news, tokens, stamps, weight):
+        """
+        Añade al final del indice un indice parcial, desplazando sus docid y newid.
+
+        param:  "index": indice invertido parcial (campo --> termino --> posting list en forma de diccionario)
+                "docs": tabla de ficheros parcial, docid parcial --> ruta del fichero
+                "news": tabla de noticias parcial, newid parcial --> [docid parcial, posicion en el fichero, ...]
+                "tokens": numero de tokens indexados
+                "stamps": docid parcial --> (tamaño, fecha de modificacion) del fichero
+                "weight": longitudes de las noticias, ver self.weight
+        """
+        self.clear_caches()
+        doc_offset = self.docid
+        news_offset = self.news_counter
+        for docid in docs.keys():
+            self.docs.append(docs[docid])
+            self.stamps[docid + doc_offset] = stamps[docid]
+        for new in news.keys():
+            entry = news[new]
+            self.news.append([entry[0] + doc_offset] + entry[1:])
+        for field in index:
+            for token, postings in index[field].items():
+                postings = {new + news_offset: value for new, value in postings.items()}
+                current = self.index[field].get(token)
+                if isinstance(current, Posting):
+                    current.extend(Posting.from_dict(postings))
+                    # The tables of a segment decode a new Posting on every access (see self.update_dir)
+                    self.index[field][token] = current
+                elif current is not None:
+                    current.update(postings)
+                else:
+                    self.index[field][token] = postings
+        for field, lengths in weight['length'].items():
+            # Indexes without the lengths of their news (older versions) keep ranking with TF-IDF
+            if len(self.weight['length'].get(field, ())) != news_offset:
+                continue
+            self.weight['length'].setdefault(field, array('i')).extend(lengths)
+            self.weight['total'][field] = self.weight['total'].get(field, 0) + weight['total'][field]
+        self.docid += len(docs)
+        self.news_counter += len(news)
+        self.tokens += tokens
+
+    def update_dir(self, root):
+        """
+        Actualiza el indice con los cambios del directorio "root" desde que se indexo, sin reindexar
+        toda la coleccion:
+          - los ficheros nuevos se indexan en un indice parcial que se añade al final con self.merge_index,
+          - los ficheros que ya no estan se marcan como borrados (self.delete_docs),
+          - los modificados (distinto tamaño o fecha) se borran y se indexan de nuevo como ficheros nuevos.
+        Solo los terminos nuevos se añaden a los indices de stems y permuterms (con Permuterms.add_terms,
+        que solo calcula las rotaciones de los terminos nuevos). Las noticias borradas
+        siguen en las posting lists, filtradas en self.solve_query, hasta compactar con self.purge.
+        En un indice abierto desde un segmento las posting lists se quedan en el segmento: solo se
+        decodifican las de los terminos de los ficheros nuevos y, al guardar, las demas se copian
+        (ver self.materialize y SAR_segment.UpdatedTable).
+
+        param:  "root": directorio indexado (las rutas se comparan tal cual, debe indicarse igual que al indexar)
+
+        return: tupla (ficheros nuevos, modificados, borrados)
+        """
+        t0 = time.time()
+        self.materialize(postings=False)
+        live = {self.docs[docid]: docid for docid in self.docs if docid not in self.deleted_docs}
+        added = []
+        changed = []
+        for fullname in self.list_files(root):
+            docid = live.pop(fullname, None)
+            if docid is None:
+                added.append(fullname)
+            elif self.stamps.get(docid, file_stamp(fullname)) != file_stamp(fullname):
+                changed.append(docid)
+        self.delete_docs(changed + list(live.values()))
+
+        partial = index_files((self.multifield, self.positional, added + [self.docs[docid] for docid in changed]))
+        new_tokens = {field: [token for token in partial[0][field] if token not in self.index[field]]
+                      for field in self.index}
+        self.merge_index(*partial)
+        if self.stemming:
+            # The stems of the new terms, and with stem postings those of all the terms of the new files
+            self.stem_terms(token for field in self.index
+                            for token in (partial[0][field] if self.stem_postings else new_tokens[field]))
+        for field, vocabulary in new_tokens.items():
+            if vocabulary and (self.stemming or self.permuterm):
+                # The ids of both tables are shifted once in the merged lexicon of the field
+                vocabulary.sort()
+                old = self.sindex[field] if self.stemming else self.ptindex[field]
+                merged = merge_lexicon(old.terms, vocabulary)
+                if self.stemming:
+                    self.sindex[field] = self.sindex[field].add_terms(vocabulary, self.stem_cache, merged)
+                if self.permuterm:
+                    self.ptindex[field] = self.ptindex[field].add_terms(vocabulary, merged)
+            if self.stem_postings:
+                # Only the stems of the terms of the new files have new postings
+                self.make_stem_postings(field, {self.stem_cache[token] for token in partial[0][field]})
+        if self.compact:
+            self.make_compact()
+        self.timings['updating'] = time.time() - t0
+        return len(added), len(changed), len(live)
+
+    def delete_docs(self, docids):
+        """
+        Marca como borradas las noticias de unos ficheros.
+
+        Las noticias de un fichero tienen newid consecutivos, se localizan con una busqueda binaria
+        sobre la columna de docid de self.news (ordenada).
 
+        param:  "docids": docid de los ficheros a borrar
+        """
+        self.clear_caches()
+        removed = array('i')
+        for docid in sorted(docids):
+            first = bisect_left(self.news.docids, docid)
+            last = bisect_left(self.news.docids, docid + 1, first)
+            removed.extend(range(first, last))
+            self.deleted_docs.add(docid)
+        for field, lengths in self.weight['length'].items():
+            self.weight['total'][field] -= sum(lengths[new] for new in removed)
+        self.deleted = self.or_posting(self.deleted, removed)
+
+    def purge(self):
+        """
+        Compacta el indice eliminando las noticias y ficheros borrados: se renumeran los newid y docid
+        de forma consecutiva, se quitan de las posting lists y se eliminan los terminos que se quedan
+        sin noticias (tambien de los indices de stems y permuterms, que se rehacen).
+        """
+        self.materialize()
+        if not len(self.deleted) and not self.deleted_docs:
+            return
+        t0 = time.time()
+        self.clear_caches()
+        deleted = set(self.deleted)
+        doc_ids = {}
+        docs = PathTable()
+        stamps = {}
+        for docid in self.docs:
+            if docid not in self.deleted_docs:
+                doc_ids[docid] = len(docs)
+                docs.append(self.docs[docid])
+                if docid in self.stamps:
+                    stamps[doc_ids[docid]] = self.stamps[docid]
+        news_ids = {}
+        news = NewsTable([array('i') for _ in self.news.columns])
+        for new in range(self.news_counter):
+            if new not in deleted:
+                news_ids[new] = len(news)
+                entry = self.news[new]
+                news.append([doc_ids[entry[0]]] + entry[1:])
+
+        self.tokens = 0
+        for field in self.index:
+            index = {}
+            for token, postings in self.index[field].items():
+                kept = {news_ids[new]: value for new, value in postings.items() if new in news_ids}
+                if kept:
+                    index[token] = Posting.from_dict(kept) if isinstance(postings, Posting) else kept
+                    self.tokens += sum(value if isinstance(value, int) else len(value) for value in kept.values())
+            self.index[field] = index
+
+        for field, lengths in self.weight['length'].items():
+            self.weight['length'][field] = array('i', [lengths[new] for new in news_ids])
+        self.docs = docs
+        self.stamps = stamps
+        self.news = news
+        self.docid = len(docs)
+        self.news_counter = len(news)
+        self.deleted = array('i')
+        self.deleted_docs = set()
         if self.stemming:
             self.make_stemming()
-
+        if self.stem_postings:
+            self.spindex = {field: {} for field in self.spindex}
+            self.make_stem_postings()
         if self.permuterm:
             self.make_permuterm()
-        ##########################################
-        ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
-        ##########################################
+        if self.compact:
+            self.make_compact()
+        self.timings['purging'] = time.time() - t0
+
+    def index_blocks(self, filenames):
+        """
+        Indexacion por bloques (SPIMI) con un limite de memoria de self.memory MB.
+
+        Los ficheros se indexan en memoria hasta que el bloque alcanza el limite (estimado con el
+        numero de tokens del bloque), entonces se vuelca a un fichero temporal ordenado por campo y
+        termino y se empieza un bloque nuevo. Si se llega a volcar algun bloque, self.merge_blocks
+        los mezcla al guardar el indice directamente en el segmento.
+
+        param:  "filenames": lista de ficheros en el orden de indexacion
+        """
+        token_bytes = self.BLOCK_POSITIONAL_TOKEN_BYTES if self.positional else self.BLOCK_TOKEN_BYTES
+        max_tokens = self.memory * 2 ** 20 // token_bytes
+        block_start = self.tokens
+        self.timings['writing blocks'] = 0
+        for fullname in filenames:
+            self.index_file(fullname)
+            if self.tokens - block_start >= max_tokens:
+                self.write_block()
+                block_start = self.tokens
+        if self.runs and self.tokens > block_start:
+            self.write_block()
+
+    def write_block(self):
+        """
+        Vuelca el bloque en memoria (self.index) a un fichero temporal y lo vacia.
+
+        El fichero contiene tuplas (campo, termino, Posting) ordenadas por campo y termino.
+        """
+        t0 = time.time()
+        run = tempfile.TemporaryFile()
+        for field in sorted(self.index):
+            for token in sorted(self.index[field]):
+                pickle.dump((field, token, Posting.from_dict(self.index[field][token])), run)
+            self.index[field] = {}
+        run.seek(0)
+        self.runs.append(run)
+        self.timings['writing blocks'] += time.time() - t0
+
+    def merge_blocks(self, filename):
+        """
+        Mezcla los bloques volcados por self.write_block y escribe el segmento "filename".
+
+        La mezcla es una k-way merge de los bloques (ordenados por campo y termino) cuyo resultado
+        se escribe directamente en el segmento: en memoria solo estan la posting list del termino
+        que se esta mezclando y el vocabulario, necesario para los stems y los permuterms.
+        Al terminar el indice queda asociado al segmento escrito.
+
+        param:  "filename": fichero de salida
+        """
+        t0 = time.time()
+        writer = SegmentWriter(filename, self.news_counter, self.bitmap_threshold, self.weight['length'])
+        vocabulary = {field: [] for field in self.index}
+        entries = heapq.merge(*(read_block(run) for run in self.runs), key=lambda entry: entry[:2])
+        # Blocks hold increasing newids and heapq.merge keeps their order for equal terms
+        for (field, token), group in groupby(entries, key=lambda entry: entry[:2]):
+            posting = next(group)[2]
+            for entry in group:
+                posting.extend(entry[2])
+            writer.add_posting(field, token, posting)
+            vocabulary[field].append(token)
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.timings['merging blocks'] = time.time() - t0
+
+        # One field at a time, so only one permuterm table is in memory
+        t0 = time.time()
+        writer.end_postings()
+        if self.stemming:
+            self.stem_terms(token for tokens in vocabulary.values() for token in tokens)
+        for field, tokens in vocabulary.items():
+            if self.stemming:
+                writer.add_stems(field, Stems.from_terms(tokens, self.stem_cache))
+            if self.permuterm:
+                writer.add_permuterms(field, Permuterms.from_terms(tokens))
+        del vocabulary
+        self.timings['stems and permuterms'] = time.time() - t0
+
+        t0 = time.time()
+        finish_segment(writer, self)
+        self.use_segment(Segment(filename))
+        self.timings['writing tables'] = time.time() - t0
 
     def index_file(self, filename):
         """
@@ -191,9 +820,10 @@ class SAR_Project:
 
         """
 
-        with open(filename) as fh:
-            jlist = json.load(fh)
-            self.docs[self.docid] = filename
+        with open(filename, 'rb') as fh:
+            jlist = split_news(fh.read())
+            self.docs.append(filename)
+            self.stamps[self.docid] = file_stamp(filename)
 
         # "jlist" es una lista con tantos elementos como noticias hay en el fichero,
         # cada noticia es un diccionario con los campos:
@@ -210,47 +840,31 @@ class SAR_Project:
         else:
             multifield = ['article', 'date']
 
-        for news in jlist:
-            self.news[self.news_counter] = [self.docid, myCounter]
+        for news, offset, length in jlist:
+            self.news.append([self.docid, myCounter, offset, length])
 
             for field in multifield:
-                position = 0
                 if field != 'date':
                     content = self.tokenize(news[field])
+                    self.weight['length'].setdefault(field, array('i')).append(len(content))
+                    self.weight['total'][field] = self.weight['total'].get(field, 0) + len(content)
                 else:
                     content = [news[field]]
-                # Indexing by posting lists
+                self.tokens += len(content)
+                # The occurrences of the news are grouped first, each posting list is updated once per term
                 if self.positional:
-                    for token in content:
-                        # Checking if token does not exist in any news
-                        if token not in self.index[field]:
-                            self.index[field].update(
-                                {token: {self.news_counter: [position]}})
-                        # Checking if the current news is not in the token dictionary
-                        elif self.news_counter not in self.index[field][token]:
-                            self.index[field][token].update(
-                                {self.news_counter: [position]})
-                        # Appending the token position to the posting list
-                        else:
-                            self.index[field][token][self.news_counter].append(
-                                position)
-                        position += 1
-                        self.tokens += 1
-                # Indexing by number of occurrences
+                    values = {}
+                    for position, token in enumerate(content):
+                        values.setdefault(token, []).append(position)
                 else:
-                    for token in content:
-                        # Checking if token does not exist in any news
-                        if token not in self.index[field]:
-                            self.index[field].update(
-                                {token: {self.news_counter: 1}})
-                        # Checking if the current news is not in the token dictionary
-                        elif self.news_counter not in self.index[field][token]:
-                            self.index[field][token].update(
-                                {self.news_counter: 1})
-                        # Adding 1 to the number of occurrence of that token in that new
-                        else:
-                            self.index[field][token][self.news_counter] += 1
-                        self.tokens += 1
+                    values = Counter(content)
+                index = self.index[field]
+                for token, value in values.items():
+                    postings = index.get(token)
+                    if postings is None:
+                        index[token] = {self.news_counter: value}
+                    else:
+                        postings[self.news_counter] = value
 
             self.news_counter += 1
             myCounter += 1
@@ -264,60 +878,163 @@ class SAR_Project:
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
         Puedes utilizar la expresion regular 'self.tokenizer'.
 
+        Los tokens son las secuencias de caracteres alfanumericos, se extraen en una sola pasada.
+
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.tokenizer.findall(text.lower())
 
-    def make_stemming(self):
+    def make_stemming(self, pool=None):
         """
         NECESARIO PARA LA AMPLIACION DE STEMMING.
 
         Crea el indice de stemming (self.sindex) para los terminos de todos los indices.
 
-        self.stemmer.stem(token) devuelve el stem del token
+        self.stemmer.stem(token) devuelve el stem del token, cada termino distinto se procesa una
+        sola vez aunque este en varios campos (ver self.stem_terms).
+
+        param:  "pool": multiprocessing.Pool opcional para calcular los stems en paralelo
         """
+        vocabulary = set().union(*self.index.values())
+        # Terms no longer in the index (see self.purge) are removed from the cache
+        self.stem_cache = {term: stem for term, stem in self.stem_cache.items() if term in vocabulary}
+        self.stem_terms(vocabulary, pool)
         for field in self.index:
-            for token in self.index[field]:
-                token_s = self.stemmer.stem(token)
-                # Creating for each token its list of stems
-                if token_s not in self.sindex[field]:
-                    self.sindex[field].update({token_s: [token]})
-                else:
-                    self.sindex[field][token_s].append(token)
+            self.sindex[field] = Stems.from_terms(sorted(self.index[field]), self.stem_cache)
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
-    def make_permuterm(self):
+    def stem_terms(self, terms, pool=None):
+        """
+        Añade a self.stem_cache los stems de los terminos que no esten ya.
+
+        param:  "terms": iterable de terminos, puede tener repetidos
+                "pool": multiprocessing.Pool opcional, con muchos terminos nuevos se reparten
+                        en tareas de self.STEM_CHUNK terminos
+        """
+        missing = [term for term in dict.fromkeys(terms) if term not in self.stem_cache]
+        if pool is not None and len(missing) > self.STEM_CHUNK:
+            chunks = [missing[i:i + self.STEM_CHUNK] for i in range(0, len(missing), self.STEM_CHUNK)]
+            stems = [stem for chunk in pool.map(token_stems, chunks) for stem in chunk]
+        else:
+            stems = token_stems(missing)
+        # Equal stems share a single string (the pool returns a copy for every term)
+        shared = {}
+        self.stem_cache.update((term, shared.setdefault(stem, stem)) for term, stem in zip(missing, stems))
+
+    def stem(self, term):
+        """
+        Stem de un termino de una consulta: los de los terminos del indice estan en self.stem_cache
+        o, en un indice abierto desde un segmento, en sus tablas de stems (self.stored_stem); el
+        resto se calcula y se guarda en la cache (hasta self.QUERY_STEMS terminos).
+
+        param:  "term": termino
+
+        return: stem del termino
+        """
+        stem = self.stem_cache.get(term)
+        if stem is None:
+            stem = self.stored_stem(term) if self.stem_ids else None
+            if stem is None:
+                stem = self.stemmer.stem(term)
+            if self.query_stems < self.QUERY_STEMS:
+                self.stem_cache[term] = stem
+                self.query_stems += 1
+        return stem
+
+    def stored_stem(self, term):
+        """
+        Busca el stem de un termino en las tablas de un segmento: el id del termino en el lexico
+        de un campo (una busqueda binaria en la tabla de terminos) da el id de su stem.
+
+        param:  "term": termino
+
+        return: stem del termino, None si no esta en el indice
+        """
+        for field, stem_ids in self.stem_ids.items():
+            term_id = self.index[field].find(term)
+            if 0 <= term_id < len(stem_ids) and stem_ids[term_id] >= 0:
+                return self.sindex[field].key(stem_ids[term_id])
+        return None
+
+    def make_stem_postings(self, field=None, stems=None):
+        """
+        Precalcula las posting lists de los stems (self.spindex): la de un stem es la union de las de
+        sus terminos, con la suma de sus frecuencias, y asi una busqueda con stemming es un solo acceso.
+        Los stems de un solo termino no se guardan, se usa la posting list del termino.
+
+        param:  "field": campo a procesar, None para todos
+                "stems": stems a recalcular, por defecto todos los de self.sindex[field]
+        """
+        for name in ([field] if field else self.index):
+            for stem in (self.sindex[name] if stems is None else stems):
+                terms = self.sindex[name].get(stem, [])
+                if len(terms) > 1:
+                    self.spindex[name][stem] = stem_posting([self.index[name][term] for term in terms])
+
+    def stem_postings_size(self):
+        """
+        return: tupla (numero de posting lists de stems, numero de postings de los stems,
+                numero de postings de los terminos) de todos los campos
+        """
+        def count(table):
+            # Tables of a segment take the number of postings of each term from its record
+            if isinstance(table, UpdatedTable):
+                return table.postings_count()
+            return sum(len(postings) for postings in table.values())
+
+        lists = sum(len(self.spindex[field]) for field in self.spindex)
+        stems = sum(count(self.spindex[field]) for field in self.spindex)
+        terms = sum(count(self.index[field]) for field in self.index)
+        return lists, stems, terms
+
+    def make_permuterm(self, pool=None):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
 
         Crea el indice permuterm (self.ptindex) para los terminos de todos los indices.
 
+        param:  "pool": multiprocessing.Pool opcional para procesar los campos en paralelo
         """
-        for field in self.index:
-            # Creating the  permuterm list of a token
-            for token in self.index[field]:
-                token_p = token + '$'
-                permuterm = []
-                for _ in range(len(token_p)):
-                    token_p = token_p[1:] + token_p[0]
-                    permuterm += [token_p]
-                # Each element of the list permuterm is added to self.ptindex
-                for term in permuterm:
-                    if term not in self.ptindex[field]:
-                        self.ptindex[field].update({term: [token]})
-                    else:
-                        self.ptindex[field][term].append(token)
+        fields = list(self.index)
+        # With stemming the stems have just been made (see self.index_dir), their lexicon is shared
+        tokens = [self.sindex[field].terms if isinstance(self.sindex[field], Stems) else sorted(self.index[field])
+                  for field in fields]
+        for field, terms, rotations in zip(fields, tokens, (pool.map if pool else map)(permuterm_rotations, tokens)):
+            self.ptindex[field] = Permuterms(terms, rotations)
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
+    def make_compact(self):
+        """
+        Convierte las posting lists de todos los indices (diccionarios newid --> frecuencia o posiciones)
+        en objetos Posting: arrays ordenados de newid y frecuencias (y posiciones si el indice es posicional).
+
+        Se llama al terminar la indexacion y tras cada actualizacion (solo se convierten las posting
+        lists nuevas), las consultas usan los arrays directamente.
+        Las posting lists de los terminos densos (self.bitmap_threshold) se guardan ademas como Bitmap
+        y todas tienen sus maximos por bloques para el ranking (ver block_maxima).
+        """
+        for field in self.index:
+            lengths = self.weight['length'].get(field)
+            for table in (self.index[field], self.spindex[field]):
+                # Tables of a segment only have in memory the posting lists changed by an update
+                entries = table.changed if isinstance(table, UpdatedTable) else table
+                for token, postings in entries.items():
+                    posting = postings if isinstance(postings, Posting) else Posting.from_dict(postings)
+                    if posting.bitmap is None and is_dense(len(posting), self.news_counter, self.bitmap_threshold):
+                        posting.bitmap = Bitmap.from_sorted(posting.docids)
+                    if posting.maxima is None:
+                        posting.maxima = block_maxima(posting.docids, posting.freqs, lengths)
+                    table[token] = posting
+
     def show_stats(self):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -328,8 +1045,11 @@ class SAR_Project:
         print('========================================')
         print('Number of indexed days:', len(self.index['date']))
         print('----------------------------------------')
-        print('Number of indexed news: ', self.news_counter)
+        print('Number of indexed news: ', self.news_counter - len(self.deleted))
         print('----------------------------------------')
+        if len(self.deleted):
+            print('Number of deleted news: ', len(self.deleted))
+            print('----------------------------------------')
         print('TOKENS:')
         if self.multifield:
             for field in self.index:
@@ -394,191 +1114,77 @@ class SAR_Project:
         return: posting list con el resultado de la query
 
         """
-        operators = ["NOT", "OR", "AND"]
-        j = 0
         if query is None or len(query) == 0:
             return []
 
-        if type(query) == list:
-            q = query
-        # Adding format to process it properly
-        else:
-            query = query.replace('(', ' (%')
-            query = query.replace(')', ' %) ')
-            query = query.replace('AND', '%AND%')
-            query = query.replace('OR', '%OR%')
-            query = query.replace('NOT', 'NOT%')
-            q = query.split("%")
-            # For positional searches with multifield
-            while j < len(q):
-                q[j] = q[j].strip()
-                if q[j] not in operators:
-                    q[j] = q[j].lower()
-                    if ' ' in q[j]:
-                        term = list(q[j])
-                        k = 0
-                        contador = False
-                        while k < len(term):
-                            if '"' in term[k]:
-                                contador = not contador
-                            elif contador:
-                                if term[k] == " ":
-                                    term[k] = '%'
-                            k += 1
-                        term = ''.join(term)
-                        term = term.split()
-                        i = 0
-                        for i in range(len(term)):
-                            term[i] = term[i].replace('%', ' ')
-                        i = 1
-                        while i < len(term):
-                            term.insert(i, 'AND')
-                            i += 2
-                        q[j] = term
-                j += 1
-            sorted = []
-            # Flattening lists
-            for sublist in q:
-                if not isinstance(sublist, str):
-                    for item in sublist:
-                        sorted.append(item)
-                else:
-                    sorted.append(sublist)
-            q = sorted
+        # The parser builds the query tree and the planner decides how to evaluate it (see SAR_query)
+        plan = plan_query(parse_query(query), self.resolve, len(self.news))
+        if self.show_plan:
+            print(explain(plan))
+        res = self.execute(plan)
+        # Deleted news stay in the posting lists until the index is purged
+        if len(self.deleted):
+            res = self.minus_posting(res, self.deleted)
+        return res
 
-        # Solving basic queries of length <= 2, like 'NOT isla' or 'isla'
-        if len(q) <= 2:
-            return self.mini_query(q)
+        ########################################
+        ## COMPLETAR PARA TODAS LAS VERSIONES ##
+        ########################################
 
-        flag = True
-        i = 0
-        opened = 0
-        first = True
-        i0 = 0
-        found = False
-        q_length = len(q)
-
-        # Processing the query parentheses recursively
-        if "(" in q and ")" in q:
-            aux = []
-            while i < q_length:
-                if q[i] == ("("):
-                    opened += 1
-                    found = True
-                if first and found:
-                    i0 = i
-                    first = False
-                if q[i] == (")"):
-                    opened -= 1
-                if opened == 0 and found:
-                    subquery = q[i0+1:i]
-                    prevquery = q[0:i0]
-                    if not (i == q_length - 1):
-                        restquery = q[i+1:q_length]
-                        if i0 == 0:
-                            aux = [list(self.solve_query(subquery))
-                                   ] + restquery
-                            return self.solve_query(aux)
-                        else:
-                            aux = prevquery + \
-                                [list(self.solve_query(subquery))] + restquery
-                            return self.solve_query(aux)
-                    else:
-                        if i0 == 0:
-                            return self.solve_query(subquery)
-                        else:
-                            aux = prevquery + \
-                                [list(self.solve_query(subquery))]
-                            return self.solve_query(aux)
-                i += 1
-        else:
-            # Resolving the query without parentheses iteratively
-            j = 0
-            negative = False
-            while j in range(q_length):
-                following = 0
-                terms = []
-                if q[j] in operators:
-                    flag = True
-                    if q[j] == "NOT":
-                        negative = True
-                else:
-                    while (j + following) < len(q) and q[j + following] not in operators:
-                        terms.append(q[j + following])
-                        following += 1
-                    if len(terms) > 1:
-                        q[j + following - 1] = self.get_positionals(terms)
-                        if not (following == q_length):
-                            aux = [q[0:j], q[j + following - 1:]]
-                            q = sum(aux, [])
-                            q_length = len(q)
-                            flag = False
-                            j = 0
-                        else:
-                            return q[j + following - 1]
-                    elif (flag and j > 1) or (negative and q_length < 3):
-                        q1 = self.mini_query(q[0:j+1])
-                        if not (j + 1 == q_length):
-                            aux = [[q1], q[j+1:]]
-                            q = sum(aux, [])
-                            q_length = len(q)
-                            flag = False
-                            j = 0
-                        else:
-                            return q1
-                j += 1
+    def resolve(self, node):
+        """
+        Devuelve la posting list de una hoja del arbol de consulta.
 
-            ########################################
-            ## COMPLETAR PARA TODAS LAS VERSIONES ##
-            ########################################
+        param:  "node": Term, Phrase o Near
 
-    def mini_query(self, query):
+        return: posting list
         """
-        param: "query": lista con la query
-        return: posting list con el resultado de la query
+        # Stemming changes the posting list of the terms
+        key = (str(node), self.use_stemming)
+        res = self.cache_get(key)
+        if res is not None:
+            return res
+        if isinstance(node, Phrase):
+            res = self.get_positionals(node.terms, node.field)
+        elif isinstance(node, Near):
+            res = self.get_near(node.terms, node.distance, node.field)
+        else:
+            res = self.get_posting(node.text, node.field)
+        self.cache_put(key, res)
+        return res
+
+    def execute(self, plan):
         """
+        Ejecuta un plan construido por SAR_query.plan_query.
 
-        queries = ["AND", "OR", "NOT"]
-        i = 0
-        # Checking if we have any str in the query and getting its posting list
-        while i < len(query):
-            if query[i] not in queries:
-                if isinstance(query[i], str):
-                    if ":" in query[i]:
-                        query[i] = query[i].split(":")
-                        query[i] = self.get_posting(query[i][1], query[i][0])
-                    else:
-                        query[i] = self.get_posting(query[i])
-            i += 1
-        # Calculating each query with AND operators
-        if "AND" in query:
-            if "NOT" in query:
-                pos = query.index("NOT")
-                if query[0] == "NOT" and query[3] == "NOT":
-                    return self.reverse_posting(self.or_posting(query[1], query[4]))
-                elif pos == 0:
-                    return self.minus_posting(query[3], query[1])
-                elif pos == 2:
-                    return self.minus_posting(query[0], query[3])
-            else:
-                return self.and_posting(query[0], query[2])
-        # Calculating each query with OR operators
-        elif "OR" in query:
-            if "NOT" in query:
-                pos = query.index("NOT")
-                if query[0] == "NOT" and query[3] == "NOT":
-                    return self.reverse_posting(self.and_posting(query[1], query[4]))
-                elif pos == 2:
-                    return self.reverse_posting(self.minus_posting(query[3], query[0]))
-                elif pos == 0:
-                    return self.reverse_posting(self.minus_posting(query[1], query[3]))
-            else:
-                return self.or_posting(query[0], query[2])
+        Los resultados de las hojas (ver self.resolve) y de los nodos intermedios se guardan en la
+        cache de consultas con la clave del nodo, asi se reutilizan en las consultas que comparten
+        subconsultas.
+
+        param:  "plan": nodo del plan (Leaf, Intersect, Union, Difference, Complement)
+
+        return: posting list con el resultado del plan
+        """
+        if isinstance(plan, Leaf):
+            return plan.posting
+        key = (plan.key, self.use_stemming)
+        res = self.cache_get(key)
+        if res is not None:
+            return res
+
+        if isinstance(plan, Complement):
+            res = self.reverse_posting(self.execute(plan.children[0]))
+        elif isinstance(plan, Difference):
+            res = self.minus_posting(self.execute(plan.children[0]), self.execute(plan.children[1]))
+        elif isinstance(plan, Union):
+            res = self.multi_or_posting([self.execute(child) for child in plan.children])
         else:
-            if query[0] == "NOT":
-                return self.reverse_posting(query[1])
-            else:
-                return query[0]
+            # Operands are already ordered by the planner, smallest first
+            res = self.execute(plan.children[0])
+            for child in plan.children[1:]:
+                res = self.and_posting(res, self.execute(child))
+        self.cache_put(key, res)
+        return res
 
     def get_posting(self, term, field='article'):
         """
@@ -610,7 +1216,7 @@ class SAR_Project:
             if self.use_stemming:
                 res = self.get_stemming(term, field)
             elif term in self.index[field]:
-                res = list(self.index[field][term].keys())
+                res = self.get_docids(term, field)
 
         return res
 
@@ -618,6 +1224,22 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def get_docids(self, token, field='article'):
+        """
+        Devuelve los newid de la posting list de un token que esta en el indice.
+        Con el indice compacto se devuelve el array ordenado del indice, sin copiarlo,
+        o su Bitmap si el termino es denso.
+
+        param:  "token": token presente en self.index[field]
+                "field": campo del indice
+
+        return: posting list (no se debe modificar)
+        """
+        postings = self.index[field][token]
+        if isinstance(postings, Posting):
+            return postings.ids()
+        return list(postings.keys())
+
     def get_positionals(self, terms, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE POSICIONALES
@@ -630,30 +1252,55 @@ class SAR_Project:
         return: posting list
 
         """
-        res = []
-        if terms[0] in self.index[field]:
-            for post in self.index[field][terms[0]].items():
-                new, list_pos = post
-                for position in list_pos:
-                    continuation = True
-                    for term in terms[1:]:
-                        if continuation and term in self.index[field] and new in self.index[field][term] \
-                                and position + 1 in self.index[field][term][new]:
-                            position += 1
-                        else:
-                            continuation = False
-                    if continuation:
-                        res += [new]
-
-        # Return of the news without the repeated ones
-        res = list(dict.fromkeys(res))
-        res.sort()
-        return res
+        return self.match_positions(terms, field, phrase_match)
 
         ########################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE POSICIONALES ##
         ########################################################
 
+    def get_near(self, terms, distance, field='article'):
+        """
+        Devuelve la posting list de las noticias en las que los terminos aparecen a "distance"
+        palabras o menos unos de otros, en cualquier orden (operador NEAR/k).
+
+        param:  "terms": lista de terminos
+                "distance": distancia maxima entre la primera y la ultima posicion de los terminos
+                "field": campo sobre el que se debe recuperar la posting list
+
+        return: posting list
+        """
+        # A repeated term needs as many distinct positions as times it appears
+        counts = Counter(terms)
+        return self.match_positions(list(counts), field,
+                                    lambda positions: near_match(positions, distance, list(counts.values())))
+
+    def match_positions(self, terms, field, match):
+        """
+        Busca las noticias que contienen todos los terminos y cuyas listas de posiciones cumplen "match".
+
+        Primero se intersecan las noticias de los terminos, del menos al mas frecuente, de modo que
+        solo se leen las posiciones de las noticias en las que aparecen todos.
+
+        param:  "terms": lista de terminos
+                "field": campo del indice
+                "match": funcion que recibe la lista de posiciones (ordenadas) de cada termino
+                         en una noticia y devuelve True si la noticia cumple la condicion
+
+        return: posting list ordenada
+        """
+        if not self.positional:
+            raise ValueError('the index is not positional')
+        # Looking up every posting list once
+        postings = [self.index[field].get(term) for term in terms]
+        if any(posting is None for posting in postings):
+            return array('i')
+        rarest = sorted(postings, key=len)
+        candidates = sorted(rarest[0]) if isinstance(rarest[0], dict) else rarest[0].docids
+        for posting in rarest[1:]:
+            # Membership is a hash lookup for dictionaries and a bisection for Posting
+            candidates = [new for new in candidates if new in posting]
+        return array('i', [new for new in candidates if match([posting[new] for posting in postings])])
+
     def get_stemming(self, term, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE STEMMING
@@ -667,16 +1314,13 @@ class SAR_Project:
 
         """
 
-        stem = self.stemmer.stem(term)
-        res = []
-
-        # Getting all the tokens of the stem and searching its posting lists
-        if stem in self.sindex[field]:
-            for token in self.sindex[field][stem]:
-                res = self.or_posting(
-                    res, list(self.index[field][token].keys()))
+        # Precomputed stems are a single lookup
+        postings = self.spindex[field].get(self.stem(term))
+        if postings is not None:
+            return postings.ids() if isinstance(postings, Posting) else list(postings.keys())
 
-        return res
+        # Getting all the tokens of the stem and merging their posting lists at once
+        return self.multi_or_posting([self.get_docids(token, field) for token in self.stem_matches(term, field)])
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
@@ -693,6 +1337,31 @@ class SAR_Project:
 
         return: posting list
 
+        """
+        tokens = dict.fromkeys(self.wildcard_matches(term, field))
+        return self.multi_or_posting([self.get_docids(token, field) for token in tokens])
+
+        ##################################################
+        ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
+        ##################################################
+
+    def stem_matches(self, term, field='article'):
+        """
+        param:  "term": termino de la consulta
+                "field": campo del indice
+
+        return: lista de terminos del indice con el mismo stem que "term"
+        """
+        return self.sindex[field].get(self.stem(term), [])
+
+    def wildcard_matches(self, term, field='article'):
+        """
+        Busca en el indice permuterm los terminos que encajan con un termino con comodin.
+
+        param:  "term": termino con un comodin (* o ?)
+                "field": campo del indice
+
+        return: lista de terminos del indice (puede tener repetidos)
         """
         # Creating the wildcard query
         res = []
@@ -705,17 +1374,27 @@ class SAR_Project:
         term = term[:-1]
 
         # For the wildcard "?" we get all the permuterms that start with the term and have the same length.
-        for permuterm in list(self.ptindex[field].keys()):
-            if permuterm.startswith(term) and (wildcard == '*' or len(permuterm) == len(term) + 1):
-                for token in self.ptindex[field][permuterm]:
-                    res = self.or_posting(
-                        res, list(self.index[field][token].keys()))
+        for permuterm, tokens in self.permuterm_items(term, field):
+            if wildcard == '*' or len(permuterm) == len(term) + 1:
+                res.extend(tokens)
 
         return res
 
-        ##################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
-        ##################################################
+    def permuterm_items(self, prefix, field='article'):
+        """
+        Permuterms que empiezan por "prefix": dos busquedas binarias sobre los permuterms
+        ordenados y el recorrido del rango entre ellas.
+
+        param:  "prefix": prefijo (permuterm del termino sin el comodin)
+                "field": campo del indice
+
+        return: lista de pares (permuterm, lista de terminos) en orden
+        """
+        ptindex = self.ptindex[field]
+        # Indexes built without permuterms keep an empty dictionary per field
+        if not self.permuterm or isinstance(ptindex, dict):
+            return []
+        return list(ptindex.prefix_items(prefix))
 
     def reverse_posting(self, p):
         """
@@ -732,9 +1411,14 @@ class SAR_Project:
 
         """
 
-        # Obtaining list of all news
-        answer = list(self.news.keys())
-        return self.minus_posting(answer, p)
+        # With bitmaps the complement is computed word by word, without listing all the news
+        if self.bitmap_threshold is not None and not isinstance(p, Bitmap):
+            p = Bitmap.from_sorted(p)
+        if isinstance(p, Bitmap):
+            return p.complement(len(self.news))
+
+        # All the news are the range 0..N-1, only the gaps between the newids of p are listed
+        return complement_ids(p, len(self.news))
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
@@ -751,7 +1435,10 @@ class SAR_Project:
         return: posting list con los newid incluidos en p1 y p2
 
         """
-        res = []
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return bitmap_and(p1, p2)
+
+        res = array('i')
         i = 0
         j = 0
         long_p1 = len(p1)
@@ -793,7 +1480,10 @@ class SAR_Project:
         return: posting list con los newid incluidos de p1 o p2
 
         """
-        answer = []
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return bitmap_or(p1, p2)
+
+        answer = array('i')
         i = 0
         j = 0
 
@@ -823,6 +1513,38 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def multi_or_posting(self, postings):
+        """
+        Calcula el OR de varias posting lists a la vez (expansiones de stems y comodines, OR de la consulta).
+
+        Si las listas son pocas respecto a la coleccion se mezclan con un heap (k-way merge), si no se
+        marcan sus newid en un bytearray con una posicion por noticia que se recorre al final. Los
+        Bitmap se unen entre si palabra a palabra.
+
+        param:  "postings": lista de posting lists
+
+        return: posting list con los newid incluidos en alguna de ellas
+        """
+        bitmaps = [p for p in postings if isinstance(p, Bitmap)]
+        lists = [p for p in postings if not isinstance(p, Bitmap) and len(p)]
+        if len(lists) <= 1:
+            res = lists[0] if lists else array('i')
+        elif sum(map(len, lists)) * self.UNION_DENSITY >= len(self.news):
+            flags = bytearray(len(self.news))
+            for p in lists:
+                for new in p:
+                    flags[new] = 1
+            res = array('i', compress(range(len(flags)), flags))
+        else:
+            res = array('i', (new for new, _ in groupby(heapq.merge(*lists))))
+
+        if bitmaps:
+            bitmap = bitmaps[0]
+            for other in bitmaps[1:]:
+                bitmap = bitmap | other
+            res = bitmap_or(bitmap, res) if len(res) else bitmap
+        return res
+
     def minus_posting(self, p1, p2):
         """
         OPCIONAL PARA TODAS LAS VERSIONES
@@ -836,7 +1558,10 @@ class SAR_Project:
         return: posting list con los newid incluidos de p1 y no en p2
 
         """
-        answer = []
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return bitmap_minus(p1, p2)
+
+        answer = array('i')
         i = 0
         j = 0
 
@@ -900,26 +1625,25 @@ class SAR_Project:
         print('========================================')
         print('Query: ', query)
         print('Number of results:', len(result))
+        if self.use_ranking:
+            result = self.rank_result(result, query)
+        else:
+            result = ((news, 0) for news in result)
         i = 1
-        for news in result:
-            aux = self.news[news]
-
-            with open(self.docs[self.news[news][0]]) as fh:
-                jlist = json.load(fh)
-                aux = jlist[self.news[news][1]]
-            puntuacion = 0
+        for news, puntuacion in result:
+            aux = self.read_news(news)
             # If snippets method is activated
             if not self.show_snippet:
                 print('#{}\t({}) ({}) ({}) {} ({})'.format(
-                    i, puntuacion, news, aux['date'], aux['title'], aux['keywords']))
+                    i, round(puntuacion, 4), news, aux['date'], aux['title'], aux['keywords']))
             else:
                 print('#{}'.format(i))
-                print('Score:', puntuacion)
+                print('Score:', round(puntuacion, 4))
                 print(news)
                 print('Date: ', aux['date'])
                 print('Title: ', aux['title'])
                 print('Keywords: ', aux['keywords'])
-                print(self.snippet(aux, query))
+                print(self.snippet(aux, query, news))
 
             i += 1
 
@@ -930,75 +1654,562 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def solve_and_collect(self, query, limit=None):
+        """
+        Resuelve una consulta y devuelve las noticias recuperadas en lugar de mostrarlas (SAR_Server).
+        Usa las mismas opciones que self.solve_and_show: ranking, snippets y numero de noticias.
+
+        param:  "query": query que se debe resolver.
+                "limit": numero maximo de noticias devueltas, None para el de self.solve_and_show
+
+        return: diccionario con la consulta, el numero de resultados y la lista de noticias devueltas,
+                cada una con su newid, puntuacion, fecha, titulo, keywords y snippet (si self.show_snippet)
+        """
+        result = self.solve_query(query)
+        if limit is None:
+            limit = None if self.show_all else self.SHOW_MAX
+        if self.use_ranking:
+            ranked = self.rank_result(result, query)
+        else:
+            ranked = ((news, 0) for news in result)
+        hits = []
+        for news, score in islice(ranked, limit):
+            aux = self.read_news(news)
+            hit = {'id': news, 'score': round(score, 4), 'date': aux['date'],
+                   'title': aux['title'], 'keywords': aux['keywords']}
+            if self.show_snippet:
+                hit['snippet'] = self.snippet(aux, query, news)
+            hits.append(hit)
+        return {'query': query, 'total': len(result), 'results': hits}
+
+    def read_news(self, new):
+        """
+        Lee una noticia de su fichero.
+
+        Solo se lee y se parsea el objeto JSON de la noticia (offset y longitud guardados en self.news),
+        no el fichero completo. Las ultimas self.NEWS_CACHE noticias leidas se guardan en self.news_cache.
+
+        param:  "new": newid de la noticia
+
+        return: diccionario con los campos de la noticia
+        """
+        if new in self.news_cache:
+            self.news_cache.move_to_end(new)
+            return self.news_cache[new]
+
+        entry = self.news[new]
+        if len(entry) < 4:
+            # Index built without offsets: the whole file has to be parsed
+            with open(self.docs[entry[0]]) as fh:
+                news = json.load(fh)[entry[1]]
+        else:
+            with open(self.docs[entry[0]], 'rb') as fh:
+                fh.seek(entry[2])
+                news = json.loads(fh.read(entry[3]))
+
+        self.news_cache[new] = news
+        if len(self.news_cache) > self.NEWS_CACHE:
+            self.news_cache.popitem(last=False)
+        return news
+
     def rank_result(self, result, query):
         """
         NECESARIO PARA LA AMPLIACION DE RANKING
 
         Ordena los resultados de una query.
 
+        La puntuacion es BM25 sobre los terminos no negados de la consulta (expandidos como en la
+        busqueda), con las longitudes de las noticias de self.weight; si el indice no tiene
+        longitudes se usa TF-IDF. Sin self.show_all solo se seleccionan los self.SHOW_MAX mejores
+        con un heap, sin ordenar todo el resultado; si ademas la consulta es una disyuncion de
+        terminos se usa self.rank_maxscore.
+
         param:  "result": lista de resultados sin ordenar
                 "query": query, puede ser la query original, la query procesada o una lista de terminos
 
 
-        return: la lista de resultados ordenada
+        return: la lista de resultados ordenada, pares (newid, puntuacion) de mayor a menor puntuacion
 
         """
-
-        return 0
+        node = parse_query(query)
+        scorers = self.ranking_terms(node)
+        if self.use_pruning and not self.show_all and is_disjunction(node) \
+                and all(isinstance(postings, Posting) for postings, _, _, _ in scorers):
+            return self.rank_maxscore(scorers, self.SHOW_MAX)
+
+        scores = dict.fromkeys(result, 0.0)
+        for postings, idf, lengths, avg in scorers:
+            for new, tf in term_frequencies(postings, scores):
+                scores[new] += self.term_score(tf, idf, lengths[new] if avg else 0, avg)
+        self.scored = len(scores)
+
+        # Ties are broken by newid
+        key = lambda item: (item[1], -item[0])
+        if self.show_all:
+            return sorted(scores.items(), key=key, reverse=True)
+        return heapq.nlargest(self.SHOW_MAX, scores.items(), key=key)
 
         ###################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
         ##################################################
-    def snippet(self, new, query):
+
+    def ranking_terms(self, node):
+        """
+        Terminos del indice que puntuan en el ranking de una consulta.
+
+        param:  "node": arbol de la consulta
+
+        return: lista de tuplas (posting list, idf, longitudes de las noticias del campo, longitud media),
+                la longitud media es 0 si el campo no tiene longitudes (TF-IDF)
+        """
+        total = self.news_counter - len(self.deleted)
+        res = []
+        for field, term in query_terms(node):
+            lengths = self.weight['length'].get(field)
+            avg = self.weight['total'][field] / total if lengths and total else 0
+            for token in self.expand_term(term, field):
+                postings = self.index[field].get(token)
+                if postings is not None:
+                    # Deleted news are still counted in the posting lists until the index is purged
+                    df = min(len(postings), total)
+                    res.append((postings, math.log(1 + (total - df + 0.5) / (df + 0.5)), lengths, avg))
+        return res
+
+    def term_score(self, tf, idf, length, avg):
+        """
+        param:  "tf": frecuencia del termino en la noticia
+                "idf": idf del termino
+                "length": longitud de la noticia en el campo
+                "avg": longitud media del campo, 0 para usar TF-IDF
+
+        return: puntuacion BM25 (o TF-IDF) del termino en la noticia
+        """
+        if avg:
+            k1 = self.BM25_K1
+            return idf * tf * (k1 + 1) / (tf + k1 * (1 - self.BM25_B + self.BM25_B * length / avg))
+        return idf * (1 + math.log(tf))
+
+    def rank_maxscore(self, scorers, k):
+        """
+        Top-k de una consulta disyuntiva con MaxScore, sin puntuar todas las noticias.
+
+        La cota de cada termino es la mayor de las cotas de sus bloques (ver block_maxima). Los
+        terminos se ordenan por cota y, cuando hay k resultados, los de menor cota cuya suma no llega
+        a la puntuacion del k-esimo dejan de generar candidatos ("no esenciales"): solo se buscan en
+        ellos las noticias de los terminos esenciales, y se descartan en cuanto la puntuacion parcial
+        mas las cotas que faltan no alcanza al k-esimo. Antes de puntuar un candidato se acota con
+        las cotas de los bloques en que aparece.
+
+        El resultado es el mismo que puntuando todas las noticias: las sumas se hacen en el mismo
+        orden y los empates se resuelven igual (los candidatos llegan en orden de newid).
+
+        param:  "scorers": terminos de self.ranking_terms, con posting lists de tipo Posting
+                "k": numero de resultados
+
+        return: lista de pares (newid, puntuacion) de mayor a menor puntuacion
+        """
+        deleted = set(self.deleted)
+        blocks = []
+        for postings, idf, lengths, avg in scorers:
+            maxima = postings.maxima
+            if maxima is None:
+                maxima = block_maxima(postings.docids, postings.freqs, lengths)
+            blocks.append([self.term_score(maxima[i], idf, maxima[i + 1], avg) for i in range(0, len(maxima), 2)])
+        upper = [max(bounds, default=0.0) for bounds in blocks]
+        order = sorted(range(len(scorers)), key=lambda j: upper[j])
+        rank = {j: r for r, j in enumerate(order)}
+        # prefix[r]: sum of the bounds of the r terms with the smallest bounds
+        prefix = list(accumulate((upper[j] for j in order), initial=0.0))
+        # Margin for the rounding errors of the sums of bounds
+        margin = 1 + 1e-9
+
+        pointers = [0] * len(scorers)
+        cursors = [(postings.docids[0], j) for j, (postings, _, _, _) in enumerate(scorers) if len(postings)]
+        heapq.heapify(cursors)
+        essential = 0  # order[essential:] are the essential terms
+        threshold = 0.0
+        top = []
+        self.scored = 0
+        while cursors:
+            new = cursors[0][0]
+            present = []
+            while cursors and cursors[0][0] == new:
+                j = heapq.heappop(cursors)[1]
+                present.append(j)
+                pointers[j] += 1
+                docids = scorers[j][0].docids
+                if pointers[j] < len(docids) and rank[j] >= essential:
+                    heapq.heappush(cursors, (docids[pointers[j]], j))
+            if new in deleted:
+                continue
+
+            full = len(top) == k
+            if full and (prefix[essential] + sum(blocks[j][(pointers[j] - 1) // BLOCK_SIZE]
+                                                for j in present)) * margin < threshold:
+                continue
+            contributions = {}
+            partial = 0.0
+            for j in present:
+                postings, idf, lengths, avg = scorers[j]
+                i = pointers[j] - 1
+                contributions[j] = self.term_score(postings.freqs[i], idf, lengths[new] if avg else 0, avg)
+                partial += contributions[j]
+            pruned = False
+            for r in range(essential - 1, -1, -1):
+                j = order[r]
+                if j in contributions:
+                    continue
+                if full and (partial + prefix[r + 1]) * margin < threshold:
+                    pruned = True
+                    break
+                postings, idf, lengths, avg = scorers[j]
+                i = bisect_left(postings.docids, new, pointers[j])
+                pointers[j] = i
+                if i < len(postings) and postings.docids[i] == new:
+                    contributions[j] = self.term_score(postings.freqs[i], idf, lengths[new] if avg else 0, avg)
+                    partial += contributions[j]
+            if pruned:
+                continue
+
+            self.scored += 1
+            score = 0.0
+            for j in sorted(contributions):
+                score += contributions[j]
+            if not full:
+                heapq.heappush(top, (score, -new))
+            elif (score, -new) > top[0]:
+                heapq.heapreplace(top, (score, -new))
+            if len(top) == k:
+                threshold = top[0][0]
+                while essential < len(order) and prefix[essential + 1] * margin < threshold:
+                    essential += 1
+        return [(-neg, score) for score, neg in sorted(top, reverse=True)]
+
+    def snippet(self, new, query, newid=None):
         '''
-        Obtiene el snippet de una noticia.
+        Obtiene el snippet de una noticia: por cada campo de la consulta, la ventana de
+        self.SNIPPET_WINDOW tokens que contiene mas terminos distintos de la consulta, y mas
+        ventanas elegidas igual para los terminos que se quedan fuera.
+
+        Con el indice posicional las posiciones de los terminos se leen del indice y solo se
+        recorre el texto hasta el final de la ventana; si no, se tokeniza el campo.
+        Los terminos con comodines y los stems (si se usa stemming) se expanden a los terminos
+        del indice, como al resolver la consulta.
+
         param:  "new": la noticia, con todos sus campos
                 "query": query sin procesar
-        return: la métrica de un par consulta - documento
+                "newid": newid de la noticia, necesario para usar las posiciones del indice
+        return: el snippet, una linea por campo
         '''
-        tokens = self.tokenize(new['article'])
-        query = query.replace('NOT ', 'NOT')
-        query = query.replace(':', 'multifield')
-        query = self.tokenize(query)
-        snippet = '"'
-        left_counter = 0
-
-        for term in query:
-            
-            local = tokens
-
-            # If we are using multifield, we tokenize every field except 'date'
-            if 'multifield' in term:
-                field, term = term.split('multifield')
-                
-                if field != 'date':
-                    local = self.tokenize(new[field])
+        fields = {}
+        for field, term in query_terms(parse_query(query)):
+            if field != 'date' and field in new:
+                fields.setdefault(field, []).append(self.expand_term(term, field))
+        # Queries without positive terms show the beginning of the article
+        if not fields:
+            fields['article'] = []
+
+        lines = []
+        size = self.SNIPPET_WINDOW
+        for field, terms in fields.items():
+            positions = self.term_positions(new[field], field, terms, newid)
+            starts = []
+            while True:
+                start = best_window(positions, size)
+                starts.append(start)
+                covered = {term for position, term in positions if start <= position < start + size}
+                positions = [(position, term) for position, term in positions if term not in covered]
+                if not positions:
+                    break
+            lines.extend(window_texts(new[field], sorted(starts), size))
+        return '\n'.join(lines)
+
+    def expand_term(self, term, field='article'):
+        """
+        param:  "term": termino de la consulta
+                "field": campo del indice
+
+        return: conjunto de terminos del indice que representa "term" (comodines y stemming)
+        """
+        if '*' in term or '?' in term:
+            return set(self.wildcard_matches(term, field))
+        if self.use_stemming:
+            return set(self.stem_matches(term, field)) | {term}
+        return {term}
+
+    def term_positions(self, text, field, terms, newid=None):
+        """
+        Busca las posiciones de los terminos de una consulta en un campo de una noticia.
+
+        param:  "text": contenido del campo
+                "field": campo
+                "terms": lista de conjuntos de terminos, uno por termino de la consulta
+                "newid": newid de la noticia, si es None se tokeniza "text"
+
+        return: lista ordenada de pares (posicion, indice del termino de la consulta en "terms")
+        """
+        if self.positional and newid is not None and (self.multifield or field == 'article'):
+            res = []
+            for i, tokens in enumerate(terms):
+                for token in tokens:
+                    postings = self.index[field].get(token)
+                    if postings is not None and newid in postings:
+                        res.extend((position, i) for position in postings[newid])
+            res.sort()
+            return res
+
+        # Without positions the field has to be tokenized
+        wanted = {}
+        for i, tokens in enumerate(terms):
+            for token in tokens:
+                wanted.setdefault(token, []).append(i)
+        return [(position, i) for position, token in enumerate(self.tokenize(text))
+                for i in wanted.get(token, ())]
+
+
+def best_window(positions, size):
+    """
+    Elige la ventana de "size" tokens que contiene mas terminos distintos de la consulta.
+
+    param:  "positions": lista ordenada de pares (posicion, termino)
+            "size": numero de tokens de la ventana
+
+    return: posicion del primer token de la ventana, con los terminos centrados en ella
+    """
+    if not positions:
+        return 0
+    best = 0
+    first = last = positions[0][0]
+    counts = {}
+    left = 0
+    for position, term in positions:
+        counts[term] = counts.get(term, 0) + 1
+        while position - positions[left][0] >= size:
+            counts[positions[left][1]] -= 1
+            if not counts[positions[left][1]]:
+                del counts[positions[left][1]]
+            left += 1
+        if len(counts) > best:
+            best = len(counts)
+            first, last = positions[left][0], position
+    return max(0, first - (size - (last - first + 1)) // 2)
+
+
+def window_texts(text, starts, size):
+    """
+    Extrae del texto original los tokens de unas ventanas, sin tokenizar mas alla de la ultima.
+
+    param:  "text": contenido del campo
+            "starts": posiciones del primer token de cada ventana, ordenadas
+            "size": numero de tokens de cada ventana
+
+    return: lista con cada ventana entre comillas, con "..." si el texto sigue antes o despues
+    """
+    matches = list(islice(_WORD.finditer(text), starts[-1] + size + 1))
+    res = []
+    for start in starts:
+        window = matches[start:start + size]
+        words = ' '.join(text[window[0].start():window[-1].end()].split()) if window else ''
+        res.append('"%s%s%s"' % ('...' if start > 0 else '', words,
+                                 '...' if len(matches) > start + size else ''))
+    return res
+
+
+_WORD = re.compile(r'\w+')
+_JSON_DECODER = json.JSONDecoder()
+_JSON_SPACES = re.compile(r'\s*')
+_JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+###############################
+###                         ###
+###  INDEXACION EN PARALELO ###
+###                         ###
+###############################
+
+# Funciones a nivel de modulo para poder ejecutarlas en los procesos de multiprocessing.Pool
+
+
+def index_files(block):
+    """
+    Indexa un bloque de ficheros en un indice parcial.
+
+    param:  "block": tupla (multifield, positional, lista de ficheros)
+
+    return: tupla (index, docs, news, tokens, stamps, weight) del indice parcial, ver SAR_Project.merge_index
+    """
+    multifield, positional, filenames = block
+    partial = SAR_Project()
+    partial.multifield = multifield
+    partial.positional = positional
+    for filename in filenames:
+        partial.index_file(filename)
+    return partial.index, partial.docs, partial.news, partial.tokens, partial.stamps, partial.weight
+
+
+def phrase_match(positions):
+    """
+    param:  "positions": lista con las posiciones ordenadas de cada termino de una frase en una noticia
+
+    return: True si los terminos aparecen seguidos, en orden
+    """
+    # The shortest list drives the search, the others are searched with bisections
+    first = min(range(len(positions)), key=lambda i: len(positions[i]))
+    for position in positions[first]:
+        start = position - first
+        for i, others in enumerate(positions):
+            j = bisect_left(others, start + i)
+            if j == len(others) or others[j] != start + i:
+                break
+        else:
+            return True
+    return False
+
+
+def near_match(positions, distance, counts=None):
+    """
+    param:  "positions": lista con las posiciones ordenadas de cada termino en una noticia
+            "distance": distancia maxima
+            "counts": numero de posiciones distintas que se necesitan de cada termino, por defecto 1
+
+    return: True si hay "counts" posiciones de cada termino y entre la primera y la ultima hay
+            "distance" palabras o menos
+    """
+    # Merging the lists in order, the smallest window that ends at each position starts
+    # at the oldest of the last "count" positions seen of every term
+    last = [deque(maxlen=count) for count in (counts or [1] * len(positions))]
+    missing = len(positions)
+    merged = heapq.merge(*(zip(terms, repeat(i)) for i, terms in enumerate(positions)))
+    for position, i in merged:
+        if len(last[i]) == last[i].maxlen - 1:
+            missing -= 1
+        last[i].append(position)
+        if not missing and position - min(window[0] for window in last) <= distance:
+            return True
+    return False
+
+
+def is_disjunction(node):
+    """
+    param:  "node": arbol de la consulta
+
+    return: True si la consulta es un termino o un OR de terminos (sin frases ni NOT)
+    """
+    if isinstance(node, Or):
+        return all(is_disjunction(child) for child in node.children)
+    return isinstance(node, Term)
+
+
+def term_frequencies(postings, ids):
+    """
+    Frecuencias de un termino en un conjunto de noticias.
+
+    Se recorre la posting list o el conjunto, el que sea mas pequeño.
+
+    param:  "postings": posting list del termino (Posting o diccionario)
+            "ids": conjunto (o diccionario) de newid
+
+    return: generador de pares (newid, frecuencia) de las noticias de "ids" que contienen el termino
+    """
+    if isinstance(postings, Posting):
+        if len(ids) < len(postings):
+            for new in ids:
+                i = postings.find(new)
+                if i >= 0:
+                    yield new, postings.freqs[i]
+        else:
+            for new, tf in zip(postings.docids, postings.freqs):
+                if new in ids:
+                    yield new, tf
+        return
+    for new in (ids if len(ids) < len(postings) else postings):
+        if new in postings and new in ids:
+            value = postings[new]
+            yield new, value if isinstance(value, int) else len(value)
 
-            # Searching the term position and creating the snippet with the words around it
-            if term in local:
-                
-                pos = local.index(term)
-                min_p = pos - 4
-                if min_p < 0:
-                    min_p = 0
-                max_p = pos + 5
-                if max_p > len(local) - 1:
-                    max_p = len(local) - 1
 
-                snippet_aux = ''
-                if min_p > 0:
-                    snippet_aux += '...'
+def split_news(data):
+    """
+    Parsea un fichero de noticias (array JSON) guardando donde empieza y acaba cada noticia.
+
+    param:  "data": contenido del fichero (bytes en utf-8)
+
+    return: lista de tuplas (noticia, offset en bytes, longitud en bytes)
+    """
+    text = data.decode('utf-8')
+    is_ascii = text.isascii()
+    pos = _JSON_SPACES.match(text).end()
+    if text[pos:pos + 1] != '[':
+        raise ValueError('news files must contain a JSON array')
+    pos += 1
+    res = []
+    # Byte offset of text[char], advanced incrementally when the file is not ASCII
+    char = byte = 0
+    while True:
+        pos = _JSON_SEPARATORS.match(text, pos).end()
+        if text[pos:pos + 1] == ']':
+            return res
+        news, end = _JSON_DECODER.raw_decode(text, pos)
+        if is_ascii:
+            offset, length = pos, end - pos
+        else:
+            byte += len(text[char:pos].encode('utf-8'))
+            length = len(text[pos:end].encode('utf-8'))
+            offset = byte
+            char, byte = end, byte + length
+        res.append((news, offset, length))
+        pos = end
+
+
+def file_stamp(filename):
+    """
+    param:  "filename": fichero de noticias
+
+    return: tupla (tamaño, fecha de modificacion en ns) para saber si el fichero ha cambiado
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
+
 
-                snippet_aux += ' '.join(local[min_p:max_p + 1])
+def read_block(run):
+    """
+    Recorre un bloque escrito por SAR_Project.write_block.
+
+    param:  "run": fichero temporal del bloque
+
+    return: generador de tuplas (campo, termino, Posting)
+    """
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
 
-                if max_p < len(local) - 1:
-                    snippet_aux += '...'
 
-                left_counter += 1
+def token_stems(tokens):
+    """
+    param:  "tokens": terminos
 
-                if left_counter != len(query) - 1 and len(query) > 1 and len(snippet_aux.lstrip()) > 0:
-                    snippet_aux += '\n'
+    return: lista con el stem de cada termino
+    """
+    stemmer = SnowballStemmer('spanish')
+    return [stemmer.stem(token) for token in tokens]
 
-                snippet += snippet_aux
 
-        return snippet + '"'
+def stem_posting(postings):
+    """
+    Une las posting lists de los terminos de un stem.
+
+    param:  "postings": posting lists (Posting o diccionarios newid --> frecuencia o posiciones)
+
+    return: diccionario newid --> suma de las frecuencias, ordenado por newid
+    """
+    freqs = {}
+    for posting in postings:
+        if isinstance(posting, Posting):
+            pairs = zip(posting.docids, posting.freqs)
+        else:
+            pairs = ((new, value if isinstance(value, int) else len(value)) for new, value in posting.items())
+        for new, tf in pairs:
+            freqs[new] = freqs.get(new, 0) + tf
+    return {new: freqs[new] for new in sorted(freqs)}
@@ -0,0 +1,352 @@
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+# Los bitmaps se dividen en chunks de 2^16 noticias, como en los roaring bitmaps: la clave
+# del chunk son los 16 bits altos del newid y su contenido un entero de Python usado como
+# vector de bits de los 16 bits bajos. Los chunks vacios no se guardan y las operaciones
+# AND/OR/ANDNOT entre enteros se hacen palabra a palabra en C.
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_HEADER = struct.Struct('<II')  # clave del chunk, numero de bytes
+COUNT = struct.Struct('<I')
+
+# numero de postings de cada bloque de block_maxima
+BLOCK_SIZE = 64
+
+# posiciones de los bits activos de cada byte, para recorrer los bitmaps
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+class Posting:
+    """
+    Posting list compacta de un termino.
+
+    Los newid se guardan ordenados en el array "docids" y sus frecuencias en el
+    array paralelo "freqs". Si el indice es posicional, las posiciones de todas
+    las noticias se guardan concatenadas en "positions"; las de la noticia i-esima
+    son positions[offsets[i]:offsets[i + 1]].
+
+    Se puede usar como el diccionario {newid: frecuencia o posiciones} del indice
+    normal, pero sin un objeto Python por cada posting.
+
+    Si el termino es denso (ver is_dense) "bitmap" contiene ademas los newid como Bitmap.
+    "maxima" son los maximos por bloques para el ranking (ver block_maxima), o None.
+    """
+
+    __slots__ = ('docids', 'freqs', 'positions', 'offsets', 'bitmap', 'maxima')
+
+    def __init__(self, docids, freqs, positions=None, offsets=None, bitmap=None, maxima=None):
+        self.docids = docids
+        self.freqs = freqs
+        self.positions = positions
+        self.offsets = offsets
+        # Terminos densos: los mismos newid como Bitmap, para las operaciones booleanas
+        self.bitmap = bitmap
+        self.maxima = maxima
+
+    @classmethod
+    def from_dict(cls, postings):
+        """
+        Construye la posting list compacta a partir del diccionario del indice normal.
+
+        param:  "postings": diccionario newid --> numero de apariciones o lista de posiciones
+
+        return: objeto Posting
+        """
+        docids = array('i', sorted(postings))
+        if not docids or isinstance(postings[docids[0]], int):
+            return cls(docids, array('i', [postings[new] for new in docids]))
+
+        freqs = array('i')
+        positions = array('i')
+        offsets = array('i', [0])
+        for new in docids:
+            positions.extend(postings[new])
+            freqs.append(len(postings[new]))
+            offsets.append(len(positions))
+        return cls(docids, freqs, positions, offsets)
+
+    def find(self, new):
+        """
+        param:  "new": newid a buscar
+
+        return: indice de "new" dentro de self.docids, -1 si no esta
+        """
+        i = bisect_left(self.docids, new)
+        if i < len(self.docids) and self.docids[i] == new:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.docids)
+
+    def __contains__(self, new):
+        return self.find(new) >= 0
+
+    def value(self, i):
+        """
+        param:  "i": indice dentro de self.docids
+
+        return: frecuencia de la noticia i-esima, o sus posiciones si el indice es posicional
+        """
+        if self.positions is None:
+            return self.freqs[i]
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, new):
+        i = self.find(new)
+        if i < 0:
+            raise KeyError(new)
+        return self.value(i)
+
+    def __iter__(self):
+        return iter(self.docids)
+
+    def keys(self):
+        return self.docids
+
+    def items(self):
+        for i, new in enumerate(self.docids):
+            yield new, self.value(i)
+
+    def extend(self, other):
+        """
+        Añade al final las postings de "other", que deben tener newid mayores que los de esta.
+
+        param:  "other": objeto Posting del mismo termino
+        """
+        if self.positions is not None:
+            base = len(self.positions)
+            self.offsets.extend([offset + base for offset in other.offsets[1:]])
+            self.positions.extend(other.positions)
+        self.docids.extend(other.docids)
+        self.freqs.extend(other.freqs)
+        self.bitmap = None
+        self.maxima = None
+
+    def ids(self):
+        """
+        return: los newid como Bitmap si el termino es denso, si no el array ordenado
+        """
+        return self.docids if self.bitmap is None else self.bitmap
+
+    def __getstate__(self):
+        return (self.docids, self.freqs, self.positions, self.offsets, self.bitmap, self.maxima)
+
+    def __setstate__(self, state):
+        # Indexes pickled before the block maxima existed have one field less
+        self.docids, self.freqs, self.positions, self.offsets, self.bitmap, self.maxima = state + (None,) * (6 - len(state))
+
+
+def block_maxima(docids, freqs, lengths=None):
+    """
+    Calcula los maximos de una posting list por bloques de BLOCK_SIZE postings: con la
+    frecuencia maxima y la longitud minima de las noticias de un bloque se acota la
+    puntuacion BM25 de cualquiera de ellas, sea cual sea la longitud media de la coleccion.
+
+    param:  "docids": newid ordenados
+            "freqs": frecuencias
+            "lengths": array newid --> longitud de la noticia en el campo, None si no hay longitudes
+
+    return: array con la frecuencia maxima y la longitud minima de cada bloque, seguidas
+    """
+    maxima = array('i')
+    for start in range(0, len(docids), BLOCK_SIZE):
+        maxima.append(max(freqs[start:start + BLOCK_SIZE]))
+        maxima.append(min(lengths[new] for new in docids[start:start + BLOCK_SIZE]) if lengths else 0)
+    return maxima
+
+
+def is_dense(df, total, threshold):
+    """
+    Decide si una posting list se guarda tambien como bitmap.
+
+    param:  "df": numero de noticias de la posting list
+            "total": numero de noticias de la coleccion
+            "threshold": fraccion minima de la coleccion, None si no se usan bitmaps
+
+    return: True si df >= threshold * total
+    """
+    return threshold is not None and df > 0 and df >= threshold * total
+
+
+def complement_ids(ids, total):
+    """
+    Complemento de una posting list en la coleccion, sin enumerar todas las noticias.
+
+    param:  "ids": newid ordenados
+            "total": numero de noticias (los newid van de 0 a total - 1)
+
+    return: array con los newid que no estan en "ids"
+    """
+    # One flag per news, the range of all the news is filtered in C
+    flags = bytearray(b'\x01') * total
+    for new in ids:
+        flags[new] = 0
+    return array('i', compress(range(total), flags))
+
+
+class Bitmap:
+    """
+    Conjunto de newid comprimido por chunks (ver CHUNK_BITS).
+
+    Se comporta como una posting list de solo lectura: len() y la iteracion devuelven
+    los newid ordenados.
+    """
+
+    __slots__ = ('chunks', 'length')
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.length = None
+
+    @classmethod
+    def from_sorted(cls, ids):
+        """
+        param:  "ids": newid ordenados
+
+        return: Bitmap con los newid de "ids"
+        """
+        chunks = {}
+        key = None
+        buf = None
+        for new in ids:
+            if new >> CHUNK_BITS != key:
+                if buf is not None:
+                    chunks[key] = int.from_bytes(buf, 'little')
+                key = new >> CHUNK_BITS
+                buf = bytearray(1 << (CHUNK_BITS - 3))
+            low = new & CHUNK_MASK
+            buf[low >> 3] |= 1 << (low & 7)
+        if buf is not None:
+            chunks[key] = int.from_bytes(buf, 'little')
+        return cls(chunks)
+
+    @classmethod
+    def full(cls, total):
+        """
+        param:  "total": numero de noticias
+
+        return: Bitmap con los newid de 0 a total - 1
+        """
+        chunks = {}
+        for key in range((total + CHUNK_MASK) >> CHUNK_BITS):
+            chunks[key] = (1 << min(total - (key << CHUNK_BITS), 1 << CHUNK_BITS)) - 1
+        return cls(chunks)
+
+    @classmethod
+    def from_buffer(cls, buf, offset=0):
+        """
+        Lee un Bitmap escrito con to_bytes.
+
+        param:  "buf": buffer con el bitmap
+                "offset": posicion del bitmap en el buffer
+
+        return: Bitmap
+        """
+        chunks = {}
+        offset += COUNT.size
+        for _ in range(COUNT.unpack_from(buf, offset - COUNT.size)[0]):
+            key, size = CHUNK_HEADER.unpack_from(buf, offset)
+            offset += CHUNK_HEADER.size
+            chunks[key] = int.from_bytes(buf[offset:offset + size], 'little')
+            offset += size
+        return cls(chunks)
+
+    def to_bytes(self):
+        """
+        return: el bitmap serializado: numero de chunks y, por cada chunk, clave, longitud y bytes
+        """
+        parts = [COUNT.pack(len(self.chunks))]
+        for key in sorted(self.chunks):
+            bits = self.chunks[key]
+            data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+            parts.append(CHUNK_HEADER.pack(key, len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = sum(bits.bit_count() for bits in self.chunks.values())
+        return self.length
+
+    def __contains__(self, new):
+        bits = self.chunks.get(new >> CHUNK_BITS)
+        return bits is not None and bits >> (new & CHUNK_MASK) & 1 == 1
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            base = key << CHUNK_BITS
+            bits = self.chunks[key]
+            for i, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+                if byte:
+                    for bit in _BYTE_BITS[byte]:
+                        yield base + (i << 3) + bit
+
+    def __and__(self, other):
+        chunks = {}
+        for key, bits in self.chunks.items():
+            bits &= other.chunks.get(key, 0)
+            if bits:
+                chunks[key] = bits
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for key, bits in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for key, bits in self.chunks.items():
+            bits &= ~other.chunks.get(key, 0)
+            if bits:
+                chunks[key] = bits
+        return Bitmap(chunks)
+
+    def complement(self, total):
+        """
+        param:  "total": numero de noticias de la coleccion
+
+        return: Bitmap con los newid de 0 a total - 1 que no estan en este
+        """
+        return Bitmap.full(total) - self
+
+
+def _as_bitmap(p):
+    return p if isinstance(p, Bitmap) else Bitmap.from_sorted(p)
+
+
+def bitmap_and(p1, p2):
+    """
+    AND de dos posting lists cuando al menos una es un Bitmap.
+
+    return: Bitmap si las dos lo son, si no un array con los newid de la lista ordenada que estan en el bitmap
+    """
+    if isinstance(p1, Bitmap) and isinstance(p2, Bitmap):
+        return p1 & p2
+    bitmap, ids = (p1, p2) if isinstance(p1, Bitmap) else (p2, p1)
+    return array('i', [new for new in ids if new in bitmap])
+
+
+def bitmap_or(p1, p2):
+    """
+    OR de dos posting lists cuando al menos una es un Bitmap.
+
+    return: Bitmap
+    """
+    return _as_bitmap(p1) | _as_bitmap(p2)
+
+
+def bitmap_minus(p1, p2):
+    """
+    p1 - p2 cuando al menos una de las dos posting lists es un Bitmap.
+
+    return: Bitmap si p1 lo es, si no un array con los newid de p1 que no estan en p2
+    """
+    if isinstance(p1, Bitmap):
+        return p1 - _as_bitmap(p2)
+    return array('i', [new for new in p1 if new not in p2])
@@ -0,0 +1,175 @@
+import json
+import time
+from array import array
+
+from SAR_postings import Bitmap, Posting
+
+# Instrumentacion de las consultas. Profiler.install sustituye en un objeto SAR_Project los
+# metodos de cada fase por envoltorios que miden su tiempo y el tamaño de las posting lists
+# que reciben y devuelven. Sin instalarlo no se ejecuta nada de este modulo, asi que la
+# instrumentacion no tiene ningun coste cuando no se usa.
+#
+# Los tiempos de cada fase son inclusivos ("ms") y exclusivos ("self_ms", sin las fases
+# llamadas desde ella). El tiempo exclusivo de solve_query es el analisis de la consulta,
+# el plan y el filtrado de las noticias borradas.
+#
+# "postings_in" y "postings_out" cuentan los newid de las posting lists que recibe y devuelve
+# cada fase (sumando los de todas si recibe una lista de posting lists); los terminos, las
+# noticias y los arboles de las consultas no cuentan. Las fases de INDEX_READS no reciben
+# posting lists sino que las leen del indice, su entrada es lo leido.
+
+# metodos que resuelven una consulta completa, cada llamada es una consulta de la traza
+QUERY_METHODS = ('solve_and_show', 'solve_and_count', 'solve_and_collect')
+
+# metodos medidos de cada fase
+PHASES = ('solve_query', 'get_posting', 'get_docids', 'get_stemming', 'stem_matches', 'get_permuterm',
+          'wildcard_matches', 'get_positionals', 'get_near', 'and_posting', 'multi_or_posting',
+          'minus_posting', 'reverse_posting', 'rank_result', 'ranking_terms', 'rank_maxscore',
+          'read_news', 'snippet')
+
+# fases que leen una posting list del indice
+INDEX_READS = ('get_docids',)
+
+# tipos de las posting lists: listas y arrays de newid, Posting y Bitmap
+POSTING_TYPES = (list, array, range, Posting, Bitmap)
+
+
+def _postings(value):
+    """
+    return: numero de newid de una posting list, de una lista de posting lists o de una lista de
+            resultados del ranking; 0 para cualquier otro valor (terminos, noticias, consultas)
+    """
+    if isinstance(value, tuple):
+        # (posting list, ...) of the ranking terms, or (newid, score) of a ranked result
+        if not value:
+            return 0
+        return 1 if isinstance(value[0], int) else _postings(value[0])
+    if isinstance(value, dict) and value and isinstance(next(iter(value)), int):
+        # posting list of an index that is not compact: newid --> frequency or positions
+        return len(value)
+    if not isinstance(value, POSTING_TYPES):
+        return 0
+    if isinstance(value, list) and value and not isinstance(value[0], int):
+        return sum(_postings(item) for item in value)
+    return len(value)
+
+
+class Profiler:
+    """
+    Mide las fases de las consultas de un SAR_Project.
+
+    Por cada consulta guarda, para cada fase, el numero de llamadas, los tiempos y los newid
+    de las posting lists de entrada y de salida; las consultas se acumulan para el resumen
+    (self.summary) y, si hay fichero de traza, se escriben en el como una linea JSON.
+    """
+
+    def __init__(self, trace=None):
+        """
+        param:  "trace": fichero abierto en el que escribir la traza, None para no escribirla
+        """
+        self.trace = trace
+        # tiempo de las fases hijas de cada llamada en curso
+        self.stack = []
+        self.query = None
+        self.totals = {}
+        self.queries = 0
+        self.total_ms = 0.0
+
+    def install(self, project):
+        """
+        Instrumenta un objeto SAR_Project (solo ese objeto, no la clase).
+
+        param:  "project": indice cargado
+        """
+        for name in QUERY_METHODS:
+            # The query methods are also a phase, their own time is the output of the results
+            setattr(project, name, self.wrap_query(self.wrap(name, getattr(project, name))))
+        for name in PHASES:
+            setattr(project, name, self.wrap(name, getattr(project, name)))
+
+    def wrap_query(self, method):
+        """
+        Envoltorio de los metodos de QUERY_METHODS: empieza y termina el registro de una consulta.
+        """
+        def wrapper(query, *args, **kwargs):
+            if self.query is not None:
+                return method(query, *args, **kwargs)
+            self.query = {'query': query, 'phases': {}}
+            t0 = time.perf_counter()
+            try:
+                return method(query, *args, **kwargs)
+            finally:
+                self.end_query((time.perf_counter() - t0) * 1000)
+        return wrapper
+
+    def wrap(self, name, method):
+        """
+        Envoltorio que mide una fase.
+
+        param:  "name": nombre de la fase
+                "method": metodo enlazado original
+        """
+        def wrapper(*args, **kwargs):
+            children = [0.0]
+            self.stack.append(children)
+            t0 = time.perf_counter()
+            try:
+                res = method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                self.stack.pop()
+                if self.stack:
+                    self.stack[-1][0] += elapsed
+            size_out = _postings(res)
+            size_in = size_out if name in INDEX_READS else sum(_postings(arg) for arg in args)
+            self.record(name, elapsed * 1000, (elapsed - children[0]) * 1000, size_in, size_out)
+            return res
+        return wrapper
+
+    def record(self, name, ms, self_ms, size_in, size_out):
+        """
+        Acumula una llamada a una fase en la consulta en curso.
+        """
+        if self.query is None:
+            return
+        phase = self.query['phases'].get(name)
+        if phase is None:
+            phase = self.query['phases'][name] = {'calls': 0, 'ms': 0.0, 'self_ms': 0.0,
+                                                  'postings_in': 0, 'postings_out': 0}
+        phase['calls'] += 1
+        phase['ms'] += ms
+        phase['self_ms'] += self_ms
+        phase['postings_in'] += size_in
+        phase['postings_out'] += size_out
+
+    def end_query(self, ms):
+        """
+        Cierra la consulta en curso: la escribe en la traza y la suma al resumen.
+
+        param:  "ms": tiempo total de la consulta
+        """
+        query = self.query
+        self.query = None
+        query['ms'] = ms
+        self.queries += 1
+        self.total_ms += ms
+        for name, phase in query['phases'].items():
+            total = self.totals.setdefault(name, dict.fromkeys(phase, 0))
+            for key, value in phase.items():
+                total[key] += value
+        if self.trace is not None:
+            self.trace.write(json.dumps(query, ensure_ascii=False) + '\n')
+
+    def summary(self):
+        """
+        return: tabla con el total de cada fase en todas las consultas, de mayor a menor tiempo exclusivo
+        """
+        lines = ['Profile of %d queries, %.2f ms in total.' % (self.queries, self.total_ms),
+                 '%-18s %8s %11s %11s %7s %13s %13s' % ('phase', 'calls', 'ms', 'self ms', 'self %',
+                                                       'postings in', 'postings out')]
+        for name, phase in sorted(self.totals.items(), key=lambda item: -item[1]['self_ms']):
+            lines.append('%-18s %8d %11.2f %11.2f %6.1f%% %13d %13d' % (
+                name, phase['calls'], phase['ms'], phase['self_ms'],
+                100 * phase['self_ms'] / self.total_ms if self.total_ms else 0,
+                phase['postings_in'], phase['postings_out']))
+        return '\n'.join(lines)
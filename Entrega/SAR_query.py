@@ -0,0 +1,433 @@
+import re
+
+# Gramatica de las consultas. Los operadores binarios se evaluan de izquierda a derecha,
+# sin precedencia entre AND y OR; dos operandos seguidos sin operador son un AND implicito.
+#
+#   query   := unary ((AND | OR)? unary)*
+#   unary   := NOT unary | primary
+#   primary := '(' query ')' | operand (NEAR/k operand)*
+#   operand := [field ':'] (WORD | PHRASE)
+#
+# Los operadores solo se reconocen como palabras completas en mayusculas, de forma que
+# terminos como "corona" o "andalucia" no se confunden con OR o AND.
+# "a NEAR/k b" son las noticias con a y b a k palabras o menos de distancia, en cualquier
+# orden; con mas terminos todos deben estar en una ventana de k + 1 palabras. Un termino
+# repetido necesita tantas posiciones distintas como veces aparece (k es al menos 1).
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+_NEAR = re.compile(r'NEAR/(\d+)$')
+
+_TOKEN = re.compile(r'''
+    (?:
+        (?P<paren>[()])
+      | (?P<field>[^\W\d_]+):(?=[^\s()])
+      | "(?P<phrase>[^"]*)"
+      | (?P<word>[^\s()"]+)
+    )''', re.VERBOSE)
+_SPACES = re.compile(r'\s*')
+
+
+class Term:
+    """
+    Termino de la consulta sobre un campo, puede contener comodines (* o ?).
+    """
+
+    __slots__ = ('field', 'text')
+
+    def __init__(self, field, text):
+        self.field = field
+        self.text = text
+
+    @property
+    def wildcard(self):
+        return '*' in self.text or '?' in self.text
+
+    def __str__(self):
+        return '%s:%s' % (self.field, self.text)
+
+
+class Phrase:
+    """
+    Secuencia de terminos consecutivos ("fin de semana") sobre un campo.
+    """
+
+    __slots__ = ('field', 'terms')
+
+    def __init__(self, field, terms):
+        self.field = field
+        self.terms = terms
+
+    def __str__(self):
+        return '%s:"%s"' % (self.field, ' '.join(self.terms))
+
+
+class Near:
+    """
+    Terminos de un campo a "distance" palabras o menos unos de otros (a NEAR/k b).
+    """
+
+    __slots__ = ('field', 'terms', 'distance')
+
+    def __init__(self, field, terms, distance):
+        self.field = field
+        self.terms = terms
+        self.distance = distance
+
+    def __str__(self):
+        return '%s:(%s)' % (self.field, (' NEAR/%d ' % self.distance).join(self.terms))
+
+
+class Not:
+    """
+    Negacion de una subconsulta.
+    """
+
+    __slots__ = ('child',)
+
+    def __init__(self, child):
+        self.child = child
+
+    def __str__(self):
+        return 'NOT %s' % self.child
+
+
+class And:
+    """
+    Conjuncion de dos o mas subconsultas.
+    """
+
+    __slots__ = ('children',)
+
+    op = 'AND'
+
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return '(%s)' % (' %s ' % self.op).join(str(child) for child in self.children)
+
+
+class Or(And):
+    """
+    Disyuncion de dos o mas subconsultas.
+    """
+
+    __slots__ = ()
+
+    op = 'OR'
+
+
+def tokenize_query(query):
+    """
+    Divide la consulta en tokens en una sola pasada.
+
+    param:  "query": cadena con la consulta
+
+    return: lista de pares (tipo, valor), con tipo 'AND', 'OR', 'NOT', 'NEAR', '(', ')', 'field', 'phrase' o 'word';
+            el valor de NEAR es la distancia
+    """
+    tokens = []
+    pos = 0
+    end = len(query)
+    while True:
+        pos = _SPACES.match(query, pos).end()
+        if pos == end:
+            return tokens
+        match = _TOKEN.match(query, pos)
+        if match is None:
+            raise ValueError('unexpected %r at position %d of query %r' % (query[pos], pos, query))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'paren':
+            tokens.append((value, value))
+        elif kind == 'word' and value in OPERATORS:
+            tokens.append((value, value))
+        elif kind == 'word' and _NEAR.match(value):
+            tokens.append(('NEAR', int(_NEAR.match(value).group(1))))
+        else:
+            tokens.append((kind, value.lower()))
+        pos = match.end()
+
+
+def parse_query(query, default_field='article'):
+    """
+    Construye el arbol de una consulta. El coste es lineal en la longitud de la consulta.
+
+    param:  "query": cadena con la consulta
+            "default_field": campo de los terminos sin prefijo "campo:"
+
+    return: arbol de la consulta (Term, Phrase, Near, Not, And, Or)
+    """
+    parser = _Parser(tokenize_query(query), default_field)
+    node = parser.query()
+    if parser.i < len(parser.tokens):
+        raise ValueError('unbalanced ")" in query %r' % query)
+    return node
+
+
+class _Parser:
+    """
+    Parser descendente recursivo sobre la lista de tokens.
+    """
+
+    def __init__(self, tokens, default_field):
+        self.tokens = tokens
+        self.default_field = default_field
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i][0] if self.i < len(self.tokens) else None
+
+    def query(self):
+        node = self.unary()
+        while self.peek() not in (None, ')'):
+            op = 'AND'
+            if self.peek() in ('AND', 'OR'):
+                op = self.peek()
+                self.i += 1
+            right = self.unary()
+            # Left to right evaluation: chains of the same operator become one n-ary node
+            if type(node) is (And if op == 'AND' else Or):
+                node.children.append(right)
+            else:
+                node = And([node, right]) if op == 'AND' else Or([node, right])
+        return node
+
+    def unary(self):
+        kind = self.peek()
+        if kind == 'NOT':
+            self.i += 1
+            return Not(self.unary())
+        if kind == '(':
+            self.i += 1
+            node = self.query()
+            if self.peek() != ')':
+                raise ValueError('missing ")" in query')
+            self.i += 1
+            return node
+        node = self.operand()
+        if self.peek() != 'NEAR':
+            return node
+        distance = self.tokens[self.i][1]
+        if distance < 1:
+            raise ValueError('NEAR distance must be at least 1')
+        terms = [node]
+        while self.peek() == 'NEAR':
+            if self.tokens[self.i][1] != distance:
+                raise ValueError('NEAR chains must use the same distance')
+            self.i += 1
+            # The terms without a field take the field of the first one
+            terms.append(self.operand(node.field))
+        if any(not isinstance(term, Term) or term.wildcard or term.field != node.field for term in terms):
+            raise ValueError('NEAR operands must be words of the same field')
+        return Near(node.field, [term.text for term in terms], distance)
+
+    def operand(self, field=None):
+        field = field or self.default_field
+        if self.peek() == 'field':
+            field = self.tokens[self.i][1]
+            self.i += 1
+        kind = self.peek()
+        if kind not in ('word', 'phrase'):
+            raise ValueError('expected a term but found %r' % (kind or 'end of query'))
+        value = self.tokens[self.i][1]
+        self.i += 1
+        if kind == 'phrase':
+            if not value.split():
+                raise ValueError('empty phrase in query')
+            return Phrase(field, value.split())
+        return Term(field, value)
+
+
+def query_terms(node, negated=False):
+    """
+    Terminos de la consulta que deberian aparecer en los resultados, los que no estan negados.
+
+    param:  "node": arbol de la consulta
+            "negated": True si el nodo esta bajo un numero impar de NOT
+
+    return: lista de pares (campo, termino); cada palabra de una frase es un termino
+    """
+    if isinstance(node, Term):
+        return [] if negated else [(node.field, node.text)]
+    if isinstance(node, (Phrase, Near)):
+        return [] if negated else [(node.field, term) for term in node.terms]
+    if isinstance(node, Not):
+        return query_terms(node.child, not negated)
+    return [term for child in node.children for term in query_terms(child, negated)]
+
+
+###############################
+###                         ###
+###      PLAN DE CONSULTA   ###
+###                         ###
+###############################
+
+# El plan se construye sobre el arbol de la consulta con las posting lists de las hojas ya
+# recuperadas, de modo que el tamaño de cada operando es exacto:
+#   - los operandos de un AND se intersecan de menor a mayor posting list,
+#   - "A AND NOT B" se resuelve como la diferencia A - B,
+#   - los NOT se propagan con De Morgan y el complemento respecto a toda la coleccion
+#     solo se calcula una vez, si el resultado final de la consulta es un complemento.
+# Las estimaciones de los nodos intermedios y los costes son aproximados (numero de
+# postings recorridos en las mezclas).
+# Cada nodo tiene una clave ("key") que identifica su resultado: la de una hoja es el termino
+# con su campo y en AND y OR no depende del orden de los hijos, para reutilizar resultados
+# de subconsultas equivalentes.
+
+
+class Leaf:
+    """
+    Hoja del plan: termino, frase o NEAR con su posting list.
+    """
+
+    def __init__(self, node, posting):
+        self.node = node
+        self.posting = posting
+        self.estimate = len(posting)
+        self.cost = 0
+        self.children = []
+        self.key = str(node)
+
+    def label(self):
+        return str(self.node)
+
+
+class Intersect:
+    """
+    AND de los hijos, en el orden en que aparecen (de menor a mayor).
+    """
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda child: child.estimate)
+        self.estimate = self.children[0].estimate
+        self.cost = sum(child.cost for child in self.children)
+        for child in self.children[1:]:
+            self.cost += self.estimate + child.estimate
+            self.estimate = min(self.estimate, child.estimate)
+        self.key = 'AND(%s)' % ','.join(sorted(child.key for child in self.children))
+
+    def label(self):
+        return 'AND'
+
+
+class Union:
+    """
+    OR de los hijos, mezclados de menor a mayor.
+    """
+
+    def __init__(self, children, total):
+        self.children = sorted(children, key=lambda child: child.estimate)
+        self.estimate = self.children[0].estimate
+        self.cost = sum(child.cost for child in self.children)
+        for child in self.children[1:]:
+            self.cost += self.estimate + child.estimate
+            self.estimate = min(total, self.estimate + child.estimate)
+        self.key = 'OR(%s)' % ','.join(sorted(child.key for child in self.children))
+
+    def label(self):
+        return 'OR'
+
+
+class Difference:
+    """
+    Noticias del primer hijo que no estan en el segundo (A AND NOT B).
+    """
+
+    def __init__(self, left, right):
+        self.children = [left, right]
+        self.estimate = left.estimate
+        self.cost = left.cost + right.cost + left.estimate + right.estimate
+        self.key = 'MINUS(%s,%s)' % (left.key, right.key)
+
+    def label(self):
+        return 'MINUS'
+
+
+class Complement:
+    """
+    Todas las noticias de la coleccion excepto las del hijo.
+    """
+
+    def __init__(self, child, total):
+        self.children = [child]
+        self.estimate = total - child.estimate
+        self.cost = child.cost + total + child.estimate
+        self.key = 'NOT(%s)' % child.key
+
+    def label(self):
+        return 'NOT'
+
+
+def plan_query(node, resolve, total):
+    """
+    Construye el plan de ejecucion de un arbol de consulta.
+
+    param:  "node": arbol de la consulta
+            "resolve": funcion que devuelve la posting list de un Term, una Phrase o un Near
+            "total": numero de noticias de la coleccion
+
+    return: raiz del plan (Leaf, Intersect, Union, Difference o Complement)
+    """
+    plan, negated = _plan(node, resolve, total)
+    if negated:
+        return Complement(plan, total)
+    return plan
+
+
+def _plan(node, resolve, total):
+    """
+    return: par (plan, negated); si negated es True el resultado del nodo es el complemento del plan
+    """
+    if isinstance(node, (Term, Phrase, Near)):
+        return Leaf(node, resolve(node)), False
+    if isinstance(node, Not):
+        plan, negated = _plan(node.child, resolve, total)
+        return plan, not negated
+
+    positive = []
+    negative = []
+    for child in node.children:
+        plan, negated = _plan(child, resolve, total)
+        (negative if negated else positive).append(plan)
+
+    if isinstance(node, Or):
+        # A OR B OR NOT C OR NOT D == NOT ((C AND D) - (A OR B))
+        if not negative:
+            return _union(positive, total), False
+        plan = _intersect(negative)
+        if positive:
+            plan = Difference(plan, _union(positive, total))
+        return plan, True
+
+    # A AND B AND NOT C AND NOT D == (A AND B) - (C OR D)
+    if not positive:
+        return _union(negative, total), True
+    plan = _intersect(positive)
+    if negative:
+        plan = Difference(plan, _union(negative, total))
+    return plan, False
+
+
+def _intersect(plans):
+    return plans[0] if len(plans) == 1 else Intersect(plans)
+
+
+def _union(plans, total):
+    return plans[0] if len(plans) == 1 else Union(plans, total)
+
+
+def explain(plan, depth=0):
+    """
+    Devuelve el plan como texto, una linea por nodo con su tamaño estimado y su coste.
+
+    param:  "plan": raiz del plan
+            "depth": nivel de indentacion
+
+    return: cadena con el plan
+    """
+    lines = ['%s%s  (est=%d cost=%d)' % ('    ' * depth, plan.label(), plan.estimate, plan.cost)]
+    for child in plan.children:
+        lines.append(explain(child, depth + 1))
+    return '\n'.join(lines)
@@ -0,0 +1,915 @@
+import heapq
+import json
+import mmap
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, groupby
+from operator import itemgetter
+from os.path import commonprefix
+
+from SAR_lexicon import Permuterms
+from SAR_postings import BLOCK_SIZE, Bitmap, Posting, block_maxima, is_dense
+from SAR_tables import NewsTable
+
+# Formato de segmento (todos los enteros en little-endian):
+#
+#   cabecera:  MAGIC | offset de los metadatos (uint64) | longitud de los metadatos (uint64)
+#   secciones: 'postings'           newid (int32) y frecuencias (int32) de cada termino, seguidos de los
+#                                   maximos por bloques (int32, ver block_maxima) y del Bitmap
+#                                   serializado si el termino es denso
+#              'positions'          posiciones (int32) de cada termino, noticia a noticia
+#              'terms/<campo>'      diccionario de terminos ordenado -> df, offset en postings y en positions;
+#                                   es el lexico del campo: el id de un termino es su posicion en la tabla
+#              'stempostings/<campo>'
+#                                   como 'terms/<campo>', para las posting lists (sin posiciones) de los stems
+#                                   con mas de un termino (self.spindex); sus postings van en 'postings'
+#              'stems/<campo>'      stem -> ids (int32) de sus terminos (self.sindex)
+#              'stemids/<campo>'    id del stem de cada termino (int32, posicion en 'stems/<campo>'), por id
+#                                   del termino, para que el stemming de las consultas sea una busqueda
+#              'permuterms/<campo>' pares (id del termino, caracteres rotados) (int32) ordenados por el
+#                                   permuterm (self.ptindex, ver SAR_lexicon)
+#              'news'               tabla de noticias por columnas: docid, posicion en el fichero, offset y
+#                                   longitud en bytes de la noticia en el fichero (int32)
+#              'docs'               tabla de ficheros: numero de ficheros, offsets (uint32) y rutas en utf-8
+#              'stamps'             tamaño y fecha de modificacion (int64) de cada fichero, -1 si no se conocen
+#              'deleted'            newid (int32) de las noticias borradas, ordenados
+#              'deleted_docs'       docid (int32) de los ficheros borrados
+#              'lengths/<campo>'    numero de tokens (int32) de cada noticia en el campo, para el ranking
+#   metadatos: JSON con la configuracion del indice y el offset y longitud de cada seccion
+#
+# Los diccionarios estan ordenados por los bytes utf-8 de la clave (el mismo orden que los str de Python)
+# para poder buscar con bisecciones directamente sobre el fichero mapeado, sin cargarlos en memoria.
+# Cada diccionario es: numero de entradas, registros de tamaño fijo, offsets (int32) de los bloques de
+# FRONT_BLOCK claves y las claves con front coding: en cada bloque la primera clave esta completa y
+# las demas guardan la longitud del prefijo comun con la anterior y el resto de la clave (KEY).
+#
+# Los segmentos de la version 1 (sin 'version' en los metadatos) guardan las claves completas con su
+# offset y longitud en cada registro, los stems y permuterms como cadenas; se siguen pudiendo leer.
+
+MAGIC = b'SARSEG01'
+VERSION = 2
+HEADER = struct.Struct('<8sQQ')
+COUNT = struct.Struct('<I')
+FRONT_BLOCK = 16
+KEY = struct.Struct('<HH')  # shared prefix length, suffix length
+TERM = struct.Struct('<IQQ')  # df, post_off, pos_off
+ENTRY = struct.Struct('<II')  # val_off, val_len (in term ids)
+TERM_V1 = struct.Struct('<IIIQQ')  # key_off, key_len, df, post_off, pos_off
+ENTRY_V1 = struct.Struct('<IIII')  # key_off, key_len, val_off, val_len
+SEPARATOR = '\x00'
+
+# atributos de SAR_Project que se guardan en los metadatos
+CONFIG = ('multifield', 'positional', 'stemming', 'permuterm', 'docid', 'news_counter', 'tokens',
+          'bitmap_threshold', 'stem_postings')
+
+
+def is_segment(filename):
+    """
+    param:  "filename": fichero con un indice
+
+    return: True si el fichero tiene formato de segmento, False si es un pickle
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def _to_bytes(ints):
+    """
+    Devuelve los bytes little-endian de un array de enteros.
+    """
+    if sys.byteorder != 'little':
+        ints = array(ints.typecode, ints)
+        ints.byteswap()
+    return ints.tobytes()
+
+
+def _from_bytes(buf, typecode='i'):
+    """
+    Devuelve un array de enteros con el contenido de "buf" (enteros little-endian del tipo "typecode").
+    """
+    ints = array(typecode)
+    ints.frombytes(buf)
+    if sys.byteorder != 'little':
+        ints.byteswap()
+    return ints
+
+
+def _int_view(buf):
+    """
+    Devuelve una vista de solo lectura de "buf" como enteros de 32 bits, sin copiarlo
+    si el orden de bytes de la maquina lo permite.
+    """
+    if sys.byteorder == 'little':
+        return buf.cast('i')
+    return _from_bytes(buf)
+
+
+def _front_code(keys):
+    """
+    Codifica claves ordenadas con front coding por bloques de FRONT_BLOCK.
+
+    param:  "keys": lista ordenada de claves (bytes)
+
+    return: tupla (array con el offset de cada bloque y el final de las claves, claves codificadas)
+    """
+    offsets = array('i')
+    data = bytearray()
+    prev = b''
+    for i, key in enumerate(keys):
+        if i % FRONT_BLOCK == 0:
+            offsets.append(len(data))
+            shared = 0
+        else:
+            shared = min(len(commonprefix((prev, key))), 0xffff)
+        data += KEY.pack(shared, len(key) - shared)
+        data += key[shared:]
+        prev = key
+    offsets.append(len(data))
+    return offsets, bytes(data)
+
+
+class SegmentWriter:
+    """
+    Escribe un indice en formato de segmento.
+
+    Las posting lists se escriben en el fichero segun se añaden (add_posting), las posiciones
+    van a un fichero temporal que se copia al final de la seccion de postings. Solo los
+    diccionarios de terminos (una entrada por termino) se mantienen en memoria hasta el final,
+    y despues los lexicos de los campos para escribir los stems y permuterms con ids.
+    """
+
+    def __init__(self, filename, total=0, bitmap_threshold=None, lengths=None):
+        self.fh = open(filename, 'wb')
+        self.total = total
+        self.bitmap_threshold = bitmap_threshold
+        # campo --> longitudes de las noticias, para los maximos por bloques
+        self.lengths = lengths or {}
+        self.fh.write(HEADER.pack(MAGIC, 0, 0))
+        self.sections = {}
+        self.terms = {}
+        # campo --> terminos (bytes) de 'terms/<campo>' ordenados, su posicion es el id
+        self.lexicon = {}
+        self.positions = tempfile.TemporaryFile()
+        self.post_start = self.fh.tell()
+        self.pos_size = 0
+        self.writing_postings = True
+
+    def add_posting(self, field, term, posting, table='terms'):
+        """
+        Añade la posting list de un termino.
+
+        param:  "field": campo del indice
+                "term": termino
+                "posting": objeto Posting o diccionario newid --> frecuencia o posiciones
+                "table": diccionario de la seccion '<table>/<campo>' en el que se añade el termino
+        """
+        if not isinstance(posting, Posting):
+            posting = Posting.from_dict(posting)
+        post_off = self.fh.tell() - self.post_start
+        self.fh.write(_to_bytes(posting.docids))
+        self.fh.write(_to_bytes(posting.freqs))
+        maxima = posting.maxima
+        if maxima is None:
+            maxima = block_maxima(posting.docids, posting.freqs, self.lengths.get(field))
+        self.fh.write(_to_bytes(maxima))
+        if is_dense(len(posting), self.total, self.bitmap_threshold):
+            self.fh.write((posting.bitmap or Bitmap.from_sorted(posting.docids)).to_bytes())
+        pos_off = self.pos_size
+        if posting.positions is not None:
+            data = _to_bytes(posting.positions)
+            self.positions.write(data)
+            self.pos_size += len(data)
+        self.terms.setdefault(table + '/' + field, []).append(
+            (term.encode('utf-8'), len(posting), post_off, pos_off))
+
+    def copy_postings(self, field, table, entries, name='terms'):
+        """
+        Añade las posting lists de varios terminos de otro segmento copiando sus bytes, sin
+        decodificarlas (las de los terminos que una actualizacion no ha cambiado, ver UpdatedTable).
+        Solo se calcula el Bitmap de un termino si pasa a ser denso.
+
+        param:  "field": campo del indice
+                "table": TermTable del otro segmento
+                "entries": iterable de pares (termino, registro del termino en "table")
+                "name": como "table" en self.add_posting
+        """
+        if table.version != VERSION or table.block_size != BLOCK_SIZE:
+            # Older layouts do not have the same block maxima, the posting lists are encoded again
+            for term, record in entries:
+                self.add_posting(field, term, table._decode(record), name)
+            return
+        records = self.terms.setdefault(name + '/' + field, [])
+        postings = table.postings
+        start = self.fh.tell() - self.post_start
+        for term, (df, post_off, pos_off) in entries:
+            end = post_off + 8 * df + 8 * -(-df // BLOCK_SIZE)
+            data = postings[post_off:end]
+            if is_dense(df, self.total, self.bitmap_threshold):
+                if is_dense(df, table.total, table.bitmap_threshold):
+                    bitmap = Bitmap.from_buffer(postings, end)
+                else:
+                    bitmap = Bitmap.from_sorted(_from_bytes(postings[post_off:post_off + 4 * df]))
+                data = bytes(data) + bitmap.to_bytes()
+            self.fh.write(data)
+            records.append((term.encode('utf-8'), df, start, self.pos_size))
+            start += len(data)
+            if table.positional:
+                size = 4 * sum(_from_bytes(postings[post_off + 4 * df:post_off + 8 * df]))
+                self.positions.write(table.positions[pos_off:pos_off + size])
+                self.pos_size += size
+
+    def end_postings(self):
+        """
+        Cierra las secciones de postings y posiciones y escribe los diccionarios de terminos.
+        """
+        if not self.writing_postings:
+            return
+        self.writing_postings = False
+        self.sections['postings'] = (self.post_start, self.fh.tell() - self.post_start)
+
+        start = self._align()
+        self.positions.seek(0)
+        shutil.copyfileobj(self.positions, self.fh)
+        self.positions.close()
+        self.sections['positions'] = (start, self.fh.tell() - start)
+
+        for name, records in self.terms.items():
+            records.sort()
+            keys = [record[0] for record in records]
+            self._add_sorted(name, keys, [TERM.pack(*record[1:]) for record in records])
+            if name.startswith('terms/'):
+                self.lexicon[name[len('terms/'):]] = keys
+        self.terms = {}
+
+    def _add_sorted(self, name, keys, records, values=b''):
+        """
+        Escribe una seccion con un diccionario ordenado.
+
+        param:  "name": nombre de la seccion
+                "keys": claves (bytes) ordenadas
+                "records": registro empaquetado de cada clave
+                "values": datos que siguen a las claves
+        """
+        offsets, data = _front_code(keys)
+        start = self._align()
+        self.fh.write(COUNT.pack(len(keys)))
+        for record in records:
+            self.fh.write(record)
+        self.fh.write(_to_bytes(offsets))
+        self.fh.write(data)
+        self.fh.write(values)
+        self.sections[name] = (start, self.fh.tell() - start)
+
+    def add_stems(self, field, stems):
+        """
+        Añade el indice de stems de un campo, con los terminos como ids del lexico del campo,
+        y el stem de cada termino ('stemids/<campo>').
+
+        param:  "field": campo del indice
+                "stems": objeto SAR_lexicon.Stems con el mismo lexico que 'terms/<campo>'
+        """
+        self.end_postings()
+        lexicon = self.lexicon.get(field, [])
+        if len(stems.terms) != len(lexicon):
+            raise ValueError('the stems of %r do not match the terms of the field' % field)
+        keys = []
+        records = []
+        values = array('i')
+        stem_ids = array('i', [-1]) * len(lexicon)
+        for stem_id, (stem, ids) in enumerate(stems.id_items()):
+            keys.append(stem.encode('utf-8'))
+            records.append(ENTRY.pack(len(values), len(ids)))
+            values.extend(ids)
+            for term_id in ids:
+                stem_ids[term_id] = stem_id
+        self._add_sorted('stems/' + field, keys, records, _to_bytes(values))
+        self.add_array('stemids/' + field, stem_ids)
+
+    def add_permuterms(self, field, permuterms):
+        """
+        Añade el indice permuterm de un campo.
+
+        param:  "field": campo del indice
+                "permuterms": objeto SAR_lexicon.Permuterms con el mismo lexico que 'terms/<campo>'
+        """
+        self.end_postings()
+        start = self._align()
+        self.fh.write(_to_bytes(array('i', permuterms.rotations)))
+        self.sections['permuterms/' + field] = (start, self.fh.tell() - start)
+
+    def add_news(self, news):
+        """
+        Añade la tabla de noticias.
+
+        param:  "news": SAR_tables.NewsTable
+        """
+        self.end_postings()
+        start = self._align()
+        for column in news.columns:
+            self.fh.write(_to_bytes(array('i', column)))
+        self.sections['news'] = (start, self.fh.tell() - start)
+
+    def add_docs(self, docs):
+        """
+        Añade la tabla de ficheros.
+
+        param:  "docs": tabla docid --> ruta del fichero, con docid de 0 a N - 1
+        """
+        self.end_postings()
+        paths = [docs[docid].encode('utf-8') for docid in range(len(docs))]
+        start = self._align()
+        self.fh.write(COUNT.pack(len(paths)))
+        self.fh.write(_to_bytes(array('i', accumulate((len(path) for path in paths), initial=0))))
+        for path in paths:
+            self.fh.write(path)
+        self.sections['docs'] = (start, self.fh.tell() - start)
+
+    def add_array(self, name, ints, typecode='i'):
+        """
+        Añade una seccion con un array de enteros.
+
+        param:  "name": nombre de la seccion
+                "ints": secuencia de enteros
+                "typecode": tipo de los enteros, como en array.array
+        """
+        self.end_postings()
+        start = self._align()
+        self.fh.write(_to_bytes(array(typecode, ints)))
+        self.sections[name] = (start, self.fh.tell() - start)
+
+    def close(self, config):
+        """
+        Escribe los metadatos y la cabecera y cierra el fichero.
+
+        param:  "config": diccionario con la configuracion del indice
+        """
+        self.end_postings()
+        meta = json.dumps({'version': VERSION, 'config': config, 'sections': self.sections,
+                           'block_size': BLOCK_SIZE}).encode('utf-8')
+        start = self._align()
+        self.fh.write(meta)
+        self.fh.seek(0)
+        self.fh.write(HEADER.pack(MAGIC, start, len(meta)))
+        self.fh.close()
+
+    def _align(self):
+        """
+        Rellena el fichero hasta un multiplo de 8 bytes y devuelve la posicion actual.
+        """
+        pad = -self.fh.tell() % 8
+        self.fh.write(b'\x00' * pad)
+        return self.fh.tell()
+
+
+def write_segment(project, filename):
+    """
+    Guarda un SAR_Project en formato de segmento.
+
+    param:  "project": indice a guardar
+            "filename": fichero de salida
+    """
+    writer = SegmentWriter(filename, project.news_counter, project.bitmap_threshold, project.weight['length'])
+    for name, tables in (('terms', project.index), ('stempostings', project.spindex)):
+        for field, table in tables.items():
+            if isinstance(table, TermTable):
+                table = UpdatedTable(table)
+            if isinstance(table, UpdatedTable):
+                # Posting lists read from a segment are copied as they are
+                table.write(writer, field, name)
+                continue
+            for term in sorted(table):
+                writer.add_posting(field, term, table[term], name)
+    finish_segment(writer, project)
+
+
+def finish_segment(writer, project):
+    """
+    Escribe las secciones que siguen a las posting lists (stems, permuterms, noticias y ficheros)
+    que no se hayan escrito ya y cierra el segmento.
+
+    param:  "writer": SegmentWriter con todas las posting lists ya añadidas
+            "project": indice a guardar
+    """
+    writer.end_postings()
+    # Tables already added by the caller are not written again
+    for field in project.sindex:
+        if project.stemming and 'stems/' + field not in writer.sections:
+            writer.add_stems(field, project.sindex[field])
+    for field in project.ptindex:
+        if project.permuterm and 'permuterms/' + field not in writer.sections:
+            writer.add_permuterms(field, project.ptindex[field])
+    writer.add_news(project.news)
+    writer.add_docs(project.docs)
+    stamps = [project.stamps.get(docid, (-1, -1)) for docid in range(len(project.docs))]
+    writer.add_array('stamps', [value for stamp in stamps for value in stamp], 'q')
+    writer.add_array('deleted', project.deleted)
+    writer.add_array('deleted_docs', sorted(project.deleted_docs))
+    for field, lengths in project.weight['length'].items():
+        writer.add_array('lengths/' + field, lengths)
+    writer.close({name: getattr(project, name, False) for name in CONFIG})
+
+
+class Segment:
+    """
+    Indice en formato de segmento abierto con mmap.
+
+    Solo se leen la cabecera y los metadatos, el resto del fichero se decodifica bajo demanda.
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, 'rb')
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_off, meta_len = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an index segment' % filename)
+        meta = json.loads(self.mm[meta_off:meta_off + meta_len].decode('utf-8'))
+        self.version = meta.get('version', 1)
+        self.config = meta['config']
+        self.sections = meta['sections']
+        # Segments written before the block maxima existed do not have them
+        self.block_size = meta.get('block_size')
+
+    def section(self, name):
+        """
+        param:  "name": nombre de la seccion
+
+        return: memoryview con el contenido de la seccion (vacio si no existe)
+        """
+        start, length = self.sections.get(name, (0, 0))
+        return memoryview(self.mm)[start:start + length]
+
+    def terms(self, field):
+        return TermTable(self, 'terms/' + field, self.config['positional'])
+
+    def stem_postings(self, field):
+        return TermTable(self, 'stempostings/' + field, False)
+
+    def lexicon(self, field):
+        """
+        return: secuencia id --> termino del campo
+        """
+        return KeyList(self.terms(field))
+
+    def stems(self, field):
+        return ListTable(self.section('stems/' + field), self.version, self.lexicon(field))
+
+    def stem_ids(self, field):
+        """
+        return: vista con el id del stem de cada termino del campo (vacia en segmentos anteriores)
+        """
+        return _int_view(self.section('stemids/' + field))
+
+    def permuterms(self, field):
+        if self.version == 1:
+            return ListTable(self.section('permuterms/' + field), self.version)
+        return Permuterms(self.lexicon(field), _int_view(self.section('permuterms/' + field)))
+
+    def news(self):
+        # The columns are views of the mapped file, one after the other
+        n = self.config['news_counter']
+        ints = _int_view(self.section('news'))
+        return NewsTable([ints[column * n:(column + 1) * n] for column in range(len(ints) // n if n else 0)])
+
+    def docs(self):
+        return DocsTable(self.section('docs'))
+
+    def array(self, name, typecode='i'):
+        """
+        param:  "name": nombre de una seccion escrita con SegmentWriter.add_array
+                "typecode": tipo de los enteros
+
+        return: copia de la seccion como array (vacio si no existe)
+        """
+        return _from_bytes(self.section(name), typecode)
+
+
+class _SortedTable:
+    """
+    Diccionario ordenado guardado en una seccion: numero de entradas, registros de tamaño fijo
+    y claves (ver el formato al principio del modulo).
+    """
+
+    # registro de cada version del formato
+    records = {1: ENTRY_V1, 2: ENTRY}
+
+    def __init__(self, buf, version=VERSION):
+        self.buf = buf
+        self.version = version
+        self.record = self.records[version]
+        self.n = COUNT.unpack_from(buf, 0)[0] if len(buf) else 0
+        end = COUNT.size + self.n * self.record.size
+        if version == 1:
+            # Version 1 records start with the offset and length of the key
+            self.keys_start = end
+        else:
+            self.keys_start = end + 4 * (-(-self.n // FRONT_BLOCK) + 1) if self.n else end
+            self.offsets = _from_bytes(buf[end:self.keys_start])
+        # ultimo bloque de claves decodificado, las busquedas acaban leyendo claves consecutivas
+        self.block = (-1, None)
+
+    def _record(self, i):
+        """
+        return: campos del registro i sin los de la clave
+        """
+        record = self.record.unpack_from(self.buf, COUNT.size + i * self.record.size)
+        return record[2:] if self.version == 1 else record
+
+    def _key(self, i):
+        if self.version == 1:
+            key_off, key_len = self.record.unpack_from(self.buf, COUNT.size + i * self.record.size)[:2]
+            start = self.keys_start + key_off
+            return bytes(self.buf[start:start + key_len])
+        return self._block(i // FRONT_BLOCK)[i % FRONT_BLOCK]
+
+    def _block(self, b):
+        """
+        return: lista con las claves (bytes) del bloque b
+        """
+        if self.block[0] != b:
+            pos = self.keys_start + self.offsets[b]
+            keys = []
+            key = b''
+            for _ in range(min(FRONT_BLOCK, self.n - b * FRONT_BLOCK)):
+                shared, length = KEY.unpack_from(self.buf, pos)
+                pos += KEY.size
+                key = key[:shared] + bytes(self.buf[pos:pos + length])
+                pos += length
+                keys.append(key)
+            self.block = (b, keys)
+        return self.block[1]
+
+    def _head(self, b):
+        """
+        return: primera clave (bytes) del bloque b, que esta completa
+        """
+        pos = self.keys_start + self.offsets[b]
+        length = KEY.unpack_from(self.buf, pos)[1]
+        return bytes(self.buf[pos + KEY.size:pos + KEY.size + length])
+
+    def _bisect(self, key):
+        """
+        Busqueda binaria de "key" (bytes) sobre el fichero mapeado.
+
+        return: indice del primer registro con clave mayor o igual que "key"
+        """
+        if self.version != 1:
+            # First over the heads of the blocks, then inside the block before the first greater head
+            b = bisect_left(range(len(self.offsets) - 1), key, key=self._head)
+            if b == 0:
+                return 0
+            return (b - 1) * FRONT_BLOCK + bisect_left(self._block(b - 1), key)
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key):
+        """
+        return: indice del registro con clave "key" (bytes), -1 si no esta
+        """
+        i = self._bisect(key)
+        if i < self.n and self._key(i) == key:
+            return i
+        return -1
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._find(key.encode('utf-8')) >= 0
+
+    def find(self, key):
+        """
+        return: posicion de "key" en la tabla (el id de un termino en su lexico), -1 si no esta
+        """
+        return self._find(key.encode('utf-8'))
+
+    def key(self, i):
+        """
+        return: clave en la posicion i
+        """
+        return self._key(i).decode('utf-8')
+
+    def __getitem__(self, key):
+        i = self._find(key.encode('utf-8'))
+        if i < 0:
+            raise KeyError(key)
+        return self._value(i)
+
+    def get(self, key, default=None):
+        i = self._find(key.encode('utf-8'))
+        return self._value(i) if i >= 0 else default
+
+    def keys(self):
+        return [key.decode('utf-8') for key in self._keys_bytes()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _value(self, i):
+        return self._decode(self._record(i))
+
+    def prefix_items(self, prefix):
+        """
+        Entradas cuya clave empieza por "prefix", con dos busquedas binarias.
+
+        param:  "prefix": cadena
+
+        return: generador de pares (clave, valor) en orden
+        """
+        key = prefix.encode('utf-8')
+        lo = self._bisect(key)
+        # Keys with the prefix are smaller than the prefix with its last byte incremented
+        # (UTF-8 never uses the byte 0xff)
+        hi = self._bisect(key[:-1] + bytes([key[-1] + 1])) if key else self.n
+        for i in range(lo, hi):
+            yield self._key(i).decode('utf-8'), self._value(i)
+
+    def _keys_bytes(self):
+        """
+        return: lista con todas las claves (bytes), decodificadas de una vez
+        """
+        keys = []
+        if self.version == 1:
+            data = bytes(self.buf[self.keys_start:])
+            for record in self.record.iter_unpack(self.buf[COUNT.size:self.keys_start]):
+                keys.append(data[record[0]:record[0] + record[1]])
+            return keys
+        data = bytes(self.buf[self.keys_start:self.keys_start + self.offsets[-1]]) if self.n else b''
+        pos = 0
+        key = b''
+        for _ in range(self.n):
+            shared, length = KEY.unpack_from(data, pos)
+            pos += KEY.size
+            key = key[:shared] + data[pos:pos + length]
+            pos += length
+            keys.append(key)
+        return keys
+
+    def _records(self):
+        """
+        return: generador con los campos del registro sin los de la clave de todas las entradas, en orden
+        """
+        end = COUNT.size + self.n * self.record.size
+        skip = 2 if self.version == 1 else 0
+        for record in self.record.iter_unpack(self.buf[COUNT.size:end]):
+            yield record[skip:]
+
+    def _entries(self):
+        """
+        return: generador de pares (clave, campos del registro sin los de la clave) de todas las entradas
+        """
+        return zip(self.keys(), self._records())
+
+    def items(self):
+        # All the records are unpacked at once, for materializing the whole table
+        for key, record in self._entries():
+            yield key, self._decode(record)
+
+
+class KeyList:
+    """
+    Claves de un diccionario ordenado como secuencia: posicion --> clave. Con la tabla de
+    terminos de un campo es su lexico, id --> termino.
+
+    Las busquedas en los permuterms acceden a ids dispersos, asi que en el primer acceso se
+    decodifican todas las claves de una vez en lugar de un bloque en cada acceso.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.keys = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        if self.keys is None:
+            self.keys = self.table.keys()
+        return self.keys[i]
+
+
+class TermTable(_SortedTable):
+    """
+    Diccionario de terminos de un campo: termino --> Posting, decodificada al acceder.
+    """
+
+    records = {1: TERM_V1, 2: TERM}
+
+    def __init__(self, segment, name, positional):
+        super().__init__(segment.section(name), segment.version)
+        self.postings = segment.section('postings')
+        self.positions = segment.section('positions')
+        self.positional = positional
+        self.total = segment.config['news_counter']
+        self.bitmap_threshold = segment.config.get('bitmap_threshold')
+        self.block_size = segment.block_size
+
+    def _decode(self, record):
+        df, post_off, pos_off = record
+        docids = _from_bytes(self.postings[post_off:post_off + 4 * df])
+        freqs = _from_bytes(self.postings[post_off + 4 * df:post_off + 8 * df])
+        end = post_off + 8 * df
+        maxima = None
+        if self.block_size:
+            blocks = -(-df // self.block_size)
+            if self.block_size == BLOCK_SIZE:
+                maxima = _from_bytes(self.postings[end:end + 8 * blocks])
+            end += 8 * blocks
+        bitmap = None
+        if is_dense(df, self.total, self.bitmap_threshold):
+            bitmap = Bitmap.from_buffer(self.postings, end)
+        if not self.positional:
+            return Posting(docids, freqs, bitmap=bitmap, maxima=maxima)
+        offsets = array('i', accumulate(freqs, initial=0))
+        positions = _from_bytes(self.positions[pos_off:pos_off + 4 * offsets[-1]])
+        return Posting(docids, freqs, positions, offsets, bitmap, maxima)
+
+
+class UpdatedTable:
+    """
+    Diccionario de terminos de un segmento con los cambios de una actualizacion: termino -->
+    Posting, con las posting lists que han cambiado (completas) en memoria y el resto leidas
+    del segmento. Asi una actualizacion solo decodifica las posting lists de los terminos de
+    los ficheros nuevos (ver SAR_Project.update_dir).
+    """
+
+    def __init__(self, table, keys=None):
+        """
+        param:  "table": TermTable del segmento
+                "keys": lista con las claves de la tabla ya decodificadas (el lexico del campo), para
+                        buscar los terminos con una biseccion sobre ella
+        """
+        self.table = table
+        self.lexicon = table.keys() if keys is None else keys
+        # termino --> Posting de los terminos cambiados
+        self.changed = {}
+        # terminos cambiados que no estan en el segmento
+        self.added = set()
+
+    def __len__(self):
+        return len(self.table) + len(self.added)
+
+    def _find(self, term):
+        """
+        return: posicion del termino en el segmento, -1 si no esta
+        """
+        i = bisect_left(self.lexicon, term)
+        return i if i < len(self.lexicon) and self.lexicon[i] == term else -1
+
+    def __contains__(self, term):
+        return term in self.changed or self._find(term) >= 0
+
+    def __getitem__(self, term):
+        posting = self.get(term)
+        if posting is None:
+            raise KeyError(term)
+        return posting
+
+    def get(self, term, default=None):
+        posting = self.changed.get(term)
+        if posting is None:
+            i = self._find(term)
+            return self.table._value(i) if i >= 0 else default
+        return posting
+
+    def __setitem__(self, term, posting):
+        if term not in self.changed and self._find(term) < 0:
+            self.added.add(term)
+        self.changed[term] = posting
+
+    def _entries(self):
+        """
+        return: generador de pares (termino, registro en el segmento o None si es nuevo) en orden
+        """
+        return heapq.merge(zip(self.lexicon, self.table._records()), ((term, None) for term in sorted(self.added)),
+                           key=itemgetter(0))
+
+    def keys(self):
+        return [term for term, _ in self._entries()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        for term, record in self._entries():
+            posting = self.changed.get(term)
+            yield term, self.table._decode(record) if posting is None else posting
+
+    def values(self):
+        for _, posting in self.items():
+            yield posting
+
+    def postings_count(self):
+        """
+        return: numero de postings de todos los terminos, con el df de los registros del segmento
+        """
+        return sum(len(self.changed[term]) if term in self.changed else record[0]
+                   for term, record in self._entries())
+
+    def write(self, writer, field, name='terms'):
+        """
+        Añade las posting lists a un SegmentWriter: las cambiadas se codifican y las demas se
+        copian del segmento.
+
+        param:  "writer": SegmentWriter
+                "field": campo del indice
+                "name": como "table" en SegmentWriter.add_posting
+        """
+        for changed, entries in groupby(self._entries(), key=lambda entry: entry[0] in self.changed):
+            if not changed:
+                writer.copy_postings(field, self.table, entries, name)
+                continue
+            for term, _ in entries:
+                writer.add_posting(field, term, self.changed[term], name)
+
+
+class ListTable(_SortedTable):
+    """
+    Diccionario clave --> lista de terminos (stems; y permuterms en la version 1).
+
+    Los valores son ids del lexico del campo (en la version 1, cadenas separadas por SEPARATOR).
+    keys() decodifica todas las claves, se guardan la primera vez que se piden.
+    """
+
+    def __init__(self, buf, version=VERSION, lexicon=None):
+        """
+        param:  "buf": seccion con la tabla
+                "version": version del formato del segmento
+                "lexicon": secuencia id --> termino con la que decodificar los valores
+        """
+        super().__init__(buf, version)
+        self.lexicon = lexicon
+        if not self.n:
+            self.values_start = self.keys_start
+        elif version == 1:
+            key_off, key_len = self.record.unpack_from(buf, COUNT.size + (self.n - 1) * self.record.size)[:2]
+            self.values_start = self.keys_start + key_off + key_len
+        else:
+            self.values_start = self.keys_start + self.offsets[-1]
+        self._keys = None
+
+    def _decode(self, record):
+        val_off, val_len = record
+        if self.version == 1:
+            start = self.values_start + val_off
+            return bytes(self.buf[start:start + val_len]).decode('utf-8').split(SEPARATOR)
+        return [self.lexicon[term_id] for term_id in self._ids(record)]
+
+    def _ids(self, record):
+        """
+        return: array con los ids de los terminos del valor (version 2)
+        """
+        val_off, val_len = record
+        start = self.values_start + 4 * val_off
+        return _from_bytes(self.buf[start:start + 4 * val_len])
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = super().keys()
+        return self._keys
+
+    def id_items(self):
+        """
+        return: generador de pares (clave, array con los ids de sus terminos), sin decodificar los
+                terminos (solo en la version 2)
+        """
+        for key, record in self._entries():
+            yield key, self._ids(record)
+
+
+class DocsTable:
+    """
+    Tabla de ficheros: docid --> ruta.
+    """
+
+    def __init__(self, buf):
+        self.n = COUNT.unpack_from(buf, 0)[0] if len(buf) else 0
+        self.buf = buf
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, docid):
+        return 0 <= docid < self.n
+
+    def __getitem__(self, docid):
+        if not 0 <= docid < self.n:
+            raise KeyError(docid)
+        start, end = struct.unpack_from('<II', self.buf, COUNT.size + 4 * docid)
+        base = COUNT.size + 4 * (self.n + 1)
+        return bytes(self.buf[base + start:base + end]).decode('utf-8')
+
+    def keys(self):
+        return range(self.n)
+
+    def __iter__(self):
+        return iter(range(self.n))
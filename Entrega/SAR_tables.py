@@ -0,0 +1,121 @@
+import os
+from array import array
+
+# Tablas de noticias y de ficheros. Los newid y docid son consecutivos desde 0, asi que no se
+# guardan: la posicion en la tabla es el id y el conjunto de todas las noticias es range(N).
+
+# columnas de la tabla de noticias: docid, posicion en el fichero, offset y longitud en bytes
+NEWS_COLUMNS = 4
+
+
+class NewsTable:
+    """
+    Tabla de noticias por columnas: newid --> [docid, posicion dentro del fichero, offset, longitud].
+
+    Cada columna es un array de enteros (o una vista de un segmento), 4 bytes por noticia y columna.
+    Los indices creados antes de guardar los offsets solo tienen las dos primeras columnas.
+    """
+
+    def __init__(self, columns=None):
+        """
+        param:  "columns": secuencias de enteros de la misma longitud, por defecto NEWS_COLUMNS arrays vacios
+        """
+        self.columns = columns if columns is not None else [array('i') for _ in range(NEWS_COLUMNS)]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        param:  "rows": lista de noticias, cada una una lista con el valor de cada columna
+
+        return: tabla con esas noticias
+        """
+        columns = [array('i') for _ in range(len(rows[0]) if rows else NEWS_COLUMNS)]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        return cls(columns)
+
+    @property
+    def docids(self):
+        """
+        return: columna de los docid, ordenada (las noticias se numeran fichero a fichero)
+        """
+        return self.columns[0]
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __contains__(self, new):
+        return 0 <= new < len(self)
+
+    def __getitem__(self, new):
+        if not 0 <= new < len(self):
+            raise KeyError(new)
+        return [column[new] for column in self.columns]
+
+    def keys(self):
+        return range(len(self))
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def append(self, row):
+        """
+        Añade una noticia al final de la tabla.
+
+        param:  "row": lista con el valor de cada columna
+        """
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+
+class PathTable:
+    """
+    Tabla de ficheros: docid --> ruta.
+
+    Las rutas se guardan separadas en directorio y nombre del fichero; cada directorio se guarda
+    una sola vez y cada fichero tiene el indice de su directorio en un array.
+    """
+
+    def __init__(self, paths=()):
+        """
+        param:  "paths": rutas de los ficheros, en orden de docid
+        """
+        self.dirs = []
+        self.dir_ids = {}
+        self.path_dirs = array('i')
+        self.names = []
+        for path in paths:
+            self.append(path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, docid):
+        return 0 <= docid < len(self)
+
+    def __getitem__(self, docid):
+        if not 0 <= docid < len(self):
+            raise KeyError(docid)
+        return self.dirs[self.path_dirs[docid]] + self.names[docid]
+
+    def keys(self):
+        return range(len(self))
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def append(self, path):
+        """
+        Añade un fichero al final de la tabla.
+
+        param:  "path": ruta del fichero
+        """
+        # The directory keeps its trailing separator, so the path is rebuilt exactly as it was given
+        split = max(path.rfind(os.sep), path.rfind('/')) + 1
+        directory = path[:split]
+        if directory not in self.dir_ids:
+            self.dir_ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        self.path_dirs.append(self.dir_ids[directory])
+        self.names.append(path[split:])
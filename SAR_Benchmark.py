@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from urllib.parse import urlencode
+
+from SAR_lib import SAR_Project, split_news
+from SAR_Searcher import percentile
+
+# modos de indexacion por defecto de "suite": letras de las opciones de SAR_Indexer.py
+MODES = ['basic', 'M', 'S', 'P', 'O', 'SP', 'MO', 'SPMO']
+
+QUERY_FILES = ['references/queries_minimo.txt', 'references/queries_full.txt']
+
+# lineas de la salida de SAR_Indexer.py con los tiempos y la memoria
+_INDEXER_TIME = re.compile(r'Time (indexing|saving): ([\d.]+)s\.')
+_INDEXER_PHASE = re.compile(r'    (.+): ([\d.]+)s\.')
+_INDEXER_MEMORY = re.compile(r'Peak memory: ([\d.]+) MB\.')
+_FIELD = re.compile(r'(?:^|[\s(])[^\W\d_]+:')
+
+
+def read_queries(filename):
+    """
+    Lee un fichero de consultas (una por linea, con o sin el numero de resultados de referencia).
+    """
+    queries = []
+    with open(filename, encoding='utf-8') as fh:
+        for line in fh:
+            query = line.rstrip('\n').split('\t')[0]
+            if query and not query.startswith('#'):
+                queries.append(query)
+    return queries
+
+
+def query_class(query):
+    """
+    Clasifica una consulta segun la ampliacion que necesita; si usa varias, la mas costosa.
+
+    return: 'phrase', 'wildcard', 'multifield', 'parentheses' o 'plain'
+    """
+    if '"' in query or 'NEAR/' in query:
+        return 'phrase'
+    if '*' in query or '?' in query:
+        return 'wildcard'
+    if _FIELD.search(query):
+        return 'multifield'
+    if '(' in query:
+        return 'parentheses'
+    return 'plain'
+
+
+def summarize(latencies):
+    """
+    param:  "latencies": segundos de cada consulta
+
+    return: diccionario con el numero de consultas y el tiempo total, medio y percentiles en ms
+    """
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return {'queries': n, 'total_ms': sum(latencies) * 1000, 'mean_ms': sum(latencies) / n * 1000,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def replay(index, query_files, modes):
+    """
+    Repite las consultas de unos ficheros sobre un indice en cada modo de salida, sin mostrar nada.
+
+    Las consultas se agrupan por clase (ver query_class); si el indice tiene stems se repiten
+    tambien con stemming, en la clase 'stemming'. La cache de consultas se desactiva para medir
+    cada consulta completa.
+
+    param:  "index": fichero con el indice
+            "query_files": ficheros de consultas
+            "modes": modos de salida: 'count', 'show' y/o 'snippet'
+
+    return: diccionario fichero --> modo --> clase --> resumen de los tiempos (ver summarize)
+    """
+    searcher = SAR_Project.load(index)
+    searcher.set_cache(0)
+    report = {}
+    for filename in query_files:
+        queries = read_queries(filename)
+        report[filename] = {}
+        for mode in modes:
+            searcher.set_snippet(mode == 'snippet')
+            solve = searcher.solve_and_count if mode == 'count' else searcher.solve_and_show
+            latencies = {}
+            errors = {}
+            for stem in ([False, True] if searcher.stemming else [False]):
+                searcher.set_stemming(stem)
+                for query in queries:
+                    kind = 'stemming' if stem else query_class(query)
+                    t0 = time.perf_counter()
+                    try:
+                        with redirect_stdout(io.StringIO()):
+                            solve(query)
+                    except Exception:
+                        # Queries not supported by the index, e.g. phrases without positions
+                        errors[kind] = errors.get(kind, 0) + 1
+                        continue
+                    latencies.setdefault(kind, []).append(time.perf_counter() - t0)
+            report[filename][mode] = {kind: dict(summarize(times), errors=errors.get(kind, 0))
+                                      for kind, times in latencies.items()}
+            for kind in errors.keys() - latencies.keys():
+                report[filename][mode][kind] = {'queries': 0, 'errors': errors[kind]}
+    return report
+
+
+def build_index(corpus, filename, flags):
+    """
+    Indexa un corpus con SAR_Indexer.py en otro proceso, para medir su memoria por separado.
+
+    param:  "corpus": directorio con las noticias
+            "filename": fichero del indice
+            "flags": opciones de SAR_Indexer.py
+
+    return: diccionario con los tiempos, las fases, el tamaño del indice y la memoria maxima
+    """
+    indexer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SAR_Indexer.py')
+    t0 = time.perf_counter()
+    output = subprocess.run([sys.executable, indexer, corpus, filename] + flags, check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    res = {'flags': ' '.join(flags), 'wall_s': time.perf_counter() - t0, 'phases': {}}
+    for line in output.splitlines():
+        if _INDEXER_TIME.match(line):
+            phase, seconds = _INDEXER_TIME.match(line).groups()
+            res[phase + '_s'] = float(seconds)
+        elif _INDEXER_PHASE.match(line):
+            phase, seconds = _INDEXER_PHASE.match(line).groups()
+            res['phases'][phase] = float(seconds)
+        elif _INDEXER_MEMORY.match(line):
+            res['peak_rss_mb'] = float(_INDEXER_MEMORY.match(line).group(1))
+    res['size_mb'] = os.path.getsize(filename) / 2 ** 20
+    return res
+
+
+def environment():
+    """
+    return: diccionario con la version del codigo (commit de git si lo hay), de Python y la fecha
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit or None, 'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def write_report(report, filename):
+    """
+    Guarda un informe en JSON, o lo muestra si "filename" es None.
+    """
+    if filename is None:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    with open(filename, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2, ensure_ascii=False)
+
+
+def bench_suite(args):
+    """
+    Indexa el corpus en cada modo y repite las consultas de referencia sobre cada indice.
+    """
+    os.makedirs(args.workdir, exist_ok=True)
+    report = dict(environment(), corpus=args.corpus, modes={})
+    for mode in args.modes:
+        flags = [] if mode == 'basic' else ['-' + letter for letter in mode]
+        filename = os.path.join(args.workdir, 'bench_%s.idx' % mode)
+        print('indexing %s...' % mode, file=sys.stderr)
+        report['modes'][mode] = build_index(args.corpus, filename, flags + args.indexer_args.split())
+        if args.search:
+            print('searching %s...' % mode, file=sys.stderr)
+            report['modes'][mode]['search'] = replay(filename, args.queries, args.output_modes)
+        if not args.keep:
+            os.remove(filename)
+    write_report(report, args.report)
+
+
+def bench_search(args):
+    """
+    Repite las consultas de referencia sobre un indice ya construido.
+    """
+    report = dict(environment(), index=args.index, search=replay(args.index, args.queries, args.output_modes))
+    write_report(report, args.report)
+
+
+async def http_get(reader, writer, host, target):
+    """
+    Hace una peticion GET en una conexion abierta (keep-alive) y lee la respuesta.
+
+    return: par (codigo HTTP, cuerpo de la respuesta)
+    """
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (target, host)).encode('latin-1'))
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    length = 0
+    for line in head[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return int(head[0].split()[1]), await reader.readexactly(length)
+
+
+async def load_level(args, targets, concurrency):
+    """
+    Envia las peticiones de "targets" con "concurrency" clientes, cada uno con su conexion.
+
+    return: diccionario con las peticiones por segundo, los percentiles de la latencia y los codigos HTTP
+    """
+    pending = iter(targets)
+    latencies = []
+    statuses = {}
+
+    async def client():
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        try:
+            for target in pending:
+                t0 = time.perf_counter()
+                status, _ = await http_get(reader, writer, args.host, target)
+                latencies.append(time.perf_counter() - t0)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    return dict(summarize(latencies), concurrency=concurrency, elapsed_s=elapsed,
+                qps=len(latencies) / elapsed if elapsed else 0,
+                status={str(status): n for status, n in sorted(statuses.items())})
+
+
+def bench_load(args):
+    """
+    Prueba de carga de un SAR_Server.py en marcha: envia las consultas con cada nivel de concurrencia
+    y muestra las peticiones por segundo y los percentiles de la latencia de cada nivel.
+    """
+    queries = [query for filename in args.queries for query in read_queries(filename)]
+    params = {name: 1 for name in ('stem', 'rank', 'snippet') if getattr(args, name)}
+    targets = ['/search?' + urlencode(dict(params, q=query)) for query in queries]
+    # The same requests are sent at every level, repeated up to args.requests
+    targets = (targets * (args.requests // len(targets) + 1))[:args.requests] if args.requests else targets
+    # One round to warm up the caches of the server processes
+    asyncio.run(load_level(args, targets[:len(queries)], 1))
+    levels = []
+    for concurrency in args.concurrency:
+        level = asyncio.run(load_level(args, targets, concurrency))
+        print('concurrency %3d: %5d requests, %7.1f requests/s, p50 %7.2f ms, p95 %7.2f ms, p99 %7.2f ms, status %s' %
+              (concurrency, level['queries'], level['qps'], level['p50_ms'], level['p95_ms'], level['p99_ms'],
+               ' '.join('%s:%d' % item for item in level['status'].items())), file=sys.stderr)
+        levels.append(level)
+    write_report(dict(environment(), server='http://%s:%d/' % (args.host, args.port), levels=levels), args.report)
+
+
+def span_text(tokens, length, rng):
+    """
+    Genera un texto sintetico de "length" tokens concatenando fragmentos de textos reales,
+    que conservan la distribucion del vocabulario y las frases cortas del corpus original.
+
+    param:  "tokens": listas de tokens de los textos reales de un campo
+            "length": numero de tokens
+            "rng": random.Random
+    """
+    res = []
+    while len(res) < length:
+        source = rng.choice(tokens)
+        if not source:
+            break
+        size = min(rng.randint(5, 30), length - len(res), len(source))
+        start = rng.randrange(len(source) - size + 1)
+        res.extend(source[start:start + size])
+    return ' '.join(res)
+
+
+def bench_corpus(args):
+    """
+    Genera un corpus sintetico "scale" veces mayor que uno real: cada fichero del original se
+    replica "scale" veces con noticias nuevas del mismo numero y longitud, con la fecha de la
+    noticia original y los campos de texto generados con span_text.
+    """
+    rng = random.Random(args.seed)
+    files = []
+    tokens = {}
+    for dirpath, _, filenames in os.walk(args.source):
+        for name in sorted(filenames):
+            if name.endswith('.json'):
+                fullname = os.path.join(dirpath, name)
+                with open(fullname, 'rb') as fh:
+                    news = [new for new, _, _ in split_news(fh.read())]
+                files.append((os.path.relpath(fullname, args.source), news))
+                for new in news:
+                    for field, text in new.items():
+                        if field != 'date':
+                            tokens.setdefault(field, []).append(text.split())
+    total = 0
+    for relname, news in sorted(files):
+        for copy in range(args.scale):
+            base, ext = os.path.splitext(os.path.join(args.target, relname))
+            os.makedirs(os.path.dirname(base), exist_ok=True)
+            generated = []
+            for new in news:
+                generated.append({field: text if field == 'date' else span_text(tokens[field], len(text.split()), rng)
+                                  for field, text in new.items()})
+            with open('%s_%d%s' % (base, copy, ext), 'w', encoding='utf-8') as fh:
+                json.dump(generated, fh, ensure_ascii=False)
+            total += len(generated)
+    print('%d files, %d news written to %s.' % (len(files) * args.scale, total, args.target))
+
+
+def bench_ranking(args):
+    """
+    Compara el ranking exhaustivo con MaxScore: noticias puntuadas y tiempo por consulta.
+    """
+    searcher = SAR_Project.load(args.index)
+    searcher.set_stemming(args.stem)
+    searcher.SHOW_MAX = args.k
+
+    totals = {False: [0, 0.0], True: [0, 0.0]}
+    print('query\tresults\tscored (exhaustive)\tscored (maxscore)\tms (exhaustive)\tms (maxscore)')
+    for query in read_queries(args.queries):
+        try:
+            result = searcher.solve_query(query)
+        except Exception as e:
+            print('%s\tERROR %s' % (query, e))
+            continue
+        ranked = {}
+        row = [query, str(len(result))]
+        for pruning in (False, True):
+            searcher.set_pruning(pruning)
+            t0 = time.perf_counter()
+            ranked[pruning] = searcher.rank_result(result, query)
+            elapsed = time.perf_counter() - t0
+            totals[pruning][0] += searcher.scored
+            totals[pruning][1] += elapsed
+            row.insert(2 + pruning, str(searcher.scored))
+            row.append('%.3f' % (elapsed * 1000))
+        if ranked[False] != ranked[True]:
+            print('==> ERROR: different ranking for %r' % query)
+            sys.exit(-1)
+        print('\t'.join(row))
+    print('TOTAL\t\t%d\t%d\t%.3f\t%.3f' % (totals[False][0], totals[True][0],
+                                            totals[False][1] * 1000, totals[True][1] * 1000))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the indexer and the searcher.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ranking = subparsers.add_parser('ranking', help='documents scored by the ranking with and without MaxScore.')
+    ranking.add_argument('index', metavar='index', type=str,
+                         help='name of the file with the index object.')
+    ranking.add_argument('-Q', '--queries', dest='queries', metavar='file', type=str,
+                         default='references/queries_full.txt',
+                         help='file with the queries (default references/queries_full.txt).')
+    ranking.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                         help='use stem index by default.')
+    ranking.add_argument('-k', dest='k', metavar='k', type=int, default=SAR_Project.SHOW_MAX,
+                         help='number of ranked results (default %d).' % SAR_Project.SHOW_MAX)
+    ranking.set_defaults(run=bench_ranking)
+
+    output_modes = ['count', 'show', 'snippet']
+
+    suite = subparsers.add_parser('suite', help='index a corpus in several modes and replay the reference queries on each index.')
+    suite.add_argument('corpus', metavar='newsdir', type=str,
+                       help='directory with the news.')
+    suite.add_argument('-m', '--modes', dest='modes', metavar='mode', nargs='+', default=MODES,
+                       help='indexing modes, letters of the SAR_Indexer.py options or "basic" (default %s).' % ' '.join(MODES))
+    suite.add_argument('-a', '--indexer-args', dest='indexer_args', metavar='args', type=str, default='',
+                       help='extra options for SAR_Indexer.py in every mode, e.g. "-F pickle".')
+    suite.add_argument('-w', '--workdir', dest='workdir', metavar='dir', type=str, default='.',
+                       help='directory for the indexes (default the current one).')
+    suite.add_argument('-k', '--keep', dest='keep', action='store_true', default=False,
+                       help='keep the indexes when done.')
+    suite.add_argument('-n', '--no-search', dest='search', action='store_false', default=True,
+                       help='only index, do not replay the queries.')
+
+    search = subparsers.add_parser('search', help='replay the reference queries on an index.')
+    search.add_argument('index', metavar='index', type=str,
+                        help='name of the file with the index object.')
+
+    for command in (suite, search):
+        command.add_argument('-Q', '--queries', dest='queries', metavar='file', nargs='+', default=QUERY_FILES,
+                             help='files with the queries (default %s).' % ' '.join(QUERY_FILES))
+        command.add_argument('-o', '--output-modes', dest='output_modes', metavar='mode', nargs='+',
+                             choices=output_modes, default=output_modes,
+                             help='ways of showing the results that are measured (default %s).' % ' '.join(output_modes))
+        command.add_argument('-r', '--report', dest='report', metavar='file', type=str, default=None,
+                             help='JSON file for the report (default standard output).')
+    suite.set_defaults(run=bench_suite)
+    search.set_defaults(run=bench_search)
+
+    corpus = subparsers.add_parser('corpus', help='generate a synthetic corpus several times larger than a real one.')
+    corpus.add_argument('source', metavar='newsdir', type=str,
+                        help='directory with the real news.')
+    corpus.add_argument('target', metavar='outdir', type=str,
+                        help='directory for the generated news.')
+    corpus.add_argument('-x', '--scale', dest='scale', metavar='n', type=int, default=10,
+                        help='number of generated news per real news (default 10).')
+    corpus.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='seed of the generator (default 0).')
+    corpus.set_defaults(run=bench_corpus)
+
+    load = subparsers.add_parser('load', help='load test of a running SAR_Server.py at increasing concurrency.')
+    load.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                      help='address of the server (default 127.0.0.1).')
+    load.add_argument('-p', '--port', dest='port', type=int, default=8080,
+                      help='port of the server (default 8080).')
+    load.add_argument('-Q', '--queries', dest='queries', metavar='file', nargs='+', default=QUERY_FILES,
+                      help='files with the queries (default %s).' % ' '.join(QUERY_FILES))
+    load.add_argument('-c', '--concurrency', dest='concurrency', metavar='N', type=int, nargs='+',
+                      default=[1, 2, 4, 8, 16, 32],
+                      help='numbers of concurrent clients, one level after another (default 1 2 4 8 16 32).')
+    load.add_argument('-n', '--requests', dest='requests', metavar='N', type=int, default=None,
+                      help='requests sent at each level, repeating the queries (default each query once).')
+    load.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                      help='ask for stemming in every request.')
+    load.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                      help='ask for ranked results in every request.')
+    load.add_argument('-N', '--snippet', dest='snippet', action='store_true', default=False,
+                      help='ask for snippets in every request.')
+    load.add_argument('-r', '--report', dest='report', metavar='file', type=str, default=None,
+                      help='JSON file for the report (default standard output).')
+    load.set_defaults(run=bench_load)
+
+    args = parser.parse_args()
+    args.run(args)
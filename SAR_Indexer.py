@@ -1,9 +1,13 @@
 import argparse
-import pickle
-import sys
 import time
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 from SAR_lib import SAR_Project
+from SAR_segment import is_segment
 
 
 if __name__ == "__main__":
@@ -19,6 +23,9 @@ if __name__ == "__main__":
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
                         help='compute stem index.')
 
+    parser.add_argument('-E', '--stem-postings', dest='stem_postings', action='store_true', default=False,
+                        help='also store the merged posting list of every stem with several terms, so stemmed searches are a single lookup (requires -S).')
+
     parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
                         help='compute permuterm index.')
 
@@ -28,19 +35,69 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False,
                         help='compute positional index.')
 
+    parser.add_argument('-C', '--compact', dest='compact', action='store_true', default=False,
+                        help='store the posting lists as compact sorted arrays.')
+
+    parser.add_argument('-B', '--bitmap-threshold', dest='bitmap_threshold', metavar='ratio', type=float, default=None,
+                        help='also store as bitmaps the posting lists of terms present in at least ratio * number of news (compact and segment indexes).')
+
+    parser.add_argument('-J', '--jobs', dest='jobs', metavar='N', type=int, default=1,
+                        help='number of processes used to index the news.')
+
+    parser.add_argument('-X', '--memory', dest='memory', metavar='MB', type=int, default=None,
+                        help='index in blocks of about MB megabytes that are merged on disk (segment format only).')
+
+    parser.add_argument('-F', '--format', dest='format', choices=['segment', 'pickle'], default=None,
+                        help='format of the index file: binary segment (default) or pickle. With -U and -Z the default is the format of the existing index.')
+
+    parser.add_argument('-U', '--update', dest='update', action='store_true', default=False,
+                        help='update the existing index with the new, modified and deleted files of newsdir (the index options are taken from the index).')
+
+    parser.add_argument('-Z', '--purge', dest='purge', action='store_true', default=False,
+                        help='rewrite the existing index without its deleted news (after the update if used with -U, otherwise newsdir is not read).')
+
     args = parser.parse_args()
+    if args.memory and args.format == 'pickle':
+        parser.error('--memory requires the segment format')
+    if args.stem_postings and not args.stem:
+        parser.error('--stem-postings requires --stem')
+    if args.stem_postings and args.memory:
+        parser.error('--stem-postings and --memory can not be used together')
+    if args.memory and args.jobs > 1:
+        parser.error('--memory and --jobs can not be used together')
 
     newsdir = args.newsdir
     indexfile = args.index
 
-    indexer = SAR_Project()
     t0 = time.time()
-    indexer.index_dir(newsdir, **vars(args))
+    if args.update or args.purge:
+        if args.format is None:
+            args.format = 'segment' if is_segment(indexfile) else 'pickle'
+        indexer = SAR_Project.load(indexfile)
+        if args.update:
+            print("Files added: %d, modified: %d, deleted: %d." % indexer.update_dir(newsdir))
+        if args.purge:
+            indexer.purge()
+    else:
+        if args.format is None:
+            args.format = 'segment'
+        indexer = SAR_Project()
+        indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
-        pickle.dump(indexer, fh)
+    indexer.save(indexfile, args.format)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
+    if indexer.timings.get('inverting'):
+        print("Tokens: %d, %.0f tokens/s." % (indexer.tokens, indexer.tokens / indexer.timings['inverting']))
+    if indexer.stem_postings:
+        lists, stems, terms = indexer.stem_postings_size()
+        # docid and frequency of every posting are two int32
+        print("Stem postings: %d lists, %d postings, %.1f MB (+%.1f%% postings)." %
+              (lists, stems, stems * 8 / 2 ** 20, 100 * stems / max(terms, 1)))
+    for phase, seconds in indexer.timings.items():
+        print("    %s: %2.2fs." % (phase, seconds))
+    if resource is not None:
+        print("Peak memory: %.1f MB." % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
     print()
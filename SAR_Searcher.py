@@ -2,10 +2,18 @@
 
 
 import argparse
-import pickle
+import io
+import math
+import multiprocessing
 import sys
+import time
+from contextlib import redirect_stdout
 
 from SAR_lib import SAR_Project
+from SAR_profile import Profiler
+
+# indice cargado, compartido con los procesos del pool (ver run_batch)
+searcher = None
 
 
 def syntax():
@@ -14,6 +22,106 @@ def syntax():
     sys.exit()
 
 
+def load_searcher(args):
+    """
+    Carga el indice y lo configura con las opciones de la linea de comandos.
+    """
+    global searcher
+    searcher = SAR_Project.load(args.index)
+    searcher.set_stemming(args.stem)
+    searcher.set_ranking(args.rank)
+    searcher.set_showall(args.all)
+    searcher.set_snippet(args.snippet)
+    searcher.set_explain(args.explain)
+    searcher.set_cache(args.cache)
+    return searcher
+
+
+def solve(method, query):
+    """
+    Resuelve una consulta; si no es valida muestra el error y no detiene la busqueda.
+
+    param:  "method": metodo de SAR_Project que resuelve la consulta
+            "query": consulta
+
+    return: lo que devuelve "method", 0 (ninguna noticia) si la consulta no es valida
+    """
+    try:
+        return method(query)
+    except ValueError as err:
+        print('%s\tERROR: %s' % (query, err))
+        return 0
+
+
+def run_query(job):
+    """
+    Resuelve una consulta de un fichero capturando lo que escribe, para mostrarlo en orden.
+
+    param:  "job": par (metodo de SAR_Project, consulta)
+
+    return: tupla (salida, valor devuelto, segundos, aciertos y fallos de la cache de consultas)
+    """
+    method, query = job
+    hits, misses = searcher.cache_hits, searcher.cache_misses
+    out = io.StringIO()
+    t0 = time.perf_counter()
+    with redirect_stdout(out):
+        result = solve(getattr(searcher, method), query)
+    seconds = time.perf_counter() - t0
+    return out.getvalue(), result, seconds, searcher.cache_hits - hits, searcher.cache_misses - misses
+
+
+def run_batch(args, jobs):
+    """
+    Resuelve las consultas de un fichero, en "args.jobs" procesos si es mayor que 1.
+
+    Con fork los procesos heredan el indice ya cargado (un segmento se comparte via mmap), sin
+    volver a leerlo; si el sistema no tiene fork cada proceso lo carga al arrancar.
+
+    param:  "args": opciones de la linea de comandos
+            "jobs": lista de pares (metodo de SAR_Project, consulta)
+
+    return: generador de los resultados de run_query, en el orden de "jobs"
+    """
+    if args.jobs <= 1:
+        yield from map(run_query, jobs)
+        return
+    if 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    else:
+        pool = multiprocessing.Pool(args.jobs, initializer=load_searcher, initargs=(args,))
+    with pool:
+        for output, result, seconds, hits, misses in pool.imap(run_query, jobs, chunksize=8):
+            searcher.cache_hits += hits
+            searcher.cache_misses += misses
+            yield output, result, seconds, hits, misses
+
+
+def percentile(values, p):
+    """
+    param:  "values": lista ordenada
+            "p": percentil (0-100)
+
+    return: el percentil "p" de "values" (nearest-rank)
+    """
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def show_throughput(latencies, elapsed):
+    """
+    Muestra las consultas por segundo y los percentiles de la latencia de un fichero de consultas.
+
+    param:  "latencies": segundos de cada consulta
+            "elapsed": segundos de todo el fichero
+    """
+    if not latencies:
+        return
+    latencies = sorted(latencies)
+    print('Queries: %d in %.2fs, %.1f queries/s. Latency p50: %.2f ms, p95: %.2f ms, p99: %.2f ms.' %
+          (len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0,
+           percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000))
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Search the index.')
@@ -38,6 +146,15 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
                         help='rank results. Does not apply with -C and -T options.')
 
+    parser.add_argument('-E', '--explain', dest='explain', action='store_true', default=False,
+                        help='show the evaluation plan of each query with its estimated cost.')
+
+    parser.add_argument('-K', '--cache', dest='cache', metavar='N', type=int, default=SAR_Project.QUERY_CACHE,
+                        help='size of the cache of query and subquery results, in news ids (default %d, 0 disables it).' % SAR_Project.QUERY_CACHE)
+
+    parser.add_argument('-H', '--cache-stats', dest='cache_stats', action='store_true', default=False,
+                        help='show the hits and misses of the query cache at the end.')
+
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar='query', type=str, action='store',
                         help='query.')
@@ -46,57 +163,92 @@ if __name__ == "__main__":
     group1.add_argument('-T', '--test', dest='test', metavar='test', type=str, action='store',
                         help='file with queries and results, for testing.')
 
+    parser.add_argument('-J', '--jobs', dest='jobs', metavar='N', type=int, default=1,
+                        help='number of processes used to solve the queries of -L and -T files.')
+
+    parser.add_argument('-P', '--profile', dest='profile', action='store_true', default=False,
+                        help='measure the phases of every query and show a summary at the end.')
+
+    parser.add_argument('-W', '--trace', dest='trace', metavar='file', type=str, default=None,
+                        help='write the measures of every query to file, one JSON object per line (implies -P).')
+
     args = parser.parse_args()
+    if (args.profile or args.trace) and args.jobs > 1:
+        parser.error('--profile and --trace can not be used with --jobs')
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    load_searcher(args)
 
-    searcher.set_stemming(args.stem)
-    searcher.set_ranking(args.rank)
-    searcher.set_showall(args.all)
-    searcher.set_snippet(args.snippet)
+    profiler = None
+    if args.profile or args.trace:
+        profiler = Profiler(open(args.trace, 'w', encoding='utf-8') if args.trace else None)
+        profiler.install(searcher)
 
     # se debe contar o mostrar resultados?
     if args.count is True:
         fnc = searcher.solve_and_count
     else:
         fnc = searcher.solve_and_show
+    method = 'solve_and_count' if args.count else 'solve_and_show'
 
     if args.test is not None:
         # opt: -T, testing
 
         with open(args.test, encoding='utf-8') as fh:
             lines = fh.read().split('\n')
-            for line in lines:
-                if len(line) > 0 and not line.startswith('#'):
-                    query, reference = line.split('\t')
-                    reference = int(reference)
-                    result = searcher.solve_and_count(query)
-                    if result != reference:
-                        print("==> ERROR: '%s'\t%d\t%d" %
-                              (query, result, reference))
-                        sys.exit(-1)
-                else:
-                    print(line)
-            print('\nParece que todo ha ido bien, buen trabajo!')
+        # The queries are solved in order (in parallel with --jobs) while the lines are printed
+        t0 = time.perf_counter()
+        results = run_batch(args, [('solve_and_count', line.split('\t')[0]) for line in lines
+                                   if len(line) > 0 and not line.startswith('#')])
+        latencies = []
+        for line in lines:
+            if len(line) > 0 and not line.startswith('#'):
+                query, reference = line.split('\t')
+                reference = int(reference)
+                output, result, seconds, _, _ = next(results)
+                sys.stdout.write(output)
+                latencies.append(seconds)
+                if result != reference:
+                    print("==> ERROR: '%s'\t%d\t%d" %
+                          (query, result, reference))
+                    sys.exit(-1)
+            else:
+                print(line)
+        show_throughput(latencies, time.perf_counter() - t0)
+        print('\nParece que todo ha ido bien, buen trabajo!')
 
     elif args.query is not None:
         # opt: -Q, una query pasada como argumento
-        fnc(args.query)  # searcher.solve_and_show(args.query)
+        solve(fnc, args.query)  # searcher.solve_and_show(args.query)
 
     elif args.qlist is not None:
         # opt: -L, una lista de queries
         with open(args.qlist, encoding='utf-8') as fh:
             queries = fh.read().split('\n')
             queries.pop()
-            for query in queries:
-                if len(query) > 0 and not query.startswith('#'):
-                    fnc(query)
-                else:
-                    print(query)
+        t0 = time.perf_counter()
+        results = run_batch(args, [(method, query) for query in queries
+                                   if len(query) > 0 and not query.startswith('#')])
+        latencies = []
+        for query in queries:
+            if len(query) > 0 and not query.startswith('#'):
+                output, _, seconds, _, _ = next(results)
+                sys.stdout.write(output)
+                latencies.append(seconds)
+            else:
+                print(query)
+        show_throughput(latencies, time.perf_counter() - t0)
     else:
         # modo interactivo
         query = input("query:")
         while query != "":
-            fnc(query)
+            solve(fnc, query)
             query = input("query:")
+
+    if args.cache_stats:
+        print('Query cache: %d hits, %d misses, %d results with %d news ids.' %
+              (searcher.cache_hits, searcher.cache_misses, len(searcher.query_cache), searcher.cache_postings))
+
+    if profiler is not None:
+        print(profiler.summary())
+        if profiler.trace is not None:
+            profiler.trace.close()
@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import SAR_Searcher
+from SAR_lib import SAR_Project
+
+# Servidor de busquedas: carga el indice una vez y responde consultas por HTTP en JSON.
+#
+# El bucle de asyncio solo lee las peticiones y escribe las respuestas; las consultas se
+# resuelven en un pool de procesos que, con fork, heredan el indice ya cargado (ver
+# SAR_Searcher.run_batch). Como mucho hay "concurrency" consultas en curso o esperando un
+# proceso; el resto espera un hueco y, si no lo consigue antes del timeout, recibe un 503.
+# Una consulta que no termina a tiempo recibe un 504: si aun no habia empezado se cancela,
+# si ya se estaba resolviendo el proceso la termina y su resultado se descarta.
+#
+#   GET /search?q=query[&stem=1][&rank=1][&snippet=1][&all=1][&limit=N]
+#   GET /stats
+
+# tamaño maximo de la linea de peticion y las cabeceras
+MAX_HEADER = 16384
+
+# segundos que se mantiene abierta una conexion sin peticiones
+IDLE_TIMEOUT = 60
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+def worker_ready():
+    """
+    Se ejecuta en un proceso del pool para arrancarlo.
+
+    return: numero de noticias del indice cargado en el proceso
+    """
+    searcher = SAR_Searcher.searcher
+    return searcher.news_counter - len(searcher.deleted)
+
+
+def search_job(query, options):
+    """
+    Resuelve una consulta en un proceso del pool.
+
+    param:  "query": consulta
+            "options": tupla (stemming, ranking, snippet, todos los resultados, limite)
+
+    return: resultado de SAR_Project.solve_and_collect con el tiempo de la consulta en "ms"
+    """
+    searcher = SAR_Searcher.searcher
+    stem, rank, snippet, show_all, limit = options
+    searcher.set_stemming(stem)
+    searcher.set_ranking(rank)
+    searcher.set_snippet(snippet)
+    searcher.set_showall(show_all)
+    t0 = time.perf_counter()
+    result = searcher.solve_and_collect(query, limit)
+    result['ms'] = round((time.perf_counter() - t0) * 1000, 3)
+    return result
+
+
+def flag(params, name, default):
+    """
+    param:  "params": parametros de la peticion (parse_qs)
+            "name": nombre del parametro
+            "default": valor si no esta en la peticion
+
+    return: el valor booleano del parametro
+    """
+    if name not in params:
+        return default
+    value = params[name][-1].lower()
+    if value in ('1', 'true', 'yes', 'on', ''):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('invalid value %r for %r' % (params[name][-1], name))
+
+
+class SearchServer:
+    """
+    Atiende las peticiones HTTP y reparte las consultas entre los procesos del pool.
+    """
+
+    def __init__(self, args, pool, news):
+        """
+        param:  "args": opciones de la linea de comandos
+                "pool": ProcessPoolExecutor con el indice cargado en cada proceso
+                "news": numero de noticias del indice
+        """
+        self.args = args
+        self.pool = pool
+        self.news = news
+        self.slots = None
+        self.started = time.time()
+        self.stats = dict.fromkeys(('requests', 'queries', 'errors', 'rejected', 'timeouts'), 0)
+        self.in_flight = 0
+
+    async def serve(self):
+        """
+        Escucha en args.host:args.port hasta que se interrumpe el proceso.
+        """
+        self.slots = asyncio.Semaphore(self.args.concurrency)
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port, limit=MAX_HEADER)
+        for sock in server.sockets:
+            host, port = sock.getsockname()[:2]
+            print('Serving %d news on http://%s:%d/ with %d processes.' % (self.news, host, port, self.args.jobs))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """
+        Atiende las peticiones de una conexion, una tras otra mientras el cliente la mantenga abierta.
+        """
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 400, {'error': 'request header too large'}, False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split()
+                if len(request) != 3:
+                    await self.respond(writer, 400, {'error': 'malformed request line'}, False)
+                    break
+                method, target, version = request
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                # The endpoints take no body, it is read only to keep the connection in sync
+                length = headers.get('content-length', '0')
+                if not length.isdigit():
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'}, False)
+                    break
+                if int(length):
+                    await reader.readexactly(int(length))
+                status, body = await self.dispatch(method, target)
+                await self.respond(writer, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, keep_alive):
+        """
+        Escribe una respuesta HTTP con un cuerpo JSON.
+        """
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=utf-8\r\n'
+                      'Content-Length: %d\r\nConnection: %s\r\n\r\n' %
+                      (status, REASONS[status], len(data), 'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+        writer.write(data)
+        await writer.drain()
+
+    async def dispatch(self, method, target):
+        """
+        return: par (codigo HTTP, cuerpo de la respuesta)
+        """
+        self.stats['requests'] += 1
+        url = urlsplit(target)
+        if url.path not in ('/search', '/stats'):
+            return 404, {'error': 'unknown path %r' % url.path}
+        if method != 'GET':
+            return 405, {'error': 'method %s not allowed' % method}
+        if url.path == '/stats':
+            return 200, dict(self.stats, news=self.news, in_flight=self.in_flight, processes=self.args.jobs,
+                             concurrency=self.args.concurrency, timeout=self.args.timeout,
+                             uptime=round(time.time() - self.started, 3))
+        params = parse_qs(url.query, keep_blank_values=True)
+        query = params.get('q', [''])[-1].strip()
+        if not query:
+            return 400, {'error': 'missing query parameter "q"'}
+        try:
+            limit = int(params['limit'][-1]) if 'limit' in params else None
+            if limit is not None and limit < 0:
+                raise ValueError('invalid value %r for %r' % (params['limit'][-1], 'limit'))
+            show_all = flag(params, 'all', self.args.all)
+            options = (flag(params, 'stem', self.args.stem), flag(params, 'rank', self.args.rank),
+                       flag(params, 'snippet', self.args.snippet),
+                       # Without show_all the ranking keeps only the first SHOW_MAX news
+                       show_all or (limit is not None and limit > SAR_Project.SHOW_MAX), limit)
+        except ValueError as err:
+            return 400, {'error': str(err)}
+        return await self.search(query, options)
+
+    async def search(self, query, options):
+        """
+        Resuelve una consulta en el pool, esperando un hueco si ya hay self.args.concurrency en curso.
+
+        return: par (codigo HTTP, cuerpo de la respuesta)
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.args.timeout
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.stats['rejected'] += 1
+            return 503, {'error': 'server busy', 'query': query}
+        self.in_flight += 1
+
+        def release(_):
+            self.in_flight -= 1
+            self.slots.release()
+
+        # The slot is freed when the process finishes the query, not when the client gives up on it
+        t0 = time.perf_counter()
+        future = self.pool.submit(search_job, query, options)
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(release, f))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), deadline - loop.time())
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return 504, {'error': 'query timed out', 'query': query}
+        except ValueError as err:
+            # syntax errors of the query
+            self.stats['errors'] += 1
+            return 400, {'error': str(err), 'query': query}
+        except Exception as err:
+            self.stats['errors'] += 1
+            return 500, {'error': '%s: %s' % (type(err).__name__, err), 'query': query}
+        self.stats['queries'] += 1
+        result['elapsed_ms'] = round((time.perf_counter() - t0) * 1000, 3)
+        return 200, result
+
+
+def start_pool(args):
+    """
+    Arranca el pool de procesos con el indice cargado.
+
+    Con fork el indice se carga una vez aqui y los procesos lo heredan (un segmento se comparte
+    via mmap); si el sistema no tiene fork cada proceso lo carga al arrancar.
+
+    return: par (ProcessPoolExecutor, numero de noticias del indice)
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        SAR_Searcher.load_searcher(args)
+        pool = ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context('fork'))
+    else:
+        pool = ProcessPoolExecutor(args.jobs, initializer=SAR_Searcher.load_searcher, initargs=(args,))
+    # The processes are started before the event loop, so none is forked from a running loop
+    news = pool.submit(worker_ready).result()
+    return pool, news
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve searches on the index over HTTP, with results in JSON.')
+
+    parser.add_argument('index', metavar='index', type=str,
+                        help='name of the file with the index object.')
+
+    parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                        help='use stem index by default (a request can change it with stem=0|1).')
+
+    parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                        help='rank results by default (rank=0|1).')
+
+    parser.add_argument('-N', '--snippet', dest='snippet', action='store_true', default=False,
+                        help='return a snippet of the retrieved documents by default (snippet=0|1).')
+
+    parser.add_argument('-A', '--all', dest='all', action='store_true', default=False,
+                        help='return all the results by default (all=0|1). If not used, only the first 10 results are returned.')
+
+    parser.add_argument('-K', '--cache', dest='cache', metavar='N', type=int, default=SAR_Project.QUERY_CACHE,
+                        help='size of the cache of query and subquery results of each process, in news ids (default %d, 0 disables it).' % SAR_Project.QUERY_CACHE)
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                        help='address to listen on (default 127.0.0.1).')
+
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8080,
+                        help='port to listen on (default 8080).')
+
+    parser.add_argument('-J', '--jobs', dest='jobs', metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='number of processes that solve the queries (default the number of CPUs).')
+
+    parser.add_argument('-c', '--concurrency', dest='concurrency', metavar='N', type=int, default=None,
+                        help='maximum number of queries being solved or waiting for a process (default 4 per process).')
+
+    parser.add_argument('-t', '--timeout', dest='timeout', metavar='seconds', type=float, default=10.0,
+                        help='time limit of each query, including the wait for a free slot (default 10).')
+
+    parser.set_defaults(explain=False)
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.concurrency is None:
+        args.concurrency = 4 * args.jobs
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    pool, news = start_pool(args)
+    try:
+        asyncio.run(SearchServer(args, pool, news).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown(cancel_futures=True)
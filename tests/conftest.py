@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, 'Entrega')
+sys.path.insert(0, LIB)
+
+# noticias del corpus de prueba, repartidas en dos ficheros
+NEWS = [
+    [{'title': 'la casa de valencia', 'date': '2015-01-01', 'keywords': 'casa playa',
+      'article': 'una casa grande en la playa de valencia', 'summary': 'casa en valencia'},
+     {'title': 'cosas del mar', 'date': '2015-01-01', 'keywords': 'mar',
+      'article': 'el mar y la playa de la cosa nostra', 'summary': 'mar'}],
+    [{'title': 'la causa del juicio', 'date': '2015-01-02', 'keywords': 'juicio causa',
+      'article': 'la causa llega al juicio en madrid', 'summary': 'juicio en madrid'},
+     {'title': 'valencia gana', 'date': '2015-01-02', 'keywords': 'futbol',
+      'article': 'valencia gana en casa y la afición celebra en la calle', 'summary': 'valencia gana'}],
+]
+
+
+def run(script, *args):
+    """
+    Ejecuta un script de la raiz del repositorio y devuelve su salida.
+    """
+    env = dict(os.environ, PYTHONPATH=LIB)
+    res = subprocess.run([sys.executable, os.path.join(ROOT, script)] + [str(arg) for arg in args],
+                         cwd=ROOT, env=env, capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    return res.stdout
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """
+    Directorio con el corpus de prueba.
+    """
+    newsdir = tmp_path / 'news'
+    newsdir.mkdir()
+    for i, news in enumerate(NEWS):
+        (newsdir / ('2015-01-%02d.json' % (i + 1))).write_text(json.dumps(news, ensure_ascii=False), encoding='utf-8')
+    return newsdir
+
+
+@pytest.fixture
+def baseline_index(corpus, tmp_path):
+    """
+    Indice del corpus de prueba guardado como pickle con los atributos de la version original
+    de SAR_Project (diccionarios, sin longitudes de las noticias ni opciones añadidas despues).
+    """
+    import pickle
+    import re
+    from SAR_lib import SAR_Project
+
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=False, positional=False, stem=False, permuterm=False)
+    state = {
+        'index': {field: {token: dict(postings) for token, postings in terms.items()}
+                  for field, terms in project.index.items()},
+        'sindex': {field: {} for field in project.index},
+        'ptindex': {field: {} for field in project.index},
+        'docs': {docid: project.docs[docid] for docid in project.docs},
+        'weight': {},
+        'news': {new: project.news[new][:2] for new in project.news},
+        'tokenizer': re.compile(r"\W+"),
+        'stemmer': project.stemmer,
+        'show_all': False, 'show_snippet': False, 'use_stemming': False, 'use_ranking': False,
+        'docid': project.docid, 'news_counter': project.news_counter, 'tokens': project.tokens,
+        'multifield': False, 'positional': False, 'stemming': False, 'permuterm': False,
+    }
+    old = SAR_Project.__new__(SAR_Project)
+    old.__dict__.update(state)
+    index = tmp_path / 'baseline.bin'
+    with open(index, 'wb') as fh:
+        pickle.dump(old, fh)
+    return index
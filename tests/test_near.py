@@ -0,0 +1,58 @@
+import pytest
+
+from SAR_lib import SAR_Project
+from SAR_query import parse_query
+
+
+@pytest.fixture(params=['memory', 'segment'])
+def project(request, corpus, tmp_path):
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=True, positional=True, stem=False, permuterm=False)
+    if request.param == 'segment':
+        project.save(str(tmp_path / 'near.idx'))
+        project = SAR_Project.load(str(tmp_path / 'near.idx'))
+    return project
+
+
+def count(project, query):
+    return len(project.solve_query(query))
+
+
+def test_near_distance_one(project):
+    # "casa grande": adjacent words are at distance 1
+    assert count(project, 'casa NEAR/1 grande') == 1
+    # "una casa grande": distance 2
+    assert count(project, 'una NEAR/1 grande') == 0
+    assert count(project, 'una NEAR/2 grande') == 1
+
+
+def test_near_any_order(project):
+    assert count(project, 'la NEAR/1 playa') == 2
+    assert count(project, 'playa NEAR/1 la') == 2
+    assert count(project, 'grande NEAR/1 casa') == 1
+    assert count(project, 'de NEAR/2 playa NEAR/2 la') == 2
+
+
+def test_near_repeated_term(project):
+    # Every operand needs its own position: "la" twice within the distance
+    assert count(project, 'la') == 4
+    assert count(project, 'la NEAR/1 la') == 0
+    assert count(project, 'la NEAR/3 la') == 1
+    assert count(project, 'la NEAR/4 la') == 2
+    assert count(project, 'la NEAR/3 la NEAR/3 la') == 0
+
+
+def test_near_field(project):
+    # title "la casa de valencia"
+    assert count(project, 'title:valencia NEAR/3 title:la') == 1
+    assert count(project, 'title:valencia NEAR/2 title:la') == 0
+    # the operands without a field take the field of the first one
+    assert count(project, 'title:valencia NEAR/3 la') == 1
+    assert count(project, 'title:la NEAR/1 title:la') == 0
+
+
+def test_near_zero():
+    with pytest.raises(ValueError):
+        parse_query('casa NEAR/0 casa')
+    with pytest.raises(ValueError):
+        parse_query('casa NEAR/0 grande')
@@ -0,0 +1,28 @@
+from conftest import run
+from SAR_lexicon import Permuterms
+
+
+def test_wildcard_without_permuterm(corpus, tmp_path):
+    index = tmp_path / 'np.bin'
+    run('SAR_Indexer.py', corpus, index, '-F', 'pickle')
+    assert run('SAR_Searcher.py', index, '-C', '-Q', 'c*sa') == 'c*sa\t0\n'
+    # Ranking and snippets expand the wildcards of the query too
+    out = run('SAR_Searcher.py', index, '-R', '-N', '-Q', 'casa OR c*sa')
+    assert 'Number of results: 2' in out
+
+
+def test_wildcard_with_permuterm(corpus, tmp_path):
+    for fmt in ('pickle', 'segment'):
+        index = tmp_path / ('p.' + fmt)
+        run('SAR_Indexer.py', corpus, index, '-P', '-F', fmt)
+        assert run('SAR_Searcher.py', index, '-C', '-Q', 'c*sa') == 'c*sa\t4\n'
+        assert run('SAR_Searcher.py', index, '-C', '-Q', 'c?sa') == 'c?sa\t3\n'
+
+
+def test_add_terms():
+    terms = ['casa', 'causa', 'cosa', 'mar', 'playa', 'valencia', 'zz']
+    for new in (['causa', 'zz'], ['casa', 'mar'], terms):
+        old = [term for term in terms if term not in new]
+        updated = Permuterms.from_terms(old).add_terms(new)
+        assert updated.terms == terms
+        assert updated.rotations == Permuterms.from_terms(terms).rotations
@@ -0,0 +1,16 @@
+from SAR_lib import SAR_Project
+from SAR_profile import Profiler
+
+
+def test_or_postings(corpus):
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=False, positional=False, stem=False, permuterm=False)
+    profiler = Profiler()
+    profiler.install(project)
+    assert project.solve_and_count('valencia OR playa') == 3
+    # valencia is in news 0 and 3, playa in news 0 and 1
+    assert profiler.totals['multi_or_posting']['postings_in'] == 4
+    assert profiler.totals['multi_or_posting']['postings_out'] == 3
+    assert profiler.totals['get_docids']['postings_in'] == 4
+    assert profiler.totals['solve_query']['postings_in'] == 0
+
@@ -0,0 +1,31 @@
+from conftest import run
+from SAR_segment import is_segment
+
+
+def test_rank_baseline_pickle(baseline_index):
+    out = run('SAR_Searcher.py', baseline_index, '-R', '-Q', 'valencia OR playa')
+    assert 'Number of results: 3' in out
+    scores = [float(line.split('\t')[1].split(')')[0][1:]) for line in out.split('\n') if line.startswith('#')]
+    assert len(scores) == 3 and scores == sorted(scores, reverse=True)
+
+
+def test_update_baseline_pickle(corpus, baseline_index):
+    (corpus / '2015-01-03.json').write_text('[{"title": "otra noticia", "date": "2015-01-03", "keywords": "valencia",'
+                                            ' "article": "valencia otra vez", "summary": ""}]', encoding='utf-8')
+    (corpus / '2015-01-01.json').unlink()
+    assert 'Files added: 1, modified: 0, deleted: 1.' in run('SAR_Indexer.py', corpus, baseline_index, '-U')
+    # The index is saved in the format it was loaded in
+    assert not is_segment(baseline_index)
+    assert 'Number of results: 2' in run('SAR_Searcher.py', baseline_index, '-R', '-Q', 'valencia')
+    run('SAR_Indexer.py', corpus, baseline_index, '-Z')
+    assert 'Number of results: 2' in run('SAR_Searcher.py', baseline_index, '-R', '-Q', 'valencia')
+
+
+def test_update_keeps_format(corpus, tmp_path):
+    for fmt in ('pickle', 'segment'):
+        index = tmp_path / ('i.' + fmt)
+        run('SAR_Indexer.py', corpus, index, '-F', fmt)
+        run('SAR_Indexer.py', corpus, index, '-U', '-Z')
+        assert is_segment(index) == (fmt == 'segment')
+    run('SAR_Indexer.py', corpus, index, '-U', '-F', 'pickle')
+    assert not is_segment(index)
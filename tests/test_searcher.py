@@ -0,0 +1,29 @@
+import pytest
+
+from conftest import run
+
+
+@pytest.fixture
+def index(corpus, tmp_path):
+    index = tmp_path / 'i.idx'
+    run('SAR_Indexer.py', corpus, index)
+    return index
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_malformed_query_in_list(index, tmp_path, jobs):
+    queries = tmp_path / 'queries.txt'
+    queries.write_text('valencia\nvalencia AND\n(casa\ncasa\n', encoding='utf-8')
+    out = run('SAR_Searcher.py', index, '-C', '-J', jobs, '-L', queries).split('\n')
+    assert out[:4] == ['valencia\t2', 'valencia AND\tERROR: expected a term but found \'end of query\'',
+                       '(casa\tERROR: missing ")" in query', 'casa\t2']
+
+
+def test_malformed_query_in_test_file(index, tmp_path):
+    test = tmp_path / 'test.txt'
+    test.write_text('valencia\t2\nvalencia AND\t0\ncasa\t2\n', encoding='utf-8')
+    assert 'Parece que todo ha ido bien' in run('SAR_Searcher.py', index, '-T', test)
+
+
+def test_malformed_query(index):
+    assert run('SAR_Searcher.py', index, '-Q', 'NOT').startswith('NOT\tERROR: ')
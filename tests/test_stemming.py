@@ -0,0 +1,61 @@
+import pytest
+from nltk.stem.snowball import SnowballStemmer
+
+from SAR_lib import SAR_Project
+
+
+class NoStemmer:
+    def stem(self, term):
+        raise AssertionError('stem of %r computed again' % term)
+
+
+@pytest.fixture
+def indexes(corpus, tmp_path):
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=True, positional=False, stem=True, permuterm=False)
+    project.save(str(tmp_path / 'stem.idx'))
+    project.save(str(tmp_path / 'stem.pkl'), 'pickle')
+    return SAR_Project.load(str(tmp_path / 'stem.idx')), SAR_Project.load(str(tmp_path / 'stem.pkl'))
+
+
+def test_stored_stems(indexes):
+    segment, _ = indexes
+    snowball = SnowballStemmer('spanish')
+    # The stems of the index terms are read from the segment, not computed again
+    segment.stemmer = NoStemmer()
+    for term in ('casa', 'causa', 'valencia', 'gana', 'afición', 'celebra', 'juicio'):
+        assert segment.stem(term) == snowball.stem(term)
+    # only in the title
+    assert segment.stem('cosas') == snowball.stem('cosas')
+
+
+def test_unknown_term_stem(indexes):
+    segment, _ = indexes
+    assert segment.stem('casitas') == SnowballStemmer('spanish').stem('casitas')
+
+
+def test_stem_queries(indexes):
+    segment, pickled = indexes
+    for project in indexes:
+        project.set_stemming(True)
+    for query in ('casa', 'cosa', 'causas', 'title:cosa', 'keywords:juicios AND valencia', 'ganar OR playas'):
+        assert list(segment.solve_query(query)) == list(pickled.solve_query(query))
+    assert len(segment.solve_query('casas')) == 2
+
+
+def test_stem_lists_of_older_pickles(corpus, tmp_path):
+    # Older versions kept the terms of each stem and permuterm in lists
+    import pickle
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=True, positional=False, stem=True, permuterm=True)
+    expected = {field: dict(project.sindex[field].items()) for field in project.sindex}
+    project.sindex = {field: {stem: list(reversed(terms)) for stem, terms in expected[field].items()}
+                      for field in project.sindex}
+    project.ptindex = {field: dict(project.ptindex[field].items()) for field in project.ptindex}
+    with open(tmp_path / 'old.pkl', 'wb') as fh:
+        pickle.dump(project, fh)
+    project = SAR_Project.load(str(tmp_path / 'old.pkl'))
+    assert {field: dict(project.sindex[field].items()) for field in project.sindex} == expected
+    assert project.sindex['article'].terms is project.ptindex['article'].terms
+    project.set_stemming(True)
+    assert len(project.solve_query('casas')) == 2
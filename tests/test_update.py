@@ -0,0 +1,68 @@
+import os
+import shutil
+
+import pytest
+
+from SAR_lib import SAR_Project
+from SAR_segment import UpdatedTable
+
+QUERIES = ('casa', 'valencia AND la', 'juicio OR mar', 'NOT playa', 'title:valencia', 'keywords:causa',
+           'c*sa', '"la playa"', 'la NEAR/3 la')
+
+
+def build(corpus, filename, **args):
+    project = SAR_Project()
+    project.index_dir(str(corpus), multifield=True, positional=True, stem=True, permuterm=True, **args)
+    project.save(str(filename))
+    return SAR_Project.load(str(filename))
+
+
+def results(project):
+    res = {}
+    for stem in (False, True):
+        project.set_stemming(stem)
+        for query in QUERIES:
+            res[stem, query] = sorted((project.docs[project.news[new][0]], project.news[new][1])
+                                      for new in project.solve_query(query))
+    return res
+
+
+@pytest.mark.parametrize('args', [{}, {'stem_postings': True, 'bitmap_threshold': 0.5}])
+def test_update_segment(corpus, tmp_path, args):
+    added = corpus / '2015-01-02.json'
+    os.rename(added, tmp_path / 'added.json')
+    project = build(corpus, tmp_path / 'upd.idx', **args)
+    shutil.copy(tmp_path / 'upd.idx', tmp_path / 'mem.idx')
+    os.rename(tmp_path / 'added.json', added)
+    fresh = build(corpus, tmp_path / 'fresh.idx', **args)
+
+    assert project.update_dir(str(corpus)) == (1, 0, 0)
+    # The posting lists stay in the segment, only those of the terms of the new file are in memory
+    table = project.index['article']
+    assert isinstance(table, UpdatedTable)
+    assert set(table.changed) == {'la', 'causa', 'llega', 'al', 'juicio', 'en', 'madrid', 'valencia', 'gana',
+                                  'casa', 'y', 'afición', 'celebra', 'calle'}
+    assert table.added == {'causa', 'llega', 'al', 'juicio', 'madrid', 'gana', 'afición', 'celebra', 'calle'}
+    assert len(table) == len(fresh.index['article'])
+    assert results(project) == results(fresh)
+
+    project.save(str(tmp_path / 'upd.idx'))
+    assert results(SAR_Project.load(str(tmp_path / 'upd.idx'))) == results(fresh)
+    # The same update on the index loaded in memory writes the same segment
+    loaded = SAR_Project.load(str(tmp_path / 'mem.idx'))
+    loaded.materialize()
+    loaded.update_dir(str(corpus))
+    loaded.save(str(tmp_path / 'mem.idx'))
+    with open(tmp_path / 'upd.idx', 'rb') as upd, open(tmp_path / 'mem.idx', 'rb') as mem:
+        assert upd.read() == mem.read()
+
+
+def test_update_deleted_file(corpus, tmp_path):
+    project = build(corpus, tmp_path / 'upd.idx')
+    os.remove(corpus / '2015-01-01.json')
+    assert project.update_dir(str(corpus)) == (0, 0, 1)
+    project.save(str(tmp_path / 'upd.idx'))
+    project = SAR_Project.load(str(tmp_path / 'upd.idx'))
+    assert len(project.solve_query('mar')) == 0
+    project.purge()
+    assert results(project) == results(build(corpus, tmp_path / 'fresh.idx'))